@@ -0,0 +1,202 @@
+# async_engine.py
+import asyncio
+from message_handler import MessageHandler
+from logger_utility import Logger, WARNING, ERROR
+from protocol import FrameDecoder, MAX_PAYLOAD, LOGIN_MAX_PAYLOAD
+from outbound_queue import OutboundQueue, coalesce
+from metrics import BYTES_IN, BYTES_OUT, SEND_ERRORS, HANDSHAKE_FAILURES
+
+logger = Logger()
+
+READ_SIZE = 64 * 1024
+
+
+class AsyncConnection:
+    """Socket-like wrapper around a StreamWriter so MessageHandler can treat
+    asyncio clients exactly like the threaded engine's ClientConnection.
+
+    Writes go through the same bounded OutboundQueue, drained by one writer
+    task per client instead of a writer thread.
+    """
+
+    def __init__(self, writer, max_messages, policy, coalesce_delay=0.0):
+        self.writer = writer
+        self.coalesce_delay = coalesce_delay
+        self.peername = writer.get_extra_info("peername")
+        self.codec = None  # compression negotiated at login
+        self.loop = asyncio.get_running_loop()
+        self.ready = asyncio.Event()
+        self.queue = OutboundQueue(max_messages, policy, on_ready=self._wake)
+        self.task = self.loop.create_task(self._write_loop())
+
+    def _in_loop(self):
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def _wake(self):
+        # In cluster mode the bus reader thread queues frames for asyncio clients too
+        if self._in_loop():
+            self.ready.set()
+        else:
+            self.loop.call_soon_threadsafe(self.ready.set)
+
+    async def _write_loop(self):
+        try:
+            while True:
+                batch = self.queue.take_all(block=False)
+                if batch is None:
+                    break
+                if not batch:
+                    self.ready.clear()
+                    await self.ready.wait()
+                    continue
+                if self.coalesce_delay:
+                    await asyncio.sleep(self.coalesce_delay)
+                    batch.extend(self.queue.take_all(block=False) or ())
+                # The SSL transport turns every write() into its own TLS record, so pack them
+                for data in coalesce(batch):
+                    self.writer.write(data)
+                    BYTES_OUT.inc(len(data))
+                await self.writer.drain()
+        except Exception as e:
+            SEND_ERRORS.inc()
+            logger.log_event(f"[SEND ERROR] {self.peername}: {e}", ERROR, addr=self.peername)
+            self.queue.close(discard=True)
+        self.writer.close()
+
+    def send(self, data, system=True, force=False):
+        if not self.queue.put(data, system, force):
+            logger.log_event(f"[SLOW CONSUMER] Disconnecting {self.peername} ({self.queue.policy})", WARNING,
+                             addr=self.peername)
+            self.abort()
+        return len(data)
+
+    def sendall(self, data):
+        self.send(data)
+
+    def when_writable(self, max_bytes, callback, max_messages=None):
+        """True if the queue has room; otherwise callback() runs once the writer task has drained it."""
+        return self.queue.when_writable(max_bytes, callback, max_messages)
+
+    def getpeername(self):
+        return self.peername
+
+    def close(self):
+        self.queue.close()
+
+    def abort(self):
+        self.queue.close(discard=True)
+        if not self._in_loop():
+            self.loop.call_soon_threadsafe(self._abort_transport)
+            return
+        self._abort_transport()
+
+    def _abort_transport(self):
+        self.writer.transport.abort()
+
+
+class AsyncEngine:
+    """Serves every client from one event loop instead of one thread per client."""
+
+    def __init__(self, server):
+        self.server = server
+        self.pending_logins = 0
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        # Reuse the socket Server already bound so stop() still closes it
+        self.server.server_socket.setblocking(False)
+        aio_server = await asyncio.start_server(
+            self.handle_connection,
+            sock=self.server.server_socket,
+            ssl=self.server.context,
+            ssl_handshake_timeout=self.server.handshake_timeout,
+            backlog=self.server.max_pending_handshakes,
+        )
+        worker = f", worker {self.server.worker_id}" if self.server.worker_id is not None else ""
+        logger.log_event(
+            f"[SECURE SERVER STARTED] Listening on {self.server.host}:{self.server.port} (asyncio{worker})"
+        )
+        async with aio_server:
+            await aio_server.serve_forever()
+
+    async def handle_connection(self, reader, writer):
+        addr = writer.get_extra_info("peername")
+        logger.log_event(f"[SECURE CONNECTION] TLS handshake successful with {addr}", addr=addr)
+        conn = AsyncConnection(writer, self.server.max_queue, self.server.slow_consumer_policy,
+                               self.server.coalesce_delay)
+
+        # Handshakes never block the loop here, but cap logins in flight all the same
+        if self.pending_logins >= self.server.max_pending_handshakes:
+            logger.log_event(f"[HANDSHAKE REJECTED] {addr}: {self.pending_logins} logins pending", WARNING, addr=addr)
+            HANDSHAKE_FAILURES.inc()
+            conn.abort()
+            return
+
+        # First frame from client is the HELLO carrying its username
+        decoder = FrameDecoder(max_payload=LOGIN_MAX_PAYLOAD)
+        self.pending_logins += 1
+        try:
+            frame = await asyncio.wait_for(self.read_frame(reader, decoder), self.server.login_timeout)
+            hello = self.server.parse_hello(frame)
+        except Exception as e:
+            logger.log_event(f"[HANDSHAKE ERROR] {addr}: {e!r}", WARNING, addr=addr)
+            hello = None
+        finally:
+            self.pending_logins -= 1
+        if not hello:
+            HANDSHAKE_FAILURES.inc()
+            conn.abort()
+            return
+        decoder.max_payload = MAX_PAYLOAD
+
+        if self.server.registry.register_blocks:
+            # A cluster-wide name claim waits on the bus, never on the loop
+            try:
+                username = await asyncio.get_running_loop().run_in_executor(None, self.server.register_client,
+                                                                            conn, hello)
+            except Exception as e:
+                logger.log_event(f"[HANDSHAKE ERROR] {addr}: {e!r}", WARNING, addr=addr)
+                HANDSHAKE_FAILURES.inc()
+                conn.abort()
+                return
+        else:
+            username = self.server.register_client(conn, hello)
+        logger.log_event(f"[NEW CONNECTION] {username} ({addr})", user=username, addr=addr)
+
+        handler = MessageHandler(conn, addr, self.server, threaded=False, decoder=decoder)
+        logger.log_event(f"[CONNECTED] {username} ({addr})", user=username, addr=addr)
+        while handler.running:
+            try:
+                if not handler.handle_frames(username):
+                    break
+                if handler.pause:
+                    # Over the rate limit: once the StreamReader buffer fills, asyncio stops reading the socket
+                    await asyncio.sleep(handler.pause)
+                    continue
+                data = await reader.read(READ_SIZE)
+                if not data:
+                    break
+                BYTES_IN.inc(len(data))
+                decoder.feed(data)
+            except Exception as e:
+                logger.log_event(f"[DISCONNECTED] {username} ({e})", type="disconnect_reason", user=username,
+                                 addr=addr, reason=str(e))
+                break
+        handler.stop()
+
+    @staticmethod
+    async def read_frame(reader, decoder):
+        """Wait until one whole frame is buffered in decoder. Returns None on EOF."""
+        while True:
+            frame = decoder.next_frame()
+            if frame is not None:
+                return frame
+            data = await reader.read(READ_SIZE)
+            if not data:
+                return None
+            decoder.feed(data)
@@ -0,0 +1,579 @@
+# benchmark.py
+"""Load generator and latency benchmark for the chat server.
+
+Starts connection_manager.py on a free localhost port (or targets a running
+server with --server), opens N TLS clients speaking the real protocol and
+drives one or more scenarios. Results are printed as JSON so runs against
+different engines or settings can be diffed and compared.
+
+    python benchmark.py --scenario broadcast --clients 50 --messages 200 --engine asyncio
+    python benchmark.py --scenario all --output results.json
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import os
+import platform
+import secrets
+import shutil
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+from file_transfer import UPLOAD_CHUNK_SIZE
+from protocol import (FrameDecoder, encode_frame, encode_hello, encode_text, encode_json, decode_json, decompress_payload,
+                      HEADER, PROTOCOL_VERSION, TEXT, FILE_START, FILE_DATA, FILE_END, FILE_OFFER, FILE_ACCEPT,
+                      FILE_CANCEL, PING, PONG, TRANSFER_ID_SIZE, FLAG_COMPRESSED, COMPRESSION_CODECS)
+from tls_config import client_context
+
+SCENARIOS = ("broadcast", "pm", "list", "file", "churn")
+
+# Chat payloads carry their own send time, so the receiver can compute delivery latency
+MARKER = "bench|"
+
+READ_SIZE = 64 * 1024
+
+
+# ---------------- STATISTICS ----------------
+def percentiles(samples):
+    """Summary of a list of durations in nanoseconds, reported in milliseconds."""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    n = len(ordered)
+
+    def rank(p):
+        # Nearest-rank percentile
+        return ordered[max(0, math.ceil(p * n) - 1)] / 1e6
+
+    return {
+        "count": n,
+        "mean": round(sum(ordered) / n / 1e6, 3),
+        "p50": round(rank(0.50), 3),
+        "p99": round(rank(0.99), 3),
+        "p999": round(rank(0.999), 3),
+        "max": round(ordered[-1] / 1e6, 3),
+    }
+
+
+class Stats:
+    def __init__(self):
+        self.sent = 0
+        self.received = 0
+        self.latencies = []   # ns, send -> delivery of one chat line
+        self.handshakes = []  # ns, TCP connect -> TLS established
+        self.logins = []      # ns, HELLO -> first reply from the server
+        self.errors = 0
+        self.monitor = None
+
+
+# ---------------- SERVER PROCESS ----------------
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def process_tree(pid):
+    """pid and all of its descendants (Linux /proc)."""
+    pids = [pid]
+    for p in pids:
+        try:
+            for task in os.listdir(f"/proc/{p}/task"):
+                with open(f"/proc/{p}/task/{task}/children") as f:
+                    pids.extend(int(c) for c in f.read().split())
+        except OSError:
+            pass
+    return pids
+
+
+def sample_resources(pid):
+    """(RSS in KiB, thread count) summed over the server's process tree, or None if unavailable."""
+    rss = threads = 0
+    for p in process_tree(pid):
+        try:
+            with open(f"/proc/{p}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        rss += int(line.split()[1])
+                    elif line.startswith("Threads:"):
+                        threads += int(line.split()[1])
+        except OSError:
+            continue
+    return (rss, threads) if rss else None
+
+
+class ServerProcess:
+    def __init__(self, args):
+        self.port = free_port()
+        here = os.path.dirname(os.path.abspath(__file__))
+        self.blob_dir = tempfile.mkdtemp(prefix="chat_benchmark_blobs_")
+        cmd = [sys.executable, os.path.join(here, "connection_manager.py"),
+               "--port", str(self.port), "--engine", args.engine, "--workers", str(args.workers),
+               "--log-level", args.server_log_level,
+               "--history-dir", "",  # history in memory: runs leave no files behind
+               "--blob-dir", self.blob_dir,
+               "--no-rate-limit"] + args.server_arg  # the scenarios send as fast as they can on purpose
+        env = dict(os.environ, CHAT_LOG_ECHO="0", CHAT_LOG_FILE=args.server_log)
+        self.process = subprocess.Popen(cmd, cwd=here, env=env,
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def wait_ready(self, timeout=15.0):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"Server exited with code {self.process.returncode}")
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=0.5).close()
+                return
+            except OSError:
+                time.sleep(0.1)
+        raise RuntimeError("Server did not start listening in time")
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        shutil.rmtree(self.blob_dir, ignore_errors=True)
+
+
+class ResourceMonitor:
+    """Samples the server's RSS and thread count while a scenario runs."""
+
+    def __init__(self, pid, interval=0.2):
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+
+    def sample(self):
+        if self.pid is not None:
+            sample = sample_resources(self.pid)
+            if sample:
+                self.samples.append(sample)
+
+    async def run(self):
+        while self.pid is not None:
+            self.sample()
+            await asyncio.sleep(self.interval)
+
+    def summary(self):
+        if not self.samples:
+            return None
+        return {
+            "rss_kb_start": self.samples[0][0],
+            "rss_kb_peak": max(s[0] for s in self.samples),
+            "rss_kb_end": self.samples[-1][0],
+            "threads_peak": max(s[1] for s in self.samples),
+            "threads_end": self.samples[-1][1],
+        }
+
+
+# ---------------- CLIENT ----------------
+class BenchClient:
+    """One scripted chat client on the event loop."""
+
+    def __init__(self, name, stats, compression=False, message_size=0):
+        self.name = name
+        self.stats = stats
+        self.compression = list(COMPRESSION_CODECS) if compression else []
+        # Log-like filler in front of the marker, so chat lines are long (and compressible) like pasted output
+        filler = "INFO worker-3 request served in 12ms path=/api/v1/items status=200\n"
+        self.padding = (filler * (message_size // len(filler) + 1))[:message_size]
+        self.decoder = FrameDecoder()
+        self.reader = None
+        self.writer = None
+        self.replies = asyncio.Queue()  # non-benchmark text frames (command replies, system lines)
+        self.files = {}  # transfer id -> Future resolved by FILE_ACCEPT (sender) or FILE_END (recipient)
+        self.task = None
+
+    async def connect(self, host, port, context):
+        start = time.perf_counter_ns()
+        self.reader, self.writer = await asyncio.open_connection(host, port, ssl=context,
+                                                                 server_hostname=host)
+        self.stats.handshakes.append(time.perf_counter_ns() - start)
+        self.task = asyncio.get_running_loop().create_task(self._read_loop())
+
+        # Logged in once the server answers our first command
+        start = time.perf_counter_ns()
+        self.writer.write(encode_hello(self.name, compression=self.compression))
+        await self.command("/list")
+        self.stats.logins.append(time.perf_counter_ns() - start)
+
+    def send_text(self, message):
+        self.writer.write(encode_text(message))
+
+    def send_bench(self, prefix=""):
+        self.stats.sent += 1
+        self.send_text(f"{prefix}{self.padding}{MARKER}{time.perf_counter_ns()}")
+
+    async def command(self, message):
+        """Send a command and return the server's reply."""
+        self.send_text(message)
+        return await self.replies.get()
+
+    async def _read_loop(self):
+        try:
+            while True:
+                data = await self.reader.read(READ_SIZE)
+                if not data:
+                    break
+                now = time.perf_counter_ns()
+                self.decoder.feed(data)
+                for frame_type, flags, payload in self.decoder.frames():
+                    if flags & FLAG_COMPRESSED and frame_type != FILE_DATA:
+                        payload = decompress_payload(payload)
+                    self.handle_frame(frame_type, payload, now)
+        except (ConnectionError, ssl.SSLError, asyncio.CancelledError):
+            pass
+        except Exception:
+            self.stats.errors += 1
+
+    def handle_frame(self, frame_type, payload, now):
+        if frame_type == TEXT:
+            text = str(payload, 'utf-8')
+            at = text.rfind(MARKER)
+            if at >= 0:
+                self.stats.received += 1
+                self.stats.latencies.append(now - int(text[at + len(MARKER):]))
+            else:
+                self.replies.put_nowait(text)
+        elif frame_type == FILE_START:
+            fields = decode_json(payload)
+            self.files[fields["id"]] = [0, asyncio.get_running_loop().create_future()]
+            self.writer.write(encode_json(FILE_ACCEPT, {"id": fields["id"], "offset": 0}))
+        elif frame_type == FILE_DATA:
+            incoming = self.files.get(str(payload[:TRANSFER_ID_SIZE], 'ascii'))
+            if incoming:
+                incoming[0] += len(payload) - TRANSFER_ID_SIZE
+        elif frame_type == PING:
+            self.writer.write(encode_frame(PONG, bytes(payload)))
+        elif frame_type in (FILE_END, FILE_ACCEPT, FILE_CANCEL):
+            fields = decode_json(payload)
+            entry = self.files.get(fields.get("id"))
+            if entry and not entry[1].done():
+                entry[1].set_result((frame_type, fields))
+
+    async def close(self):
+        if self.writer:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except Exception:
+                pass
+        if self.task:
+            self.task.cancel()
+
+
+async def connect_all(args, stats, count, prefix):
+    """Connect count clients, at most args.connect_concurrency handshakes at a time."""
+    context = client_context()
+    slots = asyncio.Semaphore(args.connect_concurrency)
+    clients = [BenchClient(f"{prefix}{i}", stats, args.compression, args.message_size) for i in range(count)]
+
+    async def connect(client):
+        async with slots:
+            await client.connect(args.host, args.port, context)
+
+    await asyncio.gather(*(connect(c) for c in clients))
+    return clients
+
+
+async def close_all(clients, stats):
+    # Last sample while every client is still connected, however short the scenario was
+    stats.monitor.sample()
+    await asyncio.gather(*(c.close() for c in clients))
+
+
+async def wait_for_deliveries(stats, expected, settle):
+    """Wait until expected messages arrived, or none arrived for settle seconds."""
+    last, idle_since = stats.received, time.monotonic()
+    while stats.received < expected:
+        await asyncio.sleep(0.02)
+        if stats.received != last:
+            last, idle_since = stats.received, time.monotonic()
+        elif time.monotonic() - idle_since > settle:
+            break
+
+
+async def pace(rate, index, start):
+    """Sleep until message index is due at rate messages per second (0: no pacing)."""
+    if rate:
+        delay = start + index / rate - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+# ---------------- SCENARIOS ----------------
+async def scenario_broadcast(args, stats, run_id):
+    """Every client sends args.messages chat lines; each is delivered to the rest of its room."""
+    clients = await connect_all(args, stats, args.clients, f"b{run_id}_")
+    rooms = {}
+    for i, client in enumerate(clients):
+        room = f"bench{i // args.room_size}" if args.room_size else None
+        if room:
+            await client.command(f"/join {room}")
+        rooms[room] = rooms.get(room, 0) + 1
+    expected = sum(n * (n - 1) for n in rooms.values()) * args.messages
+
+    async def send(client):
+        start = time.monotonic()
+        for i in range(args.messages):
+            await pace(args.rate, i, start)
+            client.send_bench()
+            await client.writer.drain()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(send(c) for c in clients))
+    await wait_for_deliveries(stats, expected, args.settle)
+    elapsed = time.perf_counter() - start
+    await close_all(clients, stats)
+    return {"expected": expected, "elapsed_s": elapsed, "rooms": len(rooms)}
+
+
+async def scenario_pm(args, stats, run_id):
+    """Every client bursts args.messages /pm lines at the next client."""
+    clients = await connect_all(args, stats, args.clients, f"p{run_id}_")
+    expected = args.clients * args.messages if args.clients > 1 else 0
+
+    async def send(i, client):
+        target = clients[(i + 1) % len(clients)].name
+        start = time.monotonic()
+        for n in range(args.messages):
+            await pace(args.rate, n, start)
+            client.send_bench(f"/pm {target} ")
+            await client.writer.drain()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(send(i, c) for i, c in enumerate(clients)))
+    await wait_for_deliveries(stats, expected, args.settle)
+    elapsed = time.perf_counter() - start
+    await close_all(clients, stats)
+    return {"expected": expected, "elapsed_s": elapsed}
+
+
+async def scenario_list(args, stats, run_id):
+    """Every client polls /list args.messages times, one request in flight at a time."""
+    clients = await connect_all(args, stats, args.clients, f"l{run_id}_")
+
+    async def poll(client):
+        start = time.monotonic()
+        for n in range(args.messages):
+            await pace(args.rate, n, start)
+            sent = time.perf_counter_ns()
+            stats.sent += 1
+            await client.command("/list")
+            stats.received += 1
+            stats.latencies.append(time.perf_counter_ns() - sent)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(poll(c) for c in clients))
+    elapsed = time.perf_counter() - start
+    await close_all(clients, stats)
+    return {"expected": args.clients * args.messages, "elapsed_s": elapsed}
+
+
+async def scenario_file(args, stats, run_id):
+    """Clients pair up and each sender uploads args.file_size bytes to its partner.
+
+    A server with several workers refuses pairs connected to different workers (files
+    are stored per worker); those are reported as "refused", not as errors.
+    """
+    clients = await connect_all(args, stats, max(2, args.clients - args.clients % 2), f"f{run_id}_")
+    durations = []
+    refused = []
+
+    async def transfer(sender, recipient):
+        loop = asyncio.get_running_loop()
+        transfer_id = secrets.token_hex(8)
+        # Different (and incompressible) content per pair, or the server would store it once
+        # and every other sender would skip the upload
+        chunk = os.urandom(UPLOAD_CHUNK_SIZE)
+        sha256 = hashlib.sha256()
+        for offset in range(0, args.file_size, UPLOAD_CHUNK_SIZE):
+            sha256.update(chunk[:min(UPLOAD_CHUNK_SIZE, args.file_size - offset)])
+        digest = sha256.hexdigest()
+        sender.files[transfer_id] = [0, loop.create_future()]
+        start = time.perf_counter_ns()
+        sender.writer.write(encode_json(FILE_OFFER, {"id": transfer_id, "to": recipient.name, "name": "bench.bin",
+                                                     "size": args.file_size, "sha256": digest}))
+        frame_type, fields = await sender.files[transfer_id][1]
+        if frame_type == FILE_CANCEL and fields.get("reason") == "no recipients":
+            refused.append(transfer_id)
+            return
+        if frame_type != FILE_ACCEPT:
+            stats.errors += 1
+            return
+        prefix = HEADER.size + len(transfer_id)
+        header = bytearray(prefix)
+        header[HEADER.size:] = transfer_id.encode('ascii')
+        for offset in range(0, args.file_size, UPLOAD_CHUNK_SIZE):
+            n = min(UPLOAD_CHUNK_SIZE, args.file_size - offset)
+            HEADER.pack_into(header, 0, PROTOCOL_VERSION, FILE_DATA, 0, len(transfer_id) + n)
+            sender.writer.write(bytes(header) + chunk[:n])
+            await sender.writer.drain()
+        sender.writer.write(encode_json(FILE_END, {"id": transfer_id, "sha256": digest}))
+        stats.sent += 1
+
+        while transfer_id not in recipient.files:
+            await asyncio.sleep(0.005)
+        frame_type, fields = await recipient.files[transfer_id][1]
+        if frame_type == FILE_END and recipient.files[transfer_id][0] == args.file_size:
+            stats.received += 1
+            durations.append(time.perf_counter_ns() - start)
+        else:
+            stats.errors += 1
+
+    pairs = [(clients[i], clients[i + 1]) for i in range(0, len(clients), 2)]
+    start = time.perf_counter()
+    await asyncio.gather(*(transfer(s, r) for s, r in pairs))
+    elapsed = time.perf_counter() - start
+    await close_all(clients, stats)
+    stats.latencies = durations  # latency_ms: offer -> last byte delivered, per file
+    return {
+        "expected": len(pairs),
+        "refused": len(refused),
+        "elapsed_s": elapsed,
+        "file_size": args.file_size,
+        "throughput_mb_s": round(len(durations) * args.file_size / elapsed / 1e6, 2) if elapsed else None,
+    }
+
+
+async def scenario_churn(args, stats, run_id):
+    """args.clients workers repeatedly connect, log in and disconnect, args.messages times each."""
+    context = client_context()
+
+    async def churn(worker):
+        for n in range(args.messages):
+            client = BenchClient(f"c{run_id}_{worker}_{n}", stats, args.compression, args.message_size)
+            try:
+                await client.connect(args.host, args.port, context)
+                stats.received += 1
+            except Exception:
+                stats.errors += 1
+            await client.close()
+            stats.sent += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(churn(w) for w in range(min(args.clients, args.connect_concurrency))))
+    elapsed = time.perf_counter() - start
+    return {"expected": stats.sent, "elapsed_s": elapsed,
+            "connections_per_s": round(stats.received / elapsed, 1) if elapsed else None}
+
+
+SCENARIO_FUNCTIONS = {
+    "broadcast": scenario_broadcast,
+    "pm": scenario_pm,
+    "list": scenario_list,
+    "file": scenario_file,
+    "churn": scenario_churn,
+}
+
+
+async def run_scenario(name, args, server_pid):
+    stats = Stats()
+    monitor = stats.monitor = ResourceMonitor(server_pid)
+    sampler = asyncio.get_running_loop().create_task(monitor.run())
+    run_id = secrets.token_hex(2)
+    try:
+        extra = await asyncio.wait_for(SCENARIO_FUNCTIONS[name](args, stats, run_id), args.timeout)
+    except asyncio.TimeoutError:
+        extra = {"timed_out": True}
+        stats.errors += 1
+    finally:
+        sampler.cancel()
+    elapsed = extra.get("elapsed_s")
+    result = {
+        "scenario": name,
+        "clients": args.clients,
+        "messages_per_client": args.messages,
+        "sent": stats.sent,
+        "delivered": stats.received,
+        "errors": stats.errors,
+        "msgs_per_s": round(stats.received / elapsed, 1) if elapsed else None,
+        "latency_ms": percentiles(stats.latencies),
+        "handshake_ms": percentiles(stats.handshakes),
+        "login_ms": percentiles(stats.logins),
+        "server": monitor.summary(),
+    }
+    if elapsed is not None:
+        extra["elapsed_s"] = round(elapsed, 3)
+    result.update(extra)
+    return result
+
+
+async def run(args, server_pid):
+    names = SCENARIOS if args.scenario == "all" else (args.scenario,)
+    results = []
+    for name in names:
+        results.append(await run_scenario(name, args, server_pid))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the chat server with scripted TLS clients")
+    parser.add_argument("--scenario", choices=SCENARIOS + ("all",), default="broadcast")
+    parser.add_argument("--clients", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=100,
+                        help="Messages (or /list polls, or churn connections) per client")
+    parser.add_argument("--rate", type=float, default=0.0,
+                        help="Messages per second per client, 0 for as fast as the socket allows")
+    parser.add_argument("--room-size", type=int, default=0,
+                        help="broadcast: split clients into rooms of this many members (0: everyone in the lobby)")
+    parser.add_argument("--message-size", type=int, default=0,
+                        help="Pad chat lines with this many bytes of log-like text")
+    parser.add_argument("--compression", action="store_true",
+                        help="Offer compression at login (the benchmark itself sends uncompressed)")
+    parser.add_argument("--file-size", type=int, default=8 * 1024 * 1024)
+    parser.add_argument("--connect-concurrency", type=int, default=100,
+                        help="TLS handshakes in flight at once while connecting clients")
+    parser.add_argument("--settle", type=float, default=5.0,
+                        help="Give up waiting for outstanding deliveries after this many idle seconds")
+    parser.add_argument("--timeout", type=float, default=300.0, help="Per-scenario time limit")
+    parser.add_argument("--server", help="HOST:PORT of a running server instead of starting one")
+    parser.add_argument("--engine", default="threads", help="Engine for the server this starts")
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes for the server this starts")
+    parser.add_argument("--server-log-level", default="WARNING")
+    parser.add_argument("--server-log", default=os.path.join(tempfile.gettempdir(), "chat_benchmark_server_log.txt"),
+                        help="Log file for the server this starts")
+    parser.add_argument("--server-arg", action="append", default=[],
+                        help="Extra argument for connection_manager.py (repeatable), e.g. --server-arg=--coalesce-ms=1")
+    parser.add_argument("--output", help="Write the JSON report here as well as to stdout")
+    args = parser.parse_args()
+
+    server = None
+    if args.server:
+        args.host, port = args.server.rsplit(":", 1)
+        args.port = int(port)
+    else:
+        server = ServerProcess(args)
+        server.wait_ready()
+        args.host, args.port = "127.0.0.1", server.port
+
+    try:
+        results = asyncio.run(run(args, server.process.pid if server else None))
+    finally:
+        if server:
+            server.stop()
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "server": args.server or {"engine": args.engine, "workers": args.workers,
+                                  "args": args.server_arg},
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
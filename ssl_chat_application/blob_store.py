@@ -0,0 +1,240 @@
+# blob_store.py
+"""Server-side store of uploaded files, keyed by their SHA-256.
+
+A file is uploaded once, whoever sends it and however many recipients it
+has; every delivery then streams from the stored blob. Blobs and uploads
+in progress count towards max_bytes; interrupted uploads and then the least
+recently used blobs are deleted to stay under it.
+
+Layout: <directory>/<sha256> for complete blobs, <sha256>.part while an
+upload is in progress (kept across disconnects, so a retry resumes).
+"""
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from logger_utility import Logger, ERROR
+
+logger = Logger()
+
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+PART_MAX_AGE = 24 * 3600  # seconds an abandoned partial upload is kept
+READ_CHUNK_SIZE = 1024 * 1024
+
+SHA256_HEX = re.compile(r"^[0-9a-f]{64}$")
+
+
+def valid_digest(digest):
+    # Digests double as file names, so nothing but 64 hex digits gets near the file system
+    return isinstance(digest, str) and SHA256_HEX.match(digest) is not None
+
+
+class BlobWriter:
+    """One blob being uploaded into its .part file; hashes as it goes."""
+
+    def __init__(self, path, sha256, size):
+        self.path = path
+        self.sha256 = sha256
+        self.size = size
+        self.hasher = hashlib.sha256()
+        offset = 0
+        if os.path.exists(path) and os.path.getsize(path) <= size:
+            # Resume: hash what an interrupted upload already stored
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(READ_CHUNK_SIZE), b""):
+                    self.hasher.update(block)
+                    offset += len(block)
+        self.offset = offset
+        self.file = open(path, "r+b" if offset else "wb")
+        self.file.seek(offset)
+
+    def write(self, data):
+        if self.offset + len(data) > self.size:
+            raise ValueError(f"upload is larger than the {self.size} bytes offered")
+        self.file.write(data)
+        self.hasher.update(data)
+        self.offset += len(data)
+
+    def close(self):
+        self.file.close()
+
+
+class BlobStore:
+    """Complete blobs plus the space reserved for uploads in progress, kept under max_bytes.
+
+    An upload reserves its full size before it starts and a blob with
+    deliveries pending is pinned, so eviction never deletes a file a
+    recipient is about to be sent and disk use never goes past the limit.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._blobs = OrderedDict()  # sha256 -> size, least recently used first
+        self._parts = OrderedDict()  # sha256 -> bytes reserved (uploading) or on disk (interrupted)
+        self._uploading = set()      # digests of the .part files being written right now
+        self._pins = {}              # sha256 -> deliveries still to be sent from that blob
+        self.total_bytes = 0         # complete blobs
+        self.reserved_bytes = 0      # .part files, counted at their full size while uploading
+        os.makedirs(directory, exist_ok=True)
+
+        # Rebuild the LRU order from modification times, which get() refreshes on every use
+        found = []
+        now = time.time()
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            try:
+                stat = os.stat(path)
+                if name.endswith(".part"):
+                    if now - stat.st_mtime > PART_MAX_AGE or not valid_digest(name[:-len(".part")]):
+                        os.remove(path)
+                    else:
+                        self._parts[name[:-len(".part")]] = stat.st_size
+                        self.reserved_bytes += stat.st_size
+                elif valid_digest(name):
+                    found.append((stat.st_mtime, name, stat.st_size))
+            except OSError:
+                pass
+        for _, name, size in sorted(found):
+            self._blobs[name] = size
+            self.total_bytes += size
+        self._evict()
+
+    def path(self, sha256):
+        return os.path.join(self.directory, sha256)
+
+    def get(self, sha256):
+        """Path of the complete blob, marked as just used, or None."""
+        return self.acquire(sha256, 0)
+
+    def acquire(self, sha256, pins=1):
+        """Like get(), but also pins the blob for pins deliveries; each one calls release() when done."""
+        with self._lock:
+            if sha256 not in self._blobs:
+                return None
+            self._blobs.move_to_end(sha256)
+            path = self.path(sha256)
+            try:
+                os.utime(path)
+            except OSError:
+                # Deleted behind our back
+                self.total_bytes -= self._blobs.pop(sha256)
+                return None
+            if pins:
+                self._pins[sha256] = self._pins.get(sha256, 0) + pins
+        return path
+
+    def release(self, sha256):
+        with self._lock:
+            count = self._pins.get(sha256, 0) - 1
+            if count > 0:
+                self._pins[sha256] = count
+            else:
+                self._pins.pop(sha256, None)
+                self._evict()
+
+    def reserve(self, sha256, size):
+        """Set aside size bytes for an upload of sha256, evicting to make room. Raises ValueError if it cannot fit."""
+        if size > self.max_bytes:
+            raise ValueError(f"larger than the {self.max_bytes} bytes the server stores")
+        with self._lock:
+            if sha256 in self._uploading:
+                raise ValueError("already being uploaded")
+            # Marked first so eviction keeps an interrupted attempt's .part, which this upload resumes
+            self._uploading.add(sha256)
+            existing = self._parts.get(sha256, 0)
+            if not self._evict(size - existing):
+                self._uploading.discard(sha256)
+                raise ValueError("the server's file store is full, try again later")
+            self._parts[sha256] = size
+            self.reserved_bytes += size - existing
+
+    def open_upload(self, sha256, size):
+        """BlobWriter for a reserved upload; its offset is where the sender should (re)start.
+
+        Resuming hashes what is already in the .part file, so call this off the event loop.
+        """
+        path = self.path(sha256) + ".part"
+        try:
+            return BlobWriter(path, sha256, size)
+        except OSError:
+            try:
+                on_disk = os.path.getsize(path)
+            except OSError:
+                on_disk = 0
+            self._end_upload(sha256, on_disk)
+            raise
+
+    def abort(self, writer):
+        """Stop an upload; its .part file stays (counted at its actual size) so a retry resumes."""
+        writer.close()
+        self._end_upload(writer.sha256, writer.offset)
+
+    def _end_upload(self, sha256, size_on_disk):
+        with self._lock:
+            self._uploading.discard(sha256)
+            self.reserved_bytes += size_on_disk - self._parts.pop(sha256, 0)
+            if size_on_disk:
+                self._parts[sha256] = size_on_disk
+
+    def commit(self, writer, pins=0):
+        """Finish an upload and pin the blob for pins deliveries.
+
+        Returns the blob path, or None if the data does not match its hash.
+        """
+        writer.close()
+        valid = writer.offset == writer.size and writer.hasher.hexdigest() == writer.sha256
+        path = self.path(writer.sha256)
+        try:
+            if valid:
+                os.replace(writer.path, path)
+            else:
+                os.remove(writer.path)
+        except OSError as e:
+            logger.log_event(f"[BLOB ERROR] Could not store {writer.sha256}: {e}", ERROR)
+            valid = False
+        with self._lock:
+            self._uploading.discard(writer.sha256)
+            self.reserved_bytes -= self._parts.pop(writer.sha256, 0)
+            if not valid:
+                return None
+            if writer.sha256 not in self._blobs:
+                self.total_bytes += writer.size
+            self._blobs[writer.sha256] = writer.size
+            self._blobs.move_to_end(writer.sha256)
+            if pins:
+                self._pins[writer.sha256] = self._pins.get(writer.sha256, 0) + pins
+        return path
+
+    def _evict(self, needed=0):
+        """Free space until needed more bytes fit. Returns False if they cannot.
+
+        Called with the lock held (or from __init__). Interrupted .part files go first,
+        then the least recently used blobs without deliveries pending.
+        """
+        while self.total_bytes + self.reserved_bytes + needed > self.max_bytes:
+            stale = next((sha for sha in self._parts if sha not in self._uploading), None)
+            if stale is not None:
+                self.reserved_bytes -= self._parts.pop(stale)
+                self._remove(self.path(stale) + ".part")
+                continue
+            victim = next((sha for sha in self._blobs if sha not in self._pins), None)
+            if victim is None:
+                return False
+            self.total_bytes -= self._blobs.pop(victim)
+            self._remove(self.path(victim))
+        return True
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.log_event(f"[BLOB ERROR] Could not evict {path}: {e}", ERROR)
+
+    def __len__(self):
+        return len(self._blobs)
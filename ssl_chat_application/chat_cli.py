@@ -0,0 +1,95 @@
+# chat_cli.py
+"""Headless chat client for terminals, SSH sessions, bots and scripts.
+
+Lines read from stdin are sent as they are (commands included, e.g.
+"/pm bob hi" or "/file bob report.pdf"), received messages are printed to
+stdout, and end of input logs out. With --send the messages are taken from
+the command line instead:
+
+    python chat_cli.py --username bot --send "/join ops" --send "deploy done"
+
+It only imports the standard library and the protocol modules (no Tk), so
+it starts in milliseconds and costs one receiver thread per instance.
+"""
+import sys
+import threading
+import time
+from datetime import datetime
+from client_handler import MessageHandler, Connector
+
+# Seconds to keep printing replies after the last --send message
+DEFAULT_WAIT = 1.0
+
+
+class ChatCLI:
+    def __init__(self, host='127.0.0.1', port=5557, username="Anonymous", timestamps=False, quiet=False,
+                 reconnect=True, compression=True):
+        self.timestamps = timestamps
+        self.quiet = quiet
+        self.print_lock = threading.Lock()
+        # TLS verified against the bundled ca_cert.pem; reconnects resume the TLS session
+        self.connector = Connector(host, port, username, compression=compression)
+        self.handler = MessageHandler(self.connector.connect(), gui_callback=self.display_message,
+                                      connector=self.connector if reconnect else None)
+
+    def display_message(self, message):
+        """Print one received line (called on the receiver thread)."""
+        if self.quiet:
+            return
+        if self.timestamps:
+            message = f"[{datetime.now().strftime('%H:%M:%S')}] {message}"
+        with self.print_lock:
+            print(message, flush=True)
+
+    def send(self, message):
+        self.handler.send_message(message)
+
+    def run(self, lines):
+        """Send every line until the input ends, /quit, or the connection is gone for good."""
+        try:
+            for line in lines:
+                line = line.rstrip("\r\n")
+                if not line.strip():
+                    continue
+                if line.strip() == "/quit":
+                    break
+                if not self.handler.running:
+                    break
+                self.send(line)
+        except KeyboardInterrupt:
+            pass
+        self.handler.quit()
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Terminal chat client (reads messages from stdin)")
+    parser.add_argument("--host", default="127.0.0.1", help="Server host")
+    parser.add_argument("--port", type=int, default=5557, help="Server port")
+    parser.add_argument("--username", default="Anonymous")
+    parser.add_argument("--send", action="append", default=[],
+                        help="Send this message instead of reading stdin (repeatable), then log out")
+    parser.add_argument("--wait", type=float, default=DEFAULT_WAIT,
+                        help="Seconds to keep printing replies after the last --send message")
+    parser.add_argument("--timestamps", action="store_true", help="Prefix received lines with the time")
+    parser.add_argument("--quiet", action="store_true", help="Do not print received messages")
+    parser.add_argument("--no-reconnect", dest="reconnect", action="store_false",
+                        help="Exit when the connection drops instead of reconnecting")
+    parser.add_argument("--no-compression", dest="compression", action="store_false",
+                        help="Do not offer compression at login")
+    args = parser.parse_args()
+
+    try:
+        cli = ChatCLI(host=args.host, port=args.port, username=args.username, timestamps=args.timestamps,
+                      quiet=args.quiet, reconnect=args.reconnect, compression=args.compression)
+    except Exception as e:
+        print(f"[ERROR] Could not connect to {args.host}:{args.port}: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    if args.send:
+        for message in args.send:
+            cli.send(message)
+        time.sleep(args.wait)
+        cli.handler.quit()
+    else:
+        cli.run(sys.stdin)
@@ -1,14 +1,24 @@
-import socket
-import ssl
+import queue
 import tkinter as tk
 from tkinter import simpledialog, scrolledtext, messagebox
-from client_handler import MessageHandler
+from client_handler import MessageHandler, Connector
 from datetime import datetime
 from tkinter import filedialog
-import pyaudio
+
+# Lines kept in the chat window; older ones are trimmed from the top
+DEFAULT_SCROLLBACK = 5000
+# How often the Tk loop drains received messages, and the most it inserts per pass
+POLL_MS = 50
+MAX_BATCH = 2000
+
 
 class ChatGUI:
-    def __init__(self, host='127.0.0.1', port=5557):
+    def __init__(self, host='127.0.0.1', port=5557, scrollback=DEFAULT_SCROLLBACK):
+        # Messages arrive on the receiver thread; only the Tk thread touches widgets
+        self.incoming = queue.SimpleQueue()
+        self.scrollback = scrollback
+        self.drain_job = None
+
         # ---------- Username ----------
         root = tk.Tk()
         root.withdraw()
@@ -86,18 +96,9 @@ class ChatGUI:
 
         # ---------- Connect to Server ----------
         try:
-            # Create raw socket
-            raw_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
-            # Wrap with SSL (same cert you generated)
-            context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
-            context.check_hostname = False
-            context.verify_mode = ssl.CERT_NONE  # skip verification for local test
-            self.client_socket = context.wrap_socket(raw_sock, server_hostname=host)
-
-            # Connect
-            self.client_socket.connect((host, port))
-            self.client_socket.send(self.username.encode('utf-8'))
+            # TLS verified against the bundled ca_cert.pem; reconnects resume the TLS session
+            self.connector = Connector(host, port, self.username)
+            self.client_socket = self.connector.connect()
 
         except Exception as e:
             messagebox.showerror("Connection Error", f"Could not connect to server:\n{e}")
@@ -105,28 +106,54 @@ class ChatGUI:
             return
 
         # ---------- Message Handler ----------
-        self.handler = MessageHandler(self.client_socket, gui_callback=self.display_message)
+        self.handler = MessageHandler(self.client_socket, gui_callback=self.display_message,
+                                      connector=self.connector)
 
         self.window.protocol("WM_DELETE_WINDOW", self.on_close)
 
         # Initial system message
         self.display_message(f"[SYSTEM] Connected securely to {host}:{port} as {self.username}", tag="system")
+        self.drain_job = self.window.after(POLL_MS, self.drain_messages)
 
     # ---------- Display Messages ----------
     def display_message(self, message, tag="other"):
-        self.chat_display.configure(state='normal')
-        timestamp = datetime.now().strftime("%H:%M")
-
+        """Queue a line for the chat window. Safe to call from any thread."""
         if message.startswith("[SYSTEM]"):
             tag = "system"
         elif message.startswith("[PRIVATE]"):
             tag = "private"
         elif message.startswith("[You]"):
             tag = "self"
-
-        self.chat_display.insert(tk.END, f"[{timestamp}] {message}\n", tag)
-        self.chat_display.configure(state='disabled')
-        self.chat_display.yview(tk.END)
+        timestamp = datetime.now().strftime("%H:%M")
+        self.incoming.put((f"[{timestamp}] {message}\n", tag))
+
+    def drain_messages(self):
+        """Insert queued lines in one batch, trim the scrollback, and reschedule (Tk thread)."""
+        chunks = []
+        count = 0
+        while count < MAX_BATCH:
+            try:
+                chunks.extend(self.incoming.get_nowait())
+            except queue.Empty:
+                break
+            count += 1
+
+        if chunks:
+            display = self.chat_display
+            # Only follow new lines if the user has not scrolled up to read history
+            at_bottom = display.yview()[1] >= 0.999
+            display.configure(state='normal')
+            display.insert(tk.END, *chunks)  # text, tag, text, tag, ...
+            # Every line ends in "\n", so the last index is on the empty line after them
+            lines = int(display.index('end-1c').split('.')[0]) - 1
+            if lines > self.scrollback:
+                display.delete('1.0', f"{lines - self.scrollback + 1}.0")
+            display.configure(state='disabled')
+            if at_bottom:
+                display.see(tk.END)
+
+        # Come straight back while there is a backlog, otherwise poll
+        self.drain_job = self.window.after(1 if count == MAX_BATCH else POLL_MS, self.drain_messages)
 
     # ---------- Send Normal Message ----------
     def send_message(self):
@@ -155,23 +182,24 @@ class ChatGUI:
 
 
     def send_file(self):
-        target = simpledialog.askstring("Send File", "Recipient username:")
+        target = simpledialog.askstring("Send File", "Recipient(s) (comma-separated, or #room):")
         if not target:
             return
         file_path = filedialog.askopenfilename(title="Select file to send")
         if not file_path:
             return
         filename = file_path.split("/")[-1]
-        # Send file command to server
-        self.handler.send_message(f"/file {target} {file_path}")
+        # Upload the file to the server (unless it already has it), which sends it to each recipient
+        self.handler.send_file(target, file_path)
         self.display_message(f"[SYSTEM] Sending '{filename}' to {target}", tag="system")
 
     # ---------- Quit ----------
     def on_close(self):
+        if self.drain_job:
+            self.window.after_cancel(self.drain_job)
         try:
             self.handler.send_message("/quit")
             self.handler.stop()
-            self.client_socket.close()
         except:
             pass
         self.window.destroy()
@@ -186,7 +214,9 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--host", default="127.0.0.1", help="Server host")
     parser.add_argument("--port", type=int, default=5557, help="Server port")
+    parser.add_argument("--scrollback", type=int, default=DEFAULT_SCROLLBACK,
+                        help="Lines kept in the chat window")
     args = parser.parse_args()
 
-    app = ChatGUI(host=args.host, port=args.port)
+    app = ChatGUI(host=args.host, port=args.port, scrollback=args.scrollback)
     app.run()
@@ -1,60 +1,473 @@
+import hashlib
+import os
+import socket
 import threading
-from datetime import datetime
+import shutil
+import time
+import zlib
+from file_transfer import UPLOAD_CHUNK_SIZE
+from protocol import (FrameDecoder, encode_frame, encode_hello, encode_text, encode_json, decode_json,
+                      compress_frame, decompress_payload, inflate, StreamCompressor, HEADER, PROTOCOL_VERSION,
+                      TEXT, FILE_START, FILE_DATA, FILE_END, FILE_OFFER, FILE_ACCEPT, FILE_CANCEL, WELCOME,
+                      PING, PONG,
+                      TRANSFER_ID_SIZE, FLAG_COMPRESSED, COMPRESSION_CODECS)
+from tls_config import client_context, SESSIONS
+
+# Delay between reconnect attempts, doubling up to the maximum
+RECONNECT_DELAY = 0.5
+MAX_RECONNECT_DELAY = 30.0
+
+# Seconds of silence from the server before we ping it; as long again without any
+# answer and the connection is considered dead (and re-established)
+HEARTBEAT_INTERVAL = 30.0
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+class Connector:
+    """Opens the TLS connection to one server and logs in, reusing the last TLS session.
+
+    Offering the session from the previous connection turns a reconnect into
+    a resumed handshake instead of a full one.
+    """
+
+    def __init__(self, host, port, username, context=None, sessions=SESSIONS, compression=True):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.context = context or client_context()
+        self.sessions = sessions
+        # Codecs offered at login; the server's WELCOME says which one (if any) is used
+        self.compression = list(COMPRESSION_CODECS) if compression else []
+
+    def connect(self):
+        raw_sock = socket.create_connection((self.host, self.port))
+        try:
+            sock = self.context.wrap_socket(raw_sock, server_hostname=self.host,
+                                            session=self.sessions.get(self.host, self.port, self.context))
+            sock.sendall(encode_hello(self.username, compression=self.compression))
+        except Exception:
+            raw_sock.close()
+            raise
+        return sock
+
+    def remember(self, sock):
+        self.sessions.remember(self.host, self.port, sock)
+
+
+class IncomingFile:
+    """A file being received into '<name>.<id>.part' until its checksum is verified."""
+
+    def __init__(self, transfer_id, sender, filename, size):
+        self.id = transfer_id
+        self.sender = sender
+        self.filename = filename
+        self.size = size
+        self.part_path = f"{filename}.{transfer_id}.part"
+        self.sha256 = hashlib.sha256()
+        self.inflater = None  # for a sender compressing its upload stream
+
+        # Resume: keep whatever an interrupted attempt already wrote
+        offset = 0
+        if os.path.exists(self.part_path) and os.path.getsize(self.part_path) <= size:
+            with open(self.part_path, "rb") as f:
+                for block in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""):
+                    self.sha256.update(block)
+                    offset += len(block)
+        self.offset = offset
+        self.file = open(self.part_path, "r+b" if offset else "wb")
+        self.file.seek(offset)
+
+    def write(self, data, compressed=False):
+        if compressed:
+            if self.inflater is None:
+                self.inflater = zlib.decompressobj()
+            data = inflate(self.inflater, data)
+        self.file.write(data)
+        self.sha256.update(data)
+
+    def finish(self, expected_sha256):
+        """Close the file and move it into place. Returns False if the checksum does not match."""
+        self.file.close()
+        if self.sha256.hexdigest() != expected_sha256:
+            os.remove(self.part_path)
+            return False
+        os.replace(self.part_path, self.filename)
+        return True
+
 
 class MessageHandler:
-    def __init__(self, client_socket, gui_callback=None):
+    def __init__(self, client_socket, gui_callback=None, connector=None, heartbeat=HEARTBEAT_INTERVAL):
         self.client_socket = client_socket
         self.gui_callback = gui_callback
+        # With a connector, a dropped connection is re-established instead of ending the session
+        self.connector = connector
+        self.heartbeat = heartbeat  # None or 0: wait for the server forever
+        client_socket.settimeout(heartbeat or None)
+        self.decoder = FrameDecoder()
+        self.codec = None  # compression the server agreed to in its WELCOME
+        self.send_lock = threading.Lock()  # chat lines and upload chunks share the socket
+        self.uploads = {}    # transfer id -> (path, recipients, sha256)
+        self.downloads = {}  # transfer id -> IncomingFile
+        # transfer id -> token of the FILE_START whose download _prepare_download() is still opening
+        self.preparing = {}
+        self.download_lock = threading.Lock()  # the receive thread and _prepare_download() share both
+        # sha256 -> (path, size, mtime_ns) of files sent or received, so an offer of content
+        # we already hold is answered without downloading it again
+        self.known_files = {}
         self.running = True
-        thread = threading.Thread(target=self.receive_messages)
-        thread.daemon = True
-        thread.start()
+        self.quitting = False  # set by quit(): the server closing the connection is then expected
+        self.thread = threading.Thread(target=self.receive_messages)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def send_frame(self, data):
+        with self.send_lock:
+            self.client_socket.sendall(data)
 
     def send_message(self, message):
+        if message.startswith("/file "):
+            # Format: /file recipient[,recipient...]|#room path
+            parts = message.split(" ", 2)
+            if len(parts) == 3:
+                self.send_file(parts[1], parts[2])
+                return
         try:
-            self.client_socket.send(message.encode('utf-8'))
+            self.send_frame(compress_frame(encode_text(message), self.codec))
         except Exception as e:
             print(f"[ERROR] Failed to send message: {e}")
+
+    def notify(self, message):
+        if self.gui_callback:
+            self.gui_callback(message)
+
+    # ---------------- UPLOAD ----------------
+    def send_file(self, targets, path):
+        """Offer a local file to one or more users (comma-separated) or a '#room'.
+
+        The server stores uploads by content, so the file is hashed first:
+        content it already has is not uploaded again.
+        """
+        try:
+            stat = os.stat(path)
+        except OSError as e:
+            self.notify(f"[SYSTEM] Cannot send '{path}': {e}")
+            return
+        to = targets if targets.startswith("#") else [name for name in targets.split(",") if name]
+        # Hashing a large file takes a while; keep the caller (the Tk thread) responsive
+        thread = threading.Thread(target=self._offer, args=(path, to, stat))
+        thread.daemon = True
+        thread.start()
+
+    def _offer(self, path, to, stat):
+        filename = os.path.basename(path)
+        try:
+            sha256 = file_sha256(path)
+        except OSError as e:
+            self.notify(f"[SYSTEM] Cannot send '{path}': {e}")
+            return
+        self.known_files[sha256] = (path, stat.st_size, stat.st_mtime_ns)
+        # Stable across retries of the same file to the same recipients, so interrupted transfers resume
+        key = f"{to}\0{filename}\0{stat.st_size}\0{stat.st_mtime_ns}"
+        transfer_id = hashlib.sha256(key.encode('utf-8')).hexdigest()[:TRANSFER_ID_SIZE]
+        self.uploads[transfer_id] = (path, to, sha256)
+        try:
+            self.send_frame(encode_json(FILE_OFFER, {"id": transfer_id, "to": to, "name": filename,
+                                                     "size": stat.st_size, "sha256": sha256}))
+        except Exception as e:
+            self.uploads.pop(transfer_id, None)
+            self.notify(f"[SYSTEM] Cannot send '{path}': {e}")
+
+    def _upload(self, transfer_id, offset):
+        path, _, sha256 = self.uploads.get(transfer_id, (None, None, None))
+        if path is None:
+            return
+        # One buffer holds header + transfer id + chunk, so each chunk is read straight into place
+        prefix = HEADER.size + TRANSFER_ID_SIZE
+        buf = bytearray(prefix + UPLOAD_CHUNK_SIZE)
+        view = memoryview(buf)
+        buf[HEADER.size:prefix] = transfer_id.encode('ascii')
+        # The chunks of one upload form a single deflate stream, flushed at the end of each chunk
+        compressor = StreamCompressor(self.codec)
+        try:
+            with open(path, "rb") as f:
+                # The server already holds everything before offset (an interrupted upload)
+                f.seek(offset)
+                while transfer_id in self.uploads:
+                    n = f.readinto(view[prefix:])
+                    if not n:
+                        break
+                    packed = compressor.compress(view[prefix:prefix + n])
+                    if packed is not None:
+                        self.send_frame(encode_frame(FILE_DATA, bytes(buf[HEADER.size:prefix]) + packed,
+                                                     FLAG_COMPRESSED))
+                        continue
+                    HEADER.pack_into(buf, 0, PROTOCOL_VERSION, FILE_DATA, 0, TRANSFER_ID_SIZE + n)
+                    self.send_frame(view[:prefix + n])
+            if self.uploads.pop(transfer_id, None) is not None:
+                self.send_frame(encode_json(FILE_END, {"id": transfer_id, "sha256": sha256}))
+        except Exception as e:
+            self.uploads.pop(transfer_id, None)
+            self.notify(f"[SYSTEM] Upload of '{os.path.basename(path)}' failed: {e}")
+            try:
+                self.send_frame(encode_json(FILE_CANCEL, {"id": transfer_id, "reason": str(e)}))
+            except Exception:
+                pass
+
     def receive_messages(self):
+        session_saved = False
+        pinged = False
         while self.running:
             try:
-                msg = self.client_socket.recv(4096)
-                if not msg:
+                try:
+                    n = self.decoder.recv_from(self.client_socket)
+                except socket.timeout:
+                    if pinged:
+                        raise ConnectionError(f"no answer from the server for {2 * self.heartbeat:.0f}s")
+                    self.send_frame(encode_frame(PING))
+                    pinged = True
+                    continue
+                if not n:
+                    raise ConnectionError("server closed the connection")
+                pinged = False
+                if not session_saved and self.connector:
+                    # TLS 1.3 tickets arrive with the first records after the handshake
+                    self.connector.remember(self.client_socket)
+                    session_saved = True
+                for frame_type, flags, payload in self.decoder.frames():
+                    if flags & FLAG_COMPRESSED and frame_type != FILE_DATA:
+                        payload = decompress_payload(payload)
+                    self.handle_frame(frame_type, flags, payload)
+
+            except Exception as e:
+                if not self.running or self.quitting:
+                    self.running = False
                     break
+                print(f"[DISCONNECTED] {e}")
+                if self.connector is None or not self.reconnect(e):
+                    self.running = False
+                    break
+                session_saved = False
+                pinged = False
 
-                # ---------------- FILE START ----------------
-                if msg.startswith(b"[FILE]"):
-                    # Extract filename
-                    filename = msg[len(b"[FILE]"):].decode('utf-8').strip()
-                    self.current_file_name = filename
-                    self.current_file = open(filename, "wb")
-                    if self.gui_callback:
-                        self.gui_callback(f"[SYSTEM] Receiving file '{filename}'...")
-
-                # ---------------- FILE DATA ----------------
-                elif msg.startswith(b"[FILEDATA]"):
-                    file_data = msg[len(b"[FILEDATA]"):]
-                    if hasattr(self, "current_file") and self.current_file:
-                        self.current_file.write(file_data)
-
-                # ---------------- END OF FILE ----------------
-                elif msg.startswith(b"[ENDFILE]"):
-                    if hasattr(self, "current_file") and self.current_file:
-                        self.current_file.close()
-                        del self.current_file
-                    if self.gui_callback:
-                        self.gui_callback(f"[SYSTEM] File '{self.current_file_name}' received successfully!")
-
-                # ---------------- NORMAL MESSAGES ----------------
-                else:
-                    if self.gui_callback:
-                        self.gui_callback(msg.decode('utf-8'))
+    def reconnect(self, reason):
+        """Re-open the connection, backing off between attempts. Returns False once stopped."""
+        self.notify(f"[SYSTEM] Connection lost ({reason}), reconnecting...")
+        self.connector.remember(self.client_socket)
+        try:
+            self.client_socket.close()
+        except Exception:
+            pass
+        # Transfers do not survive a reconnect; .part files let them resume when re-sent
+        self.uploads.clear()
+        with self.download_lock:
+            self.preparing.clear()
+            downloads, self.downloads = self.downloads, {}
+        for incoming in downloads.values():
+            incoming.file.close()
 
+        delay = RECONNECT_DELAY
+        while self.running:
+            try:
+                sock = self.connector.connect()
             except Exception as e:
-                print(f"[DISCONNECTED] {e}")
-                self.running = False
-                break
+                print(f"[RECONNECT FAILED] {e}")
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+                continue
+            sock.settimeout(self.heartbeat or None)
+            with self.send_lock:
+                self.client_socket = sock
+            self.decoder = FrameDecoder()
+            self.codec = None  # until the new WELCOME
+            resumed = " (TLS session resumed)" if sock.session_reused else ""
+            self.notify(f"[SYSTEM] Reconnected to {self.connector.host}:{self.connector.port}{resumed}")
+            return True
+        return False
+
+    def handle_frame(self, frame_type, flags, payload):
+        # ---------------- LOGIN ----------------
+        if frame_type == WELCOME:
+            codec = decode_json(payload).get("compression")
+            self.codec = codec if codec in COMPRESSION_CODECS else None
+
+        # ---------------- HEARTBEAT ----------------
+        elif frame_type == PING:
+            self.send_frame(encode_frame(PONG, bytes(payload)))
 
+        elif frame_type == PONG:
+            pass  # any frame from the server counts as an answer
+
+        # ---------------- FILE START ----------------
+        elif frame_type == FILE_START:
+            fields = decode_json(payload)
+            # Only keep the base name so a sender cannot pick our path
+            filename = os.path.basename(str(fields.get("name", ""))) or "file"
+            transfer_id = str(fields["id"])
+            token = object()
+            with self.download_lock:
+                stale = self.downloads.pop(transfer_id, None)
+                self.preparing[transfer_id] = token
+            if stale:
+                stale.file.close()
+            # Hashing a local copy, or the .part file of a resumed download, reads the whole file:
+            # keep that off this thread, which would otherwise stop reading chat meanwhile
+            thread = threading.Thread(target=self._prepare_download,
+                                      args=(token, transfer_id, fields.get("from"), filename,
+                                            int(fields.get("size", 0)), fields.get("sha256")))
+            thread.daemon = True
+            thread.start()
+
+        # ---------------- FILE DATA ----------------
+        elif frame_type == FILE_DATA:
+            incoming = self.downloads.get(str(payload[:TRANSFER_ID_SIZE], 'ascii'))
+            if incoming:
+                try:
+                    incoming.write(payload[TRANSFER_ID_SIZE:], flags & FLAG_COMPRESSED)
+                except OSError as e:
+                    del self.downloads[incoming.id]
+                    self.refuse_download(incoming.id, incoming.filename, e, incoming)
+
+        # ---------------- END OF FILE ----------------
+        elif frame_type == FILE_END:
+            fields = decode_json(payload)
+            transfer_id = str(fields.get("id", ""))
+            # For one of our uploads: the server has the content, nothing (more) to send
+            self.uploads.pop(transfer_id, None)
+            incoming = self.downloads.pop(transfer_id, None)
+            if incoming:
+                try:
+                    received = incoming.finish(fields.get("sha256"))
+                except OSError as e:
+                    self.notify(f"[SYSTEM] Could not save '{incoming.filename}': {e}")
+                    return
+                if received:
+                    self.remember_file(fields["sha256"], incoming.filename)
+                    self.notify(f"[SYSTEM] File '{incoming.filename}' received successfully!")
+                else:
+                    self.notify(f"[SYSTEM] File '{incoming.filename}' was corrupted in transit (checksum mismatch).")
+
+        # ---------------- UPLOAD CONTROL ----------------
+        elif frame_type == FILE_ACCEPT:
+            fields = decode_json(payload)
+            thread = threading.Thread(target=self._upload, args=(str(fields.get("id", "")), int(fields.get("offset", 0))))
+            thread.daemon = True
+            thread.start()
+
+        elif frame_type == FILE_CANCEL:
+            transfer_id = str(decode_json(payload).get("id", ""))
+            self.uploads.pop(transfer_id, None)
+            with self.download_lock:
+                self.preparing.pop(transfer_id, None)
+                incoming = self.downloads.pop(transfer_id, None)
+            if incoming:
+                # Keep the .part file so the next attempt resumes from here
+                incoming.file.close()
+
+        # ---------------- NORMAL MESSAGES ----------------
+        elif frame_type == TEXT:
+            self.notify(str(payload, 'utf-8'))
+
+
+    def _prepare_download(self, token, transfer_id, sender, filename, size, sha256):
+        """Answer a FILE_START: FILE_END if we already have the content, else open the download and FILE_ACCEPT it."""
+        incoming = None
+        try:
+            if not self.have_file(sha256, filename, size):
+                incoming = IncomingFile(transfer_id, sender, filename, size)
+        except OSError as e:
+            with self.download_lock:
+                current = self.preparing.pop(transfer_id, None) is token
+            if current:
+                try:
+                    self.refuse_download(transfer_id, filename, e)
+                except Exception:
+                    pass
+            return
+        with self.download_lock:
+            current = self.preparing.get(transfer_id) is token
+            if current:
+                del self.preparing[transfer_id]
+                if incoming:
+                    self.downloads[transfer_id] = incoming
+        if not current:
+            # Cancelled, restarted or the connection dropped meanwhile; a .part file stays for the next attempt
+            if incoming:
+                incoming.file.close()
+            return
+        try:
+            if incoming is None:
+                # Same content already here: tell the server to skip the download
+                self.send_frame(encode_json(FILE_END, {"id": transfer_id, "sha256": sha256}))
+                self.notify(f"[SYSTEM] Already have '{filename}' from {sender}, not downloading it again.")
+                return
+            if incoming.offset:
+                self.notify(f"[SYSTEM] Resuming '{filename}' from {sender} at byte {incoming.offset}...")
+            else:
+                self.notify(f"[SYSTEM] Receiving file '{filename}' from {sender}...")
+            self.send_frame(encode_json(FILE_ACCEPT, {"id": transfer_id, "offset": incoming.offset}))
+        except Exception:
+            pass  # the connection dropped: the receive thread reconnects, and the sender offers again
+
+    def refuse_download(self, transfer_id, filename, error, incoming=None):
+        """A download failed on our side (disk full, no permission...): the connection is fine, so only it stops."""
+        if incoming:
+            try:
+                incoming.file.close()
+            except OSError:
+                pass
+        self.send_frame(encode_json(FILE_CANCEL, {"id": transfer_id, "reason": f"could not save it: {error}"}))
+        self.notify(f"[SYSTEM] Could not save '{filename}': {error}")
+
+    # ---------------- LOCAL COPIES ----------------
+    def remember_file(self, sha256, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return
+        self.known_files[sha256] = (path, stat.st_size, stat.st_mtime_ns)
+
+    def have_file(self, sha256, filename, size):
+        """True if content sha256 is (now) at filename: already there, or copied from a known file."""
+        if not isinstance(sha256, str):
+            return False
+        try:
+            if os.path.getsize(filename) == size and file_sha256(filename) == sha256:
+                self.remember_file(sha256, filename)
+                return True
+        except OSError:
+            pass
+        known = self.known_files.get(sha256)
+        if known is None:
+            return False
+        path, known_size, mtime_ns = known
+        try:
+            stat = os.stat(path)
+            if (stat.st_size, stat.st_mtime_ns) != (known_size, mtime_ns):
+                # Changed since we saw it
+                del self.known_files[sha256]
+                return False
+            if os.path.abspath(path) != os.path.abspath(filename):
+                shutil.copyfile(path, filename)
+        except OSError:
+            return False
+        return True
+
+    def quit(self, timeout=2.0):
+        """Send /quit and wait up to timeout for the server's goodbye before closing."""
+        self.quitting = True
+        try:
+            self.send_frame(encode_text("/quit"))
+            self.thread.join(timeout)
+        except Exception:
+            pass
+        self.stop()
 
     def stop(self):
         self.running = False
@@ -0,0 +1,128 @@
+# client_registry.py
+from metrics import TimedLock, REGISTRY_LOCK_WAIT
+from rooms import RoomIndex, LOBBY
+
+
+class ClientRegistry:
+    """Two-way index of connected clients: connection <-> username.
+
+    Every lookup, login and logout is a constant-time dict operation done
+    under the registry's own short-lived lock. Readers that need the whole
+    population (broadcast, /list) get an immutable snapshot that is rebuilt
+    only after the membership has changed, so they never hold the lock
+    while iterating.
+
+    Room membership lives in self.rooms: clients enter the lobby when they
+    register and leave whatever room they are in when they unregister.
+    """
+
+    # True if register() may wait on something slower than the lock (the asyncio engine then runs it in an executor)
+    register_blocks = False
+
+    def __init__(self):
+        self._lock = TimedLock(REGISTRY_LOCK_WAIT)
+        self._names = {}        # connection -> username
+        self._connections = {}  # username -> connection
+        self._next_suffix = {}  # requested name -> lowest "_N" suffix that may be free (all below are taken)
+        self._usernames_snapshot = ()
+        self._connections_snapshot = ()
+        self._dirty = False
+        self.rooms = RoomIndex()
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, conn):
+        return conn in self._names
+
+    def register(self, conn, username):
+        """Store conn under a unique username and return the name actually assigned."""
+        with self._lock:
+            assigned = self._unique_name(username)
+            self._add(conn, assigned)
+        return assigned
+
+    def _unique_name(self, username):
+        # Called with the lock held
+        if username not in self._connections:
+            return username
+        # Skip the suffixes known to be taken; unregister() lowers the hint when one frees up
+        i = self._next_suffix.get(username, 1)
+        while f"{username}_{i}" in self._connections:
+            i += 1
+        self._next_suffix[username] = i + 1
+        return f"{username}_{i}"
+
+    def _add(self, conn, username):
+        # Called with the lock held
+        self._names[conn] = username
+        self._connections[username] = conn
+        self._dirty = True
+        self.rooms.join(conn, LOBBY)
+
+    def unregister(self, conn):
+        """Remove conn. Returns its username, or None if it was not registered."""
+        with self._lock:
+            username = self._names.pop(conn, None)
+            if username is not None:
+                del self._connections[username]
+                self._dirty = True
+                self.rooms.leave(conn)
+                self._free_suffix(username)
+        return username
+
+    def _free_suffix(self, username):
+        # Called with the lock held: let the next duplicate login reuse this name's suffix
+        base, _, suffix = username.rpartition("_")
+        if not suffix.isdigit() or base not in self._next_suffix:
+            return
+        i = int(suffix)
+        if i == 1:
+            del self._next_suffix[base]  # everything is free again from the start
+        elif i < self._next_suffix[base]:
+            self._next_suffix[base] = i
+
+    def get_username(self, conn, default=None):
+        return self._names.get(conn, default)
+
+    def get_connection(self, username):
+        return self._connections.get(username)
+
+    def _refresh(self):
+        # Called with the lock held
+        if self._dirty:
+            self._usernames_snapshot = tuple(self._connections)
+            self._connections_snapshot = tuple(self._names)
+            self._dirty = False
+
+    def usernames(self):
+        """Immutable snapshot of every username, in login order."""
+        if self._dirty:
+            with self._lock:
+                self._refresh()
+        return self._usernames_snapshot
+
+    def connections(self):
+        """Immutable snapshot of every connection, in login order."""
+        if self._dirty:
+            with self._lock:
+                self._refresh()
+        return self._connections_snapshot
+
+    def publish(self, frame, room, record=False):
+        """Hand a frame for room to clients outside this registry (record: keep it in history).
+
+        A single-process server has none; ClusterRegistry forwards it to the
+        other worker processes.
+        """
+
+    def clear(self):
+        """Forget every client and return their connections."""
+        with self._lock:
+            connections = list(self._names)
+            self._names.clear()
+            self._connections.clear()
+            self._next_suffix.clear()
+            self._dirty = True
+            self.rooms.clear()
+        return connections
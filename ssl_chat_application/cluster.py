@@ -0,0 +1,381 @@
+# cluster.py
+"""Multi-process mode.
+
+N worker processes each run a normal Server on the same port (SO_REUSEPORT
+lets the kernel spread new connections across them). The parent process
+runs a BusHub on a Unix domain socket; workers use it to keep usernames
+unique, share presence for /list, and route broadcasts and private
+messages to users connected to another worker.
+"""
+import itertools
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import struct
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from client_registry import ClientRegistry
+from logger_utility import Logger, ERROR, configure_logging, settings as log_settings
+from outbound_queue import coalesce
+from protocol import FrameDecoder, encode_frame, read_frame, compress_frame
+
+logger = Logger()
+
+# ---------------- BUS MESSAGES ----------------
+WORKER = 1     # worker -> hub {"worker"}: first message on a new bus connection
+CLAIM = 2      # worker -> hub {"req", "name"}: reserve a cluster-wide unique username
+CLAIMED = 3    # hub -> worker {"req", "name"}: the name actually assigned
+RELEASE = 4    # worker -> hub {"name"}
+JOINED = 5     # hub -> every worker {"name", "worker"}
+LEFT = 6       # hub -> every worker {"name"}
+BROADCAST = 7  # worker -> hub -> other workers {"room", "record"}, body: encoded client frame
+DIRECT = 8     # worker -> hub -> owning worker {"to"}, body: encoded client frame
+
+META_LENGTH = struct.Struct("!I")
+CLAIM_TIMEOUT = 5.0
+
+
+def encode_bus(kind, fields, body=b""):
+    """A bus message is a protocol frame whose payload is JSON fields followed by an opaque body."""
+    meta = json.dumps(fields).encode('utf-8')
+    return encode_frame(kind, META_LENGTH.pack(len(meta)) + meta + body)
+
+
+def decode_bus(payload):
+    (length,) = META_LENGTH.unpack_from(payload)
+    end = META_LENGTH.size + length
+    return json.loads(str(payload[META_LENGTH.size:end], 'utf-8')), payload[end:]
+
+
+# ---------------- HUB (parent process) ----------------
+class BusHub:
+    def __init__(self, path):
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen()
+        self.lock = threading.Lock()
+        self.workers = {}  # worker id -> (socket, send lock)
+        # Cluster-wide names; a "connection" here is the (worker id, request id) that claimed it
+        self.names = ClientRegistry()
+
+    def serve_forever(self):
+        while True:
+            conn, _ = self.sock.accept()
+            thread = threading.Thread(target=self.handle_worker, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def send(self, worker_id, data):
+        target = self.workers.get(worker_id)
+        if target is None:
+            return
+        sock, send_lock = target
+        try:
+            with send_lock:
+                sock.sendall(data)
+        except OSError as e:
+            logger.log_event(f"[BUS ERROR] worker {worker_id}: {e}", ERROR)
+
+    def send_all(self, data, exclude=None):
+        for worker_id in list(self.workers):
+            if worker_id != exclude:
+                self.send(worker_id, data)
+
+    def handle_worker(self, conn):
+        decoder = FrameDecoder()
+        frame = read_frame(conn, decoder)
+        if frame is None or frame[0] != WORKER:
+            conn.close()
+            return
+        worker_id = decode_bus(frame[2])[0]["worker"]
+        with self.lock:
+            self.workers[worker_id] = (conn, threading.Lock())
+        # Bring the new worker up to date with everyone already online
+        for token in self.names.connections():
+            self.send(worker_id, encode_bus(JOINED, {"name": self.names.get_username(token), "worker": token[0]}))
+
+        try:
+            while True:
+                frame = read_frame(conn, decoder)
+                if frame is None:
+                    break
+                self.handle_message(worker_id, frame, decoder)
+        except Exception as e:
+            logger.log_event(f"[BUS ERROR] worker {worker_id}: {e}", ERROR)
+        finally:
+            with self.lock:
+                self.workers.pop(worker_id, None)
+            for token in self.names.connections():
+                if token[0] == worker_id:
+                    name = self.names.unregister(token)
+                    self.send_all(encode_bus(LEFT, {"name": name}))
+            conn.close()
+
+    def handle_message(self, worker_id, frame, decoder):
+        kind, _, payload = frame
+        fields, body = decode_bus(payload)
+        if kind == CLAIM:
+            name = self.names.register((worker_id, fields["req"]), fields["name"])
+            # JOINED first, so the claimer knows the name is online before its login completes
+            self.send_all(encode_bus(JOINED, {"name": name, "worker": worker_id}))
+            self.send(worker_id, encode_bus(CLAIMED, {"req": fields["req"], "name": name}))
+        elif kind == RELEASE:
+            token = self.names.get_connection(fields["name"])
+            if token is not None and token[0] == worker_id:
+                self.names.unregister(token)
+                self.send_all(encode_bus(LEFT, {"name": fields["name"]}))
+        elif kind == BROADCAST:
+            # Forward the bus message verbatim to every other worker
+            self.send_all(bytes(decoder.last_frame()), exclude=worker_id)
+        elif kind == DIRECT:
+            token = self.names.get_connection(fields["to"])
+            if token is not None:
+                self.send(token[0], bytes(decoder.last_frame()))
+
+    def close(self):
+        self.sock.close()
+
+
+# ---------------- WORKER SIDE ----------------
+class RemoteConnection:
+    """Stands in for a client connected to another worker; sends go over the bus."""
+
+    remote = True
+    codec = None  # frames cross the bus uncompressed; the owning worker compresses them for its client
+
+    def __init__(self, username, bus):
+        self.username = username
+        self.bus = bus
+
+    def send(self, data, system=True, force=False):
+        self.bus.direct(self.username, data)
+        return len(data)
+
+    def sendall(self, data):
+        self.send(data)
+
+
+class BusClient:
+    def __init__(self, path, worker_id, history=None):
+        self.worker_id = worker_id
+        self.history = history  # every worker keeps the whole cluster's room history
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        # send() only queues; the bus writer thread does the blocking writes, so callers
+        # on the asyncio loop never wait on the hub
+        self.outbox = deque()
+        self.outbox_ready = threading.Condition()
+        self.requests = itertools.count()
+        self.pending = {}  # request id -> Future for CLAIM replies
+        self.owners = {}   # every username in the cluster -> worker id
+        self.owners_lock = threading.Lock()
+        self.usernames_snapshot = ()
+        self.registry = None  # set by ClusterRegistry
+        self.connected = True
+        self.send(encode_bus(WORKER, {"worker": worker_id}))
+
+        for target in (self._read_loop, self._write_loop):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def send(self, data):
+        with self.outbox_ready:
+            if not self.connected:
+                return
+            self.outbox.append(data)
+            self.outbox_ready.notify()
+
+    def _write_loop(self):
+        while True:
+            with self.outbox_ready:
+                while not self.outbox and self.connected:
+                    self.outbox_ready.wait()
+                if not self.connected:
+                    return
+                batch = list(self.outbox)
+                self.outbox.clear()
+            try:
+                for data in coalesce(batch):
+                    self.sock.sendall(data)
+            except OSError as e:
+                # The read loop notices the hub is gone and stops the worker
+                logger.log_event(f"[BUS ERROR] {e}", ERROR)
+                return
+
+    def claim(self, username):
+        """Ask the hub for a cluster-wide unique name (blocks for one round trip)."""
+        req = next(self.requests)
+        future = self.pending[req] = Future()
+        self.send(encode_bus(CLAIM, {"req": req, "name": username}))
+        try:
+            return future.result(CLAIM_TIMEOUT)
+        except FutureTimeout:
+            if not future.cancel():
+                return future.result()  # answered just now
+            raise
+        finally:
+            # A reply that comes after this finds no request and gives the name straight back
+            self.pending.pop(req, None)
+
+    def release(self, username):
+        self.send(encode_bus(RELEASE, {"name": username}))
+
+    def broadcast(self, frame, room, record=False):
+        self.send(encode_bus(BROADCAST, {"room": room, "record": record}, frame))
+
+    def direct(self, username, frame):
+        self.send(encode_bus(DIRECT, {"to": username}, frame))
+
+    def usernames(self):
+        """Immutable snapshot of every username in the cluster."""
+        return self.usernames_snapshot
+
+    def _read_loop(self):
+        decoder = FrameDecoder()
+        try:
+            while True:
+                frame = read_frame(self.sock, decoder)
+                if frame is None:
+                    break
+                self.handle_message(*frame)
+        except Exception as e:
+            logger.log_event(f"[BUS ERROR] {e}", ERROR)
+        with self.outbox_ready:
+            self.connected = False
+            self.outbox.clear()
+            self.outbox_ready.notify()
+        # The hub is the parent process; without it this worker is orphaned, so shut down
+        logger.log_event(f"[BUS DISCONNECTED] Stopping worker {self.worker_id}", ERROR)
+        os.kill(os.getpid(), signal.SIGINT)
+
+    def handle_message(self, kind, flags, payload):
+        fields, body = decode_bus(payload)
+        if kind == CLAIMED:
+            future = self.pending.get(fields["req"])
+            if future is not None and future.set_running_or_notify_cancel():
+                future.set_result(fields["name"])
+            else:
+                # The claim timed out and that login failed: the hub must not keep the name taken
+                self.release(fields["name"])
+        elif kind == JOINED:
+            with self.owners_lock:
+                self.owners[fields["name"]] = fields["worker"]
+                self.usernames_snapshot = tuple(self.owners)
+        elif kind == LEFT:
+            with self.owners_lock:
+                self.owners.pop(fields["name"], None)
+                self.usernames_snapshot = tuple(self.owners)
+        elif kind == BROADCAST:
+            # One copy out of the bus buffer (compressed at most once per codec), shared by every local recipient
+            frame = bytes(body)
+            variants = {}
+            for conn in self.registry.rooms.members(fields["room"]):
+                conn.send(compress_frame(frame, conn.codec, variants), system=False)
+            if fields.get("record") and self.history:
+                self.history.append(fields["room"], frame)
+        elif kind == DIRECT:
+            conn = self.registry.get_local_connection(fields["to"])
+            if conn is not None:
+                conn.send(compress_frame(bytes(body), conn.codec))
+
+
+class ClusterRegistry(ClientRegistry):
+    """ClientRegistry for one worker: local connections are indexed as usual,
+    names and presence are cluster-wide through the bus."""
+
+    register_blocks = True  # one bus round trip, up to CLAIM_TIMEOUT
+
+    def __init__(self, bus):
+        super().__init__()
+        self.bus = bus
+        bus.registry = self
+
+    def register(self, conn, username):
+        # Claim outside the lock so a bus round trip never holds up other logins
+        assigned = self.bus.claim(username)
+        with self._lock:
+            self._add(conn, assigned)
+        return assigned
+
+    def unregister(self, conn):
+        username = super().unregister(conn)
+        if username is not None:
+            self.bus.release(username)
+        return username
+
+    def get_local_connection(self, username):
+        return self._connections.get(username)
+
+    def get_connection(self, username):
+        conn = self._connections.get(username)
+        if conn is None and username in self.bus.owners:
+            conn = RemoteConnection(username, self.bus)
+        return conn
+
+    def usernames(self):
+        return self.bus.usernames()
+
+    def publish(self, frame, room, record=False):
+        self.bus.broadcast(frame, room, record)
+
+    def clear(self):
+        connections = [(conn, self.get_username(conn)) for conn in self.connections()]
+        super().clear()
+        for _, username in connections:
+            self.bus.release(username)
+        return [conn for conn, _ in connections]
+
+
+# ---------------- PROCESS MANAGEMENT ----------------
+def worker_log_file(log_file, worker_id):
+    root, ext = os.path.splitext(log_file)
+    return f"{root}.worker{worker_id}{ext}"
+
+
+def run_worker(worker_id, bus_path, server_kwargs, parent_log_settings):
+    # Each worker logs (and rotates) its own file; processes never share a log writer
+    configure_logging(**dict(parent_log_settings,
+                             log_file=worker_log_file(parent_log_settings["log_file"], worker_id)))
+    from connection_manager import Server
+    server = Server(**server_kwargs, reuse_port=True, bus_path=bus_path, worker_id=worker_id)
+    try:
+        server.start()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+def run_cluster(workers, server_kwargs):
+    """Start workers sharing server_kwargs["port"] and run the bus hub until interrupted."""
+    bus_dir = tempfile.mkdtemp(prefix="chat-bus-")
+    bus_path = os.path.join(bus_dir, "bus.sock")
+    hub = BusHub(bus_path)
+
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(target=run_worker, args=(i, bus_path, server_kwargs, dict(log_settings)),
+                        name=f"chat-worker-{i}", daemon=True)
+        for i in range(1, workers + 1)
+    ]
+    for process in processes:
+        process.start()
+    # Stop the workers on SIGTERM as well as Ctrl+C
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    logger.log_event(f"[CLUSTER STARTED] {workers} workers on "
+                     f"{server_kwargs.get('host')}:{server_kwargs.get('port')}, bus at {bus_path}")
+    try:
+        hub.serve_forever()
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join(timeout=5)
+        hub.close()
+        shutil.rmtree(bus_dir, ignore_errors=True)
+        logger.log_event("[CLUSTER STOPPED]")
@@ -1,80 +1,272 @@
+import os
+import select
 import socket
-import threading
 import ssl
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from message_handler import handle_client
-from logger_utility import Logger
+from client_registry import ClientRegistry
+from file_transfer import TransferTable, DELIVERY_WORKERS
+from blob_store import BlobStore, DEFAULT_MAX_BYTES as DEFAULT_BLOB_BYTES
+from logger_utility import Logger, WARNING, ERROR, LEVELS, MODES, ROTATIONS, FORMATS, configure_logging
+from outbound_queue import ClientConnection, POLICIES, DROP_OLDEST, DEFAULT_MAX_MESSAGES
+from protocol import (FrameDecoder, ProtocolError, decode_hello, encode_json, negotiate_compression,
+                      HELLO, WELCOME, MAX_PAYLOAD, LOGIN_MAX_PAYLOAD)
+from metrics import metrics, serve_metrics, CONNECTIONS, HANDSHAKE_FAILURES, HANDSHAKE_TIME
+from history import HistoryStore, DEFAULT_RING_SIZE
+from timer_wheel import TimerWheel
+from rate_limit import DEFAULT_LIMITS, DEFAULT_DISCONNECT_AFTER, parse_limit
+from tls_config import server_context, DEFAULT_CIPHERS, DEFAULT_SESSION_TICKETS, TLS_VERSIONS
 
 logger = Logger()
 
+ENGINES = ("threads", "asyncio")
+
+# Handshake stage defaults
+HANDSHAKE_WORKERS = 32       # threads doing TLS handshakes + username login
+MAX_PENDING_HANDSHAKES = 256  # accepted sockets allowed to wait for / sit in the handshake stage
+HANDSHAKE_TIMEOUT = 10.0     # seconds for the TLS handshake
+LOGIN_TIMEOUT = 10.0         # seconds for the HELLO frame after the handshake
+# Both are deadlines for the whole stage, not per read, so a client dripping bytes cannot stretch them
+
+# Heartbeats: a client silent for IDLE_TIMEOUT seconds is pinged and dropped if it
+# still has not sent anything LIVENESS_TIMEOUT seconds later (half-open connections)
+IDLE_TIMEOUT = 60.0
+LIVENESS_TIMEOUT = 30.0
+
 class Server:
-    def __init__(self, host='127.0.0.1', port=5557):
+    def __init__(self, host='127.0.0.1', port=5557, engine="threads",
+                 max_queue=DEFAULT_MAX_MESSAGES, slow_consumer_policy=DROP_OLDEST, coalesce_ms=0.0,
+                 handshake_workers=HANDSHAKE_WORKERS, max_pending_handshakes=MAX_PENDING_HANDSHAKES,
+                 handshake_timeout=HANDSHAKE_TIMEOUT, login_timeout=LOGIN_TIMEOUT,
+                 reuse_port=False, bus_path=None, worker_id=None, admins=(), metrics_port=None,
+                 ciphers=DEFAULT_CIPHERS, ecdh_curve=None, min_tls="1.2",
+                 session_tickets=DEFAULT_SESSION_TICKETS,
+                 history_dir=None, history_ring=DEFAULT_RING_SIZE, history_replay=0, compression=True,
+                 idle_timeout=IDLE_TIMEOUT, liveness_timeout=LIVENESS_TIMEOUT,
+                 blob_dir="chat_blobs", blob_max_bytes=DEFAULT_BLOB_BYTES,
+                 rate_limits=DEFAULT_LIMITS, rate_disconnect=DEFAULT_DISCONNECT_AFTER):
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine '{engine}', expected one of {ENGINES}")
         self.host = host
         self.port = port
+        self.engine = engine
+        # Per-client outbound queue size and what to do once a client falls that far behind
+        self.max_queue = max_queue
+        self.slow_consumer_policy = slow_consumer_policy
+        # Optional window for packing several queued frames into one TLS write
+        self.coalesce_delay = coalesce_ms / 1000.0
+        # Handshake stage: accept() only hands sockets over, TLS + login happen in a pool
+        self.handshake_workers = handshake_workers
+        self.max_pending_handshakes = max_pending_handshakes
+        self.handshake_timeout = handshake_timeout
+        self.login_timeout = login_timeout
+        # One timer wheel tracks every logged-in client's heartbeat deadline (idle_timeout 0: off)
+        self.idle_timeout = idle_timeout
+        self.liveness_timeout = liveness_timeout
+        self.timers = TimerWheel()
+        # Token buckets per client and kind of traffic (None: unlimited); reads pause while a client is over
+        self.rate_limits = rate_limits
+        self.rate_disconnect = rate_disconnect
+        self.handshake_slots = threading.BoundedSemaphore(max_pending_handshakes)
+        self.handshake_pool = None
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            # Several worker processes listen on the same port; the kernel spreads new connections
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.worker_id = worker_id
+
+        # SSL context setup: one context for the whole process, so its session cache and
+        # ticket keys let returning clients resume instead of doing a full handshake
+        self.context = server_context(ciphers=ciphers, ecdh_curve=ecdh_curve, min_version=min_tls,
+                                      session_tickets=session_tickets)
+
+        # Room history: recent messages in memory, everything in segment files if history_dir is set
+        if history_dir and worker_id is not None:
+            history_dir = os.path.join(history_dir, f"worker{worker_id}")
+        self.history = HistoryStore(history_dir, ring_size=history_ring)
+        self.history_replay = history_replay  # messages replayed on login and /join (0: off)
+        self.compression = compression  # False: never agree to compress, whatever clients offer
+
+        if bus_path:
+            # Worker of a cluster: names, presence and broadcasts are shared over the bus
+            from cluster import BusClient, ClusterRegistry
+            self.registry = ClusterRegistry(BusClient(bus_path, worker_id, self.history))
+        else:
+            self.registry = ClientRegistry()  # connection <-> username
+        self.transfers = TransferTable()  # file uploads and deliveries in progress
+        # Uploaded files by content hash; every recipient is streamed from the one stored copy
+        if worker_id is not None:
+            blob_dir = os.path.join(blob_dir, f"worker{worker_id}")
+        self.blobs = BlobStore(blob_dir, blob_max_bytes)
+        self.deliveries_pool = ThreadPoolExecutor(max_workers=DELIVERY_WORKERS, thread_name_prefix="delivery")
 
-        # SSL context setup
-        self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-        self.context.load_cert_chain(certfile="server.crt", keyfile="server.key")
+        # Usernames allowed to run /stats, and an optional local port serving metrics as text
+        self.admins = frozenset(admins)
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+        metrics.gauge("chat_clients_connected", "Clients logged in to this process", lambda: len(self.registry))
+        metrics.gauge("chat_tls_sessions_resumed", "Handshakes that resumed a TLS session",
+                      lambda: self.context.session_stats()["hits"])
+        metrics.gauge("chat_tls_handshakes_completed", "Server-side TLS handshakes completed",
+                      lambda: self.context.session_stats()["accept_good"])
+        metrics.gauge("chat_file_store_bytes", "Bytes of uploaded files kept in the blob store",
+                      lambda: self.blobs.total_bytes)
 
-        self.clients = {}  # key: socket, value: username
-        self.clients_lock = threading.Lock()
+    def register_client(self, conn, hello):
+        """Store conn under a unique username, settle compression and send the WELCOME.
+
+        Returns the username actually assigned.
+        """
+        if self.compression:
+            conn.codec = negotiate_compression(hello.get("compression"))
+        username = self.registry.register(conn, hello["username"])
+        # Always the first frame a client gets, so it knows its name and codec before any message
+        conn.send(encode_json(WELCOME, {"username": username, "compression": conn.codec}), force=True)
+        CONNECTIONS.inc()
+        return username
+
+    @staticmethod
+    def parse_hello(frame):
+        """Return the fields of a login frame (username stripped), or None if it is not a valid HELLO."""
+        if frame is None:
+            return None
+        frame_type, _, payload = frame
+        if frame_type != HELLO:
+            raise ProtocolError(f"Expected HELLO, got frame type {frame_type}")
+        hello = decode_hello(payload)
+        hello["username"] = str(hello.get("username", "")).strip()
+        return hello if hello["username"] else None
+
+    def read_hello(self, conn, decoder, deadline):
+        """Wait for the HELLO until deadline (time.monotonic()). Returns what parse_hello() does."""
+        while True:
+            frame = decoder.next_frame()
+            if frame is not None:
+                return self.parse_hello(frame)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout("login timed out")
+            conn.settimeout(remaining)
+            if not decoder.recv_from(conn):
+                return None
+
+    @staticmethod
+    def tls_handshake(conn, deadline):
+        """do_handshake() on a non-blocking socket, given up at deadline (time.monotonic())."""
+        conn.setblocking(False)
+        while True:
+            try:
+                conn.do_handshake()
+                return
+            except ssl.SSLWantReadError:
+                wait = ([conn], [])
+            except ssl.SSLWantWriteError:
+                wait = ([], [conn])
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not any(select.select(*wait, [], remaining)):
+                raise socket.timeout("TLS handshake timed out")
 
     def start(self):
         self.server_socket.bind((self.host, self.port))
         self.server_socket.listen()
-        logger.log_event(f"[SECURE SERVER STARTED] Listening on {self.host}:{self.port}")
+        if self.metrics_port:
+            # Workers of a cluster each get their own port: metrics_port, metrics_port + 1, ...
+            port = self.metrics_port + (self.worker_id - 1 if self.worker_id else 0)
+            self.metrics_server = serve_metrics("127.0.0.1", port)
+            logger.log_event(f"[METRICS] Serving on http://127.0.0.1:{port}/")
+
+        if self.engine == "asyncio":
+            from async_engine import AsyncEngine
+            AsyncEngine(self).run()
+            return
+
+        worker = f" (worker {self.worker_id})" if self.worker_id is not None else ""
+        logger.log_event(f"[SECURE SERVER STARTED] Listening on {self.host}:{self.port}{worker}")
+        self.handshake_pool = ThreadPoolExecutor(max_workers=self.handshake_workers,
+                                                 thread_name_prefix="handshake")
 
         while True:
             try:
                 conn, addr = self.server_socket.accept()
+            except OSError as e:
+                if self.server_socket.fileno() == -1:
+                    break  # closed by stop()
+                logger.log_event(f"[ERROR] {e}", ERROR)
+                continue
+
+            # Shed load instead of queueing unbounded work during a reconnect storm
+            if not self.handshake_slots.acquire(blocking=False):
+                logger.log_event(f"[HANDSHAKE REJECTED] {addr}: {self.max_pending_handshakes} handshakes pending",
+                                 WARNING, addr=addr)
+                HANDSHAKE_FAILURES.inc()
+                conn.close()
+                continue
+            self.handshake_pool.submit(self.handshake, conn, addr)
+
+    def handshake(self, conn, addr):
+        """TLS handshake + username login for one accepted socket (runs in the handshake pool)."""
+        secure_conn = conn
+        try:
+            # Wrap socket for SSL
+            start = time.perf_counter()
+            handshake_deadline = time.monotonic() + self.handshake_timeout
+            secure_conn = self.context.wrap_socket(conn, server_side=True, do_handshake_on_connect=False)
+            self.tls_handshake(secure_conn, handshake_deadline)
+            elapsed = time.perf_counter() - start
+            HANDSHAKE_TIME.observe(elapsed)
+            logger.log_event(f"[SECURE CONNECTION] TLS handshake successful with {addr}", addr=addr,
+                             latency_ms=round(elapsed * 1000, 3))
+
+            # First frame from client is the HELLO carrying its username
+            decoder = FrameDecoder(max_payload=LOGIN_MAX_PAYLOAD)
+            hello = self.read_hello(secure_conn, decoder, handshake_deadline + self.login_timeout)
+            if not hello:
+                HANDSHAKE_FAILURES.inc()
+                secure_conn.close()
+                return
+            secure_conn.settimeout(None)
+            decoder.max_payload = MAX_PAYLOAD
+
+            # From here on all writes go through the client's queue and writer thread
+            client = ClientConnection(secure_conn, self.max_queue, self.slow_consumer_policy,
+                                      self.coalesce_delay)
+            username = self.register_client(client, hello)
+            logger.log_event(f"[NEW CONNECTION] {username} ({addr})", user=username, addr=addr)
 
-                # Wrap socket for SSL
-                secure_conn = self.context.wrap_socket(conn, server_side=True)
-                logger.log_event(f"[SECURE CONNECTION] TLS handshake successful with {addr}")
-
-                # First message from client is username
-                username = secure_conn.recv(1024).decode('utf-8').strip()
-                if not username:
-                    secure_conn.close()
-                    continue
-
-                with self.clients_lock:
-                    # Avoid duplicate usernames
-                    existing_usernames = set(self.clients.values())
-                    original_name = username
-                    i = 1
-                    while username in existing_usernames:
-                        username = f"{original_name}_{i}"
-                        i += 1
-                    self.clients[secure_conn] = username
-
-                logger.log_event(f"[NEW CONNECTION] {username} ({addr})")
-
-                # Start thread for this client
-                thread = threading.Thread(
-                    target=handle_client,
-                    args=(secure_conn, addr, self.clients, self.clients_lock)
-                )
-                thread.daemon = True
-                thread.start()
-
-            except Exception as e:
-                logger.log_event(f"[ERROR] {e}")
+            # MessageHandler starts its own reader thread for this client
+            handle_client(client, addr, self, decoder)
+
+        except Exception as e:
+            HANDSHAKE_FAILURES.inc()
+            logger.log_event(f"[HANDSHAKE ERROR] {addr}: {e}", WARNING, addr=addr)
+            try:
+                secure_conn.close()
+            except:
+                pass
+        finally:
+            self.handshake_slots.release()
 
     def stop(self):
         logger.log_event("[STOPPING SERVER...]")
-        with self.clients_lock:
-            for conn in list(self.clients.keys()):
-                try:
-                    conn.close()
-                except:
-                    pass
-            self.clients.clear()
+        self.timers.stop()
+        for conn in self.registry.clear():
+            try:
+                conn.close()
+            except:
+                pass
         try:
             self.server_socket.close()
         except:
             pass
+        if self.handshake_pool:
+            self.handshake_pool.shutdown(wait=False, cancel_futures=True)
+        self.deliveries_pool.shutdown(wait=False, cancel_futures=True)
+        if self.metrics_server:
+            self.metrics_server.shutdown()
+        self.history.close()
         logger.log_event("[SERVER STOPPED]")
 
 
@@ -83,9 +275,89 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--host", default="127.0.0.1", help="Host to bind (use 0.0.0.0 for public)")
     parser.add_argument("--port", type=int, default=5557)
+    parser.add_argument("--engine", choices=ENGINES, default="threads",
+                        help="threads: one reader thread per client, asyncio: single event loop")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Worker processes sharing the port (SO_REUSEPORT), linked by a local bus")
+    parser.add_argument("--queue-size", type=int, default=DEFAULT_MAX_MESSAGES,
+                        help="Outbound messages buffered per client before the slow-consumer policy applies")
+    parser.add_argument("--slow-policy", choices=POLICIES, default=DROP_OLDEST,
+                        help="What to do when a client's outbound queue is full")
+    parser.add_argument("--coalesce-ms", type=float, default=0.0,
+                        help="Wait this long after a client's first queued frame so more can share its TLS write")
+    parser.add_argument("--handshake-workers", type=int, default=HANDSHAKE_WORKERS,
+                        help="Threads doing TLS handshakes and logins (threads engine)")
+    parser.add_argument("--max-handshakes", type=int, default=MAX_PENDING_HANDSHAKES,
+                        help="Connections allowed in the handshake stage before new ones are refused")
+    parser.add_argument("--handshake-timeout", type=float, default=HANDSHAKE_TIMEOUT)
+    parser.add_argument("--login-timeout", type=float, default=LOGIN_TIMEOUT)
+    parser.add_argument("--ciphers", default=DEFAULT_CIPHERS, help="OpenSSL cipher string for TLS 1.2")
+    parser.add_argument("--ecdh-curve", help="Pin the key exchange group, e.g. prime256v1 (default: OpenSSL's choice)")
+    parser.add_argument("--min-tls", choices=TLS_VERSIONS, default="1.2",
+                        help="Oldest TLS version accepted; 1.3 refuses TLS 1.2 clients")
+    parser.add_argument("--session-tickets", type=int, default=DEFAULT_SESSION_TICKETS,
+                        help="TLS 1.3 session tickets issued per handshake, 0 to disable tickets")
+    parser.add_argument("--history-dir", default="chat_history",
+                        help="Directory for room history segments ('' keeps history in memory only)")
+    parser.add_argument("--history-ring", type=int, default=DEFAULT_RING_SIZE,
+                        help="Recent messages per room kept in memory")
+    parser.add_argument("--history-replay", type=int, default=0,
+                        help="Messages replayed to a client when it logs in or joins a room")
+    parser.add_argument("--blob-dir", default="chat_blobs", help="Directory of the uploaded file store")
+    parser.add_argument("--blob-max-mb", type=float, default=DEFAULT_BLOB_BYTES / 2 ** 20,
+                        help="Size of the file store; least recently used files are deleted beyond it")
+    parser.add_argument("--idle-timeout", type=float, default=IDLE_TIMEOUT,
+                        help="Seconds of client silence before it is pinged (0 disables heartbeats)")
+    parser.add_argument("--liveness-timeout", type=float, default=LIVENESS_TIMEOUT,
+                        help="Seconds a pinged client has to answer before it is disconnected")
+    parser.add_argument("--rate-limit", type=parse_limit, action="append", default=[],
+                        metavar="KIND:MSGS_PER_S:BURST:BYTES_PER_S:BYTE_BURST",
+                        help="Per-client limit for chat, pm or file traffic, 0 meaning unlimited "
+                             "(repeatable; default chat and pm 20/s, 64 KiB/s, file 10 offers/s)")
+    parser.add_argument("--no-rate-limit", dest="rate_limited", action="store_false",
+                        help="Do not rate limit clients")
+    parser.add_argument("--rate-disconnect", type=float, default=DEFAULT_DISCONNECT_AFTER,
+                        help="Disconnect a client kept over its rate limit for this many seconds "
+                             "(default 0: never, it is only throttled)")
+    parser.add_argument("--no-compression", dest="compression", action="store_false",
+                        help="Refuse to negotiate compression with clients")
+    parser.add_argument("--admin", action="append", default=[],
+                        help="Username allowed to run /stats (repeatable)")
+    parser.add_argument("--metrics-port", type=int,
+                        help="Serve metrics as plain text on 127.0.0.1:PORT (one port per worker)")
+    parser.add_argument("--log-level", choices=LEVELS, help="Defaults to $CHAT_LOG_LEVEL or DEBUG")
+    parser.add_argument("--log-mode", choices=MODES,
+                        help="background: buffered writes from a logger thread (default $CHAT_LOG_MODE or sync)")
+    parser.add_argument("--log-rotate", choices=ROTATIONS, help="Defaults to $CHAT_LOG_ROTATE or none")
+    parser.add_argument("--log-format", choices=FORMATS,
+                        help="json: one typed record per line, for log_query.py (default $CHAT_LOG_FORMAT or text)")
     args = parser.parse_args()
 
-    chat_server = Server(host=args.host, port=args.port)
+    configure_logging(level=args.log_level, mode=args.log_mode, rotate=args.log_rotate, format=args.log_format)
+
+    server_kwargs = dict(host=args.host, port=args.port, engine=args.engine,
+                         max_queue=args.queue_size, slow_consumer_policy=args.slow_policy,
+                         coalesce_ms=args.coalesce_ms,
+                         handshake_workers=args.handshake_workers, max_pending_handshakes=args.max_handshakes,
+                         handshake_timeout=args.handshake_timeout, login_timeout=args.login_timeout,
+                         admins=args.admin, metrics_port=args.metrics_port,
+                         ciphers=args.ciphers, ecdh_curve=args.ecdh_curve, min_tls=args.min_tls,
+                         session_tickets=args.session_tickets,
+                         history_dir=args.history_dir, history_ring=args.history_ring,
+                         history_replay=args.history_replay, compression=args.compression,
+                         idle_timeout=args.idle_timeout, liveness_timeout=args.liveness_timeout,
+                         blob_dir=args.blob_dir, blob_max_bytes=int(args.blob_max_mb * 2 ** 20),
+                         rate_limits=dict(DEFAULT_LIMITS, **dict(args.rate_limit)) if args.rate_limited else None,
+                         rate_disconnect=args.rate_disconnect)
+    if args.workers > 1:
+        from cluster import run_cluster
+        try:
+            run_cluster(args.workers, server_kwargs)
+        except KeyboardInterrupt:
+            pass
+        raise SystemExit
+
+    chat_server = Server(**server_kwargs)
     try:
         chat_server.start()
     except KeyboardInterrupt:
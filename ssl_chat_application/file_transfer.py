@@ -0,0 +1,145 @@
+# file_transfer.py
+import threading
+import time
+
+# File data allowed to sit in one recipient's outbound queue before the
+# server stops reading the blob for it (bounded buffering / backpressure)
+RELAY_WINDOW = 2 * 1024 * 1024
+
+# Size of the FILE_DATA chunks clients upload and the server sends
+UPLOAD_CHUNK_SIZE = 256 * 1024
+
+# Threads streaming stored blobs to recipients and preparing uploads. A delivery only
+# holds one while its recipient's queue has room, so a stalled recipient costs none
+DELIVERY_WORKERS = 16
+
+
+class Upload:
+    """One file coming from its sender into the blob store."""
+
+    __slots__ = ("id", "sender", "sender_name", "name", "size", "sha256", "writer", "inflater", "deliveries")
+
+    def __init__(self, transfer_id, sender, sender_name, name, size, sha256, writer):
+        self.id = transfer_id
+        self.sender = sender
+        self.sender_name = sender_name
+        self.name = name
+        self.size = size
+        self.sha256 = sha256
+        self.writer = writer  # BlobWriter, None until prepared off the event loop
+        # Inflates the sender's compressed stream before it is stored
+        self.inflater = None
+        self.deliveries = []  # waiting for this upload to complete
+
+
+class Delivery:
+    """One stored (or still uploading) file on its way to one recipient."""
+
+    __slots__ = ("id", "sender", "sender_name", "recipient", "recipient_name", "name", "size", "sha256",
+                 "offset", "accepted", "path", "cancelled", "blobs", "position", "compressor", "started")
+
+    def __init__(self, transfer_id, sender, sender_name, recipient, recipient_name, name, size, sha256):
+        self.id = transfer_id
+        self.sender = sender
+        self.sender_name = sender_name
+        self.recipient = recipient
+        self.recipient_name = recipient_name
+        self.name = name
+        self.size = size
+        self.sha256 = sha256
+        self.offset = 0         # from the recipient's FILE_ACCEPT (resume)
+        self.accepted = False
+        self.path = None        # blob path, once the content is on the server
+        self.cancelled = False  # checked by the delivery steps between chunks
+        self.blobs = None       # BlobStore holding a pin on the blob for this delivery
+        # Kept between the steps that send the blob (deliver_file)
+        self.position = None
+        self.compressor = None
+        self.started = None  # set by the one caller of TransferTable.claim_start() that wins
+
+
+class TransferTable:
+    """Uploads keyed by (sender, transfer id), deliveries by (recipient, transfer id)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Held while an offer decides between stored blob, upload in progress and new upload,
+        # and whenever an upload's writer is set or taken (it is opened in the delivery pool)
+        self.offer_lock = threading.RLock()
+        self._uploads = {}
+        self._by_digest = {}  # sha256 -> Upload, so a second sender of the same file waits for the first
+        self._deliveries = {}
+
+    def add_upload(self, upload):
+        with self._lock:
+            self._uploads[(upload.sender, upload.id)] = upload
+            self._by_digest[upload.sha256] = upload
+
+    def get_upload(self, sender, transfer_id):
+        return self._uploads.get((sender, transfer_id))
+
+    def upload_of(self, sha256):
+        return self._by_digest.get(sha256)
+
+    def remove_upload(self, upload):
+        with self._lock:
+            self._uploads.pop((upload.sender, upload.id), None)
+            if self._by_digest.get(upload.sha256) is upload:
+                del self._by_digest[upload.sha256]
+
+    def add_delivery(self, delivery):
+        with self._lock:
+            previous = self._deliveries.get((delivery.recipient, delivery.id))
+            self._deliveries[(delivery.recipient, delivery.id)] = delivery
+            if previous:
+                self._cancel(previous)
+        return previous
+
+    def attach_blob(self, delivery, blobs, path):
+        """Give delivery the blob it was pinned in blobs for; unpins it at once if the delivery is already off."""
+        with self._lock:
+            if not delivery.cancelled:
+                delivery.path = path
+                delivery.blobs = blobs
+                return True
+        blobs.release(delivery.sha256)
+        return False
+
+    def claim_start(self, delivery):
+        """True for exactly one caller, once delivery is accepted and has its blob: that caller sends it."""
+        with self._lock:
+            if delivery.cancelled or not delivery.accepted or delivery.path is None or delivery.started:
+                return False
+            delivery.started = time.perf_counter()
+            return True
+
+    def get_delivery(self, recipient, transfer_id):
+        return self._deliveries.get((recipient, transfer_id))
+
+    def remove_delivery(self, delivery):
+        with self._lock:
+            if self._deliveries.get((delivery.recipient, delivery.id)) is delivery:
+                del self._deliveries[(delivery.recipient, delivery.id)]
+            self._cancel(delivery)
+
+    def remove_connection(self, conn):
+        """Forget conn's uploads and the deliveries to it; returns (uploads, deliveries)."""
+        with self._lock:
+            uploads = [u for key, u in self._uploads.items() if key[0] is conn]
+            for upload in uploads:
+                del self._uploads[(conn, upload.id)]
+                if self._by_digest.get(upload.sha256) is upload:
+                    del self._by_digest[upload.sha256]
+            deliveries = [d for key, d in self._deliveries.items() if key[0] is conn]
+            for delivery in deliveries:
+                del self._deliveries[(conn, delivery.id)]
+                self._cancel(delivery)
+        return uploads, deliveries
+
+    @staticmethod
+    def _cancel(delivery):
+        # Called with the lock held; the blob may be evicted once nothing is left to send from it
+        delivery.cancelled = True
+        blobs, delivery.blobs = delivery.blobs, None
+        if blobs is not None:
+            blobs.release(delivery.sha256)
@@ -0,0 +1,264 @@
+# history.py
+"""Chat history per room, in two tiers.
+
+Recent messages sit in an in-memory ring buffer. With a directory
+configured, every message is also appended to the room's current segment
+file; each segment has a sparse index (one entry per INDEX_INTERVAL records)
+mapping sequence number and timestamp to a file offset.
+
+Messages are stored as the exact frame that was broadcast, so replaying
+them means handing those bytes to the client's queue: from the ring as is,
+from disk as memoryview slices of a memory-mapped segment (no parsing and
+no per-message copy). The index turns "last N" and "since T" into a bisect
+plus a short forward scan instead of reading the whole file.
+
+Layout: <directory>/<room>/<first seq:020d>.seg and .idx
+"""
+import mmap
+import os
+import struct
+import threading
+import time
+from bisect import bisect_right
+from collections import deque
+from logger_utility import Logger, ERROR
+
+logger = Logger()
+
+RECORD = struct.Struct("!QdI")       # seq, timestamp, frame length; followed by the frame
+INDEX_ENTRY = struct.Struct("!QdQ")  # seq, timestamp, offset of the record in its segment
+
+DEFAULT_RING_SIZE = 200
+DEFAULT_SEGMENT_BYTES = 64 * 1024 * 1024
+DEFAULT_MAX_SEGMENTS = 16  # per room; the oldest segment is deleted beyond this
+INDEX_INTERVAL = 64
+MAX_HISTORY = 5000         # most messages one request may replay
+
+
+class Segment:
+    """One append-only file of records plus its sparse index."""
+
+    def __init__(self, path, base_seq):
+        self.path = path
+        self.index_path = path[:-len(".seg")] + ".idx"
+        self.base_seq = base_seq
+        self.seqs = []     # sparse index, parallel lists for bisect
+        self.times = []
+        self.offsets = []
+        self.size = 0
+        self.last_seq = base_seq - 1
+        self.last_time = 0.0
+        self.file = None   # append handle while this is the active segment
+        self.index_file = None
+
+    def load(self):
+        """Read the index and scan the tail past its last entry (dropping a torn last record)."""
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "rb") as f:
+                data = f.read()
+            for pos in range(0, len(data) - len(data) % INDEX_ENTRY.size, INDEX_ENTRY.size):
+                seq, ts, offset = INDEX_ENTRY.unpack_from(data, pos)
+                self.seqs.append(seq)
+                self.times.append(ts)
+                self.offsets.append(offset)
+        file_size = os.path.getsize(self.path)
+        offset = self.offsets[-1] if self.offsets else 0
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            while offset + RECORD.size <= file_size:
+                seq, ts, length = RECORD.unpack(f.read(RECORD.size))
+                if offset + RECORD.size + length > file_size:
+                    break
+                f.seek(length, os.SEEK_CUR)
+                self.last_seq, self.last_time = seq, ts
+                offset += RECORD.size + length
+        self.size = offset
+        if offset < file_size:
+            os.truncate(self.path, offset)
+
+    def open_for_append(self):
+        self.file = open(self.path, "ab")
+        self.index_file = open(self.index_path, "ab")
+
+    def append(self, seq, ts, frame):
+        if (seq - self.base_seq) % INDEX_INTERVAL == 0:
+            self.seqs.append(seq)
+            self.times.append(ts)
+            self.offsets.append(self.size)
+            self.index_file.write(INDEX_ENTRY.pack(seq, ts, self.size))
+            self.index_file.flush()
+        self.file.write(RECORD.pack(seq, ts, len(frame)))
+        self.file.write(frame)
+        self.file.flush()
+        self.size += RECORD.size + len(frame)
+        self.last_seq, self.last_time = seq, ts
+
+    def close(self):
+        for f in (self.file, self.index_file):
+            if f:
+                f.close()
+        self.file = self.index_file = None
+
+    def read(self, size, first_seq=None, since=None):
+        """Yield memoryviews of the frames in the first size bytes from first_seq and/or time since on."""
+        if not size:
+            return
+        # Jump to the last indexed record at or before the start (the later of the two), then scan forward
+        i = -1
+        if first_seq is not None:
+            i = bisect_right(self.seqs, first_seq) - 1
+        if since is not None:
+            i = max(i, bisect_right(self.times, since) - 1)
+        offset = self.offsets[i] if i >= 0 else 0
+        with open(self.path, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        # The views keep the mapping alive for as long as they sit in a client's queue
+        view = memoryview(mapped)
+        while offset + RECORD.size <= size:
+            seq, ts, length = RECORD.unpack_from(mapped, offset)
+            start = offset + RECORD.size
+            offset = start + length
+            if (first_seq is None or seq >= first_seq) and (since is None or ts >= since):
+                yield view[start:offset]
+
+
+class RoomLog:
+    """The segment files of one room."""
+
+    def __init__(self, directory, segment_bytes, max_segments):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        self.segments = []
+        # The directory is created with the first segment, so reading an unused room leaves nothing behind
+        names = sorted(os.listdir(directory)) if os.path.isdir(directory) else ()
+        for name in names:
+            if name.endswith(".seg"):
+                segment = Segment(os.path.join(directory, name), int(name[:-len(".seg")]))
+                segment.load()
+                self.segments.append(segment)
+        if self.segments:
+            self.segments[-1].open_for_append()
+
+    @property
+    def next_seq(self):
+        return self.segments[-1].last_seq + 1 if self.segments else 0
+
+    def append(self, seq, ts, frame):
+        if not self.segments or self.segments[-1].size >= self.segment_bytes:
+            self._roll(seq)
+        self.segments[-1].append(seq, ts, frame)
+
+    def _roll(self, seq):
+        if self.segments:
+            self.segments[-1].close()
+        os.makedirs(self.directory, exist_ok=True)
+        segment = Segment(os.path.join(self.directory, f"{seq:020d}.seg"), seq)
+        segment.open_for_append()
+        self.segments.append(segment)
+        while len(self.segments) > self.max_segments:
+            old = self.segments.pop(0)
+            for path in (old.path, old.index_path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def snapshot(self):
+        """(segment, size) pairs to read from; records past each size may still be half written."""
+        return [(segment, segment.size) for segment in self.segments]
+
+    def close(self):
+        if self.segments:
+            self.segments[-1].close()
+
+
+class RoomHistory:
+    def __init__(self, log, ring_size):
+        self.lock = threading.Lock()
+        self.log = log
+        self.ring = deque(maxlen=ring_size)  # (seq, timestamp, frame)
+        self.next_seq = log.next_seq if log else 0
+
+    def append(self, frame):
+        now = time.time()
+        with self.lock:
+            seq = self.next_seq
+            self.next_seq += 1
+            self.ring.append((seq, now, frame))
+            if self.log:
+                try:
+                    self.log.append(seq, now, frame)
+                except OSError as e:
+                    logger.log_event(f"[HISTORY ERROR] {e}", ERROR)
+
+    def last(self, count):
+        with self.lock:
+            first_seq = max(self.next_seq - count, 0)
+            ring = list(self.ring)
+            segments = self.log.snapshot() if self.log else ()
+        if not segments or (ring and ring[0][0] <= first_seq):
+            return [frame for seq, _, frame in ring if seq >= first_seq]
+        # Older than the ring holds: serve the whole range from the mapped segments
+        frames = []
+        for segment, size in segments:
+            if segment.last_seq >= first_seq:
+                frames.extend(segment.read(size, first_seq=first_seq))
+        return frames[-count:]
+
+    def since(self, timestamp, limit):
+        with self.lock:
+            # Only the last limit messages can be returned, so nothing before first_seq is read
+            first_seq = max(self.next_seq - limit, 0)
+            ring = list(self.ring)
+            segments = self.log.snapshot() if self.log else ()
+        if not segments or (ring and (ring[0][1] <= timestamp or ring[0][0] <= first_seq)):
+            return [frame for seq, ts, frame in ring if ts >= timestamp and seq >= first_seq]
+        frames = []
+        for segment, size in segments:
+            if segment.last_time >= timestamp and segment.last_seq >= first_seq:
+                frames.extend(segment.read(size, first_seq=first_seq, since=timestamp))
+        return frames
+
+
+class HistoryStore:
+    """Every room's history; rooms are opened (and their segments indexed) on first use."""
+
+    def __init__(self, directory=None, ring_size=DEFAULT_RING_SIZE, segment_bytes=DEFAULT_SEGMENT_BYTES,
+                 max_segments=DEFAULT_MAX_SEGMENTS):
+        self.directory = directory
+        self.ring_size = ring_size
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        self._lock = threading.Lock()
+        self._rooms = {}
+
+    def room(self, name):
+        history = self._rooms.get(name)
+        if history is None:
+            with self._lock:
+                history = self._rooms.get(name)
+                if history is None:
+                    log = None
+                    if self.directory:
+                        log = RoomLog(os.path.join(self.directory, name), self.segment_bytes, self.max_segments)
+                    history = self._rooms[name] = RoomHistory(log, self.ring_size)
+        return history
+
+    def append(self, room, frame):
+        self.room(room).append(frame)
+
+    def last(self, room, count):
+        """Frames of the last count messages in room, oldest first."""
+        return self.room(room).last(min(count, MAX_HISTORY))
+
+    def since(self, room, timestamp):
+        """Frames of room's messages from timestamp on (at most MAX_HISTORY), oldest first."""
+        return self.room(room).since(timestamp, MAX_HISTORY)
+
+    def close(self):
+        with self._lock:
+            for history in self._rooms.values():
+                if history.log:
+                    with history.lock:
+                        history.log.close()
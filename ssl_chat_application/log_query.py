@@ -0,0 +1,289 @@
+# log_query.py
+"""Offline queries over the server log and its rotated segments.
+
+The first run indexes every segment (server_log.txt, server_log.txt.1 ...,
+server_log.txt.2025-10-11, and the server_log.workerN.txt files of a
+cluster) into a SQLite file next to the log. That file records time,
+type, user, room, address, bytes and latency per event, plus where the
+line is. Later runs only index what was appended since, following
+segments through rotation by inode. Queries and aggregates are answered
+from the index; the raw files are only read to print matching lines.
+
+Logs written with --log-format json have every field. Text lines only
+yield their time and type.
+
+    python log_query.py events --user bob --since 2h
+    python log_query.py count --type message --by user --by hour
+    python log_query.py disconnect-rate --by day
+"""
+import glob
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+from datetime import datetime
+from logger_utility import settings, event_type
+
+TEXT_LINE = re.compile(r"^\[(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)\] (.*)$")
+RELATIVE_TIME = re.compile(r"^(\d+(?:\.\d+)?)([smhd])$")
+UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+HEAD_SIZE = 4096  # bytes of a segment's start that identify it along with its inode
+BATCH_SIZE = 5000
+
+# --by name -> SQL expression over the events table
+GROUPS = {
+    "user": "user",
+    "type": "type",
+    "room": "room",
+    "level": "level",
+    "addr": "addr",
+    "minute": "strftime('%Y-%m-%d %H:%M', ts, 'unixepoch', 'localtime')",
+    "hour": "strftime('%Y-%m-%d %H:00', ts, 'unixepoch', 'localtime')",
+    "day": "strftime('%Y-%m-%d', ts, 'unixepoch', 'localtime')",
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS segments (
+    id INTEGER PRIMARY KEY, path TEXT, dev INTEGER, ino INTEGER, head TEXT, indexed INTEGER);
+CREATE TABLE IF NOT EXISTS events (
+    segment INTEGER, offset INTEGER, ts REAL, type TEXT, level TEXT,
+    user TEXT, room TEXT, addr TEXT, bytes INTEGER, latency_ms REAL);
+CREATE INDEX IF NOT EXISTS events_ts ON events (ts);
+CREATE INDEX IF NOT EXISTS events_user_ts ON events (user, ts);
+CREATE INDEX IF NOT EXISTS events_type_ts ON events (type, ts);
+"""
+
+
+def find_segments(log_file, index_path):
+    """The live log, its rotated backups and, for a cluster, every worker's log and backups."""
+    root, ext = os.path.splitext(log_file)
+    index_path = os.path.abspath(index_path)
+    paths = []
+    for base in [log_file] + sorted(glob.glob(f"{glob.escape(root)}.worker*{glob.escape(ext)}")):
+        for path in [base] + sorted(glob.glob(glob.escape(base) + ".*")):
+            if os.path.isfile(path) and not os.path.abspath(path).startswith(index_path):
+                paths.append(path)
+    return paths
+
+
+def parse_line(line):
+    """Index fields of one log line: (ts, type, level, user, room, addr, bytes, latency_ms), or None."""
+    if line.startswith("{"):
+        try:
+            record = json.loads(line)
+            return (float(record["ts"]), record.get("type"), record.get("level"), record.get("user"),
+                    record.get("room"), record.get("addr"), record.get("bytes"), record.get("latency_ms"))
+        except (ValueError, KeyError, TypeError):
+            return None
+    match = TEXT_LINE.match(line)
+    if match is None:
+        return None  # continuation of a multi-line message
+    ts = time.mktime(time.strptime(match.group(1), "%Y-%m-%d %H:%M:%S"))
+    return ts, event_type(match.group(2)), None, None, None, None, None, None
+
+
+class LogIndex:
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def update(self, segment_paths):
+        """Index whatever the segments gained since the last run. Returns the number of new events."""
+        known = {(dev, ino, head): (seg_id, path, indexed) for seg_id, path, dev, ino, head, indexed
+                 in self.db.execute("SELECT id, path, dev, ino, head, indexed FROM segments")}
+        seen = set()
+        added = 0
+        for path in segment_paths:
+            try:
+                stat = os.stat(path)
+                with open(path, "rb") as f:
+                    head = hashlib.sha1(f.read(HEAD_SIZE).split(b"\n", 1)[0]).hexdigest()
+            except OSError:
+                continue
+            if stat.st_size == 0:
+                continue
+            key = (stat.st_dev, stat.st_ino, head)
+            if key in known:
+                seg_id, old_path, indexed = known[key]
+                if old_path != path:
+                    # Renamed by rotation: same file, same offsets
+                    self.db.execute("UPDATE segments SET path = ? WHERE id = ?", (path, seg_id))
+                if stat.st_size < indexed:
+                    self.db.execute("DELETE FROM events WHERE segment = ?", (seg_id,))
+                    indexed = 0
+            else:
+                seg_id = self.db.execute("INSERT INTO segments (path, dev, ino, head, indexed) VALUES (?, ?, ?, ?, 0)",
+                                         (path, stat.st_dev, stat.st_ino, head)).lastrowid
+                indexed = 0
+            seen.add(seg_id)
+            if stat.st_size > indexed:
+                added += self._index_segment(seg_id, path, indexed)
+
+        # Segments rotated out of existence
+        for seg_id, _, _ in known.values():
+            if seg_id not in seen:
+                self.db.execute("DELETE FROM events WHERE segment = ?", (seg_id,))
+                self.db.execute("DELETE FROM segments WHERE id = ?", (seg_id,))
+        self.db.commit()
+        return added
+
+    def _index_segment(self, seg_id, path, offset):
+        rows = []
+        added = 0
+        with open(path, "rb") as f:
+            f.seek(offset)
+            for raw in f:
+                if not raw.endswith(b"\n"):
+                    break  # still being written; picked up next time
+                fields = parse_line(raw.decode("utf-8", "replace"))
+                if fields is not None:
+                    rows.append((seg_id, offset) + fields)
+                offset += len(raw)
+                if len(rows) >= BATCH_SIZE:
+                    added += self._insert(rows)
+                    rows = []
+        added += self._insert(rows)
+        self.db.execute("UPDATE segments SET indexed = ? WHERE id = ?", (offset, seg_id))
+        return added
+
+    def _insert(self, rows):
+        self.db.executemany("INSERT INTO events VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        return len(rows)
+
+    def events(self, where, params, limit=None):
+        """(path, offset) of every matching event, oldest first."""
+        sql = (f"SELECT s.path, e.offset FROM events e JOIN segments s ON s.id = e.segment"
+               f"{where} ORDER BY e.ts, e.segment, e.offset")
+        if limit:
+            sql += f" LIMIT {int(limit)}"
+        return self.db.execute(sql, params)
+
+    def aggregate(self, groups, where, params):
+        columns = [GROUPS[g] for g in groups]
+        select = ", ".join(columns + ["COUNT(*)", "SUM(bytes)", "AVG(latency_ms)"])
+        group_by = f" GROUP BY {', '.join(columns)} ORDER BY {', '.join(columns)}" if columns else ""
+        return self.db.execute(f"SELECT {select} FROM events e{where}{group_by}", params)
+
+    def stats(self):
+        return self.db.execute("SELECT (SELECT COUNT(*) FROM segments), COUNT(*), MIN(ts), MAX(ts) FROM events").fetchone()
+
+
+def parse_time(value):
+    """'2025-10-11', '2025-10-11 23:14[:08]' or relative to now ('90m', '2h', '7d') -> epoch seconds."""
+    match = RELATIVE_TIME.match(value)
+    if match:
+        return time.time() - float(match.group(1)) * UNITS[match.group(2)]
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise ValueError(f"unrecognised time '{value}'")
+
+
+def build_filter(args):
+    clauses, params = [], []
+    if args.since:
+        clauses.append("e.ts >= ?")
+        params.append(parse_time(args.since))
+    if args.until:
+        clauses.append("e.ts < ?")
+        params.append(parse_time(args.until))
+    for column, values in (("user", args.user), ("type", args.type), ("room", args.room)):
+        if values:
+            clauses.append(f"e.{column} IN ({', '.join('?' * len(values))})")
+            params.extend(values)
+    return (" WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+
+def print_lines(locations):
+    """Stream the raw log lines at (path, offset), keeping each segment open while it is being read."""
+    files = {}
+    try:
+        for path, offset in locations:
+            f = files.get(path)
+            if f is None:
+                f = files[path] = open(path, "rb")
+            f.seek(offset)
+            sys.stdout.write(f.readline().decode("utf-8", "replace"))
+    finally:
+        for f in files.values():
+            f.close()
+
+
+def print_table(header, rows):
+    print("\t".join(header))
+    for row in rows:
+        print("\t".join("" if value is None else f"{value:.3f}" if isinstance(value, float) else str(value)
+                        for value in row))
+
+
+def disconnect_rate(index, groups, where, params):
+    """Connections and disconnections per group, and disconnections per connection."""
+    where = where.replace(" WHERE ", " AND ", 1) if where else ""
+    columns = [GROUPS[g] for g in groups] or ["'all'"]
+    sql = (f"SELECT {', '.join(columns)}, SUM(type = 'connected'), SUM(type = 'disconnected') FROM events e "
+           f"WHERE type IN ('connected', 'disconnected'){where} "
+           f"GROUP BY {', '.join(columns)} ORDER BY {', '.join(columns)}")
+    for row in index.db.execute(sql, params):
+        *keys, connects, disconnects = row
+        yield tuple(keys) + (connects, disconnects, disconnects / connects if connects else None)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Query the chat server log through a time/user index")
+    parser.add_argument("--log", default=settings["log_file"],
+                        help="Live log file; its rotated segments and worker logs are found next to it")
+    parser.add_argument("--index", help="Index file (default: <log name>.index.sqlite next to the log)")
+    parser.add_argument("--no-update", dest="update", action="store_false",
+                        help="Answer from the index as it is, without indexing new log lines first")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    def add_filters(command):
+        command.add_argument("--since", help="Start time: '2025-10-11 23:00' or relative, e.g. 90m, 2h, 7d")
+        command.add_argument("--until", help="End time (exclusive), same formats")
+        command.add_argument("--user", action="append", help="Only these users (repeatable)")
+        command.add_argument("--type", action="append",
+                             help="Only these event types (repeatable), e.g. message, pm, connected, "
+                                  "disconnected, file_sent, rate_limit")
+        command.add_argument("--room", action="append", help="Only these rooms (repeatable)")
+
+    commands.add_parser("index", help="Index new log lines and show what the index holds")
+    events = commands.add_parser("events", help="Print the matching log lines, oldest first")
+    add_filters(events)
+    events.add_argument("--limit", type=int)
+    count = commands.add_parser("count", help="Event count, bytes and mean latency per group")
+    add_filters(count)
+    count.add_argument("--by", action="append", default=[], choices=sorted(GROUPS),
+                       help="Group by this (repeatable), e.g. --by user --by hour")
+    rate = commands.add_parser("disconnect-rate", help="Connections, disconnections and the ratio per group")
+    add_filters(rate)
+    rate.add_argument("--by", action="append", default=[], choices=sorted(GROUPS))
+    args = parser.parse_args()
+
+    index_path = args.index or os.path.splitext(args.log)[0] + ".index.sqlite"
+    index = LogIndex(index_path)
+    if args.update or args.command == "index":
+        added = index.update(find_segments(args.log, index_path))
+    try:
+        if args.command == "index":
+            segments, total, first, last = index.stats()
+            span = (f", {datetime.fromtimestamp(first):%Y-%m-%d %H:%M:%S} to {datetime.fromtimestamp(last):%Y-%m-%d %H:%M:%S}"
+                    if first is not None else "")
+            print(f"{index_path}: {total} events ({added} new) from {segments} segments{span}")
+        elif args.command == "events":
+            where, params = build_filter(args)
+            print_lines(index.events(where, params, args.limit))
+        elif args.command == "count":
+            where, params = build_filter(args)
+            print_table(args.by + ["events", "bytes", "latency_ms"], index.aggregate(args.by, where, params))
+        elif args.command == "disconnect-rate":
+            where, params = build_filter(args)
+            print_table((args.by or ["period"]) + ["connects", "disconnects", "rate"],
+                        disconnect_rate(index, args.by, where, params))
+    except ValueError as e:
+        parser.error(str(e))
+    except BrokenPipeError:
+        pass  # e.g. piped into head
@@ -1,18 +1,245 @@
-from datetime import datetime
+from datetime import datetime, date
+import atexit
+import json
+import os
+import sys
 import threading
 
+# ---------------- LEVELS ----------------
+DEBUG = 10    # per-message lines ([RECEIVED RAW], [BROADCAST], ...)
+INFO = 20     # connections, logins, file transfers
+WARNING = 30  # rejected handshakes, slow consumers
+ERROR = 40
+LEVELS = {"DEBUG": DEBUG, "INFO": INFO, "WARNING": WARNING, "ERROR": ERROR}
+LEVEL_NAMES = {number: name for name, number in LEVELS.items()}
+
+MODES = ("sync", "background")
+ROTATIONS = ("none", "size", "daily")
+# text: "[time] [PREFIX] message" lines. json: one object per line with typed fields
+# (ts, level, type, msg, and user/addr/room/bytes/latency_ms where the event has them),
+# which log_query.py indexes.
+FORMATS = ("text", "json")
+
+# Process-wide settings, overridable from the environment so production can
+# e.g. set CHAT_LOG_LEVEL=INFO to drop per-message lines without code changes.
+settings = {
+    "log_file": os.environ.get("CHAT_LOG_FILE", "server_log.txt"),
+    "level": LEVELS.get(os.environ.get("CHAT_LOG_LEVEL", "DEBUG").upper(), DEBUG),
+    "mode": os.environ.get("CHAT_LOG_MODE", "sync"),
+    "format": os.environ.get("CHAT_LOG_FORMAT", "text"),
+    "rotate": os.environ.get("CHAT_LOG_ROTATE", "none"),
+    "max_bytes": int(os.environ.get("CHAT_LOG_MAX_BYTES", 50 * 1024 * 1024)),
+    "backup_count": int(os.environ.get("CHAT_LOG_BACKUPS", 5)),
+    "flush_interval": float(os.environ.get("CHAT_LOG_FLUSH_INTERVAL", 0.5)),
+    "flush_bytes": int(os.environ.get("CHAT_LOG_FLUSH_BYTES", 64 * 1024)),
+    "echo": os.environ.get("CHAT_LOG_ECHO", "1") != "0",
+}
+
+_writers = {}  # log file path -> LogWriter shared by every Logger writing there
+_writers_lock = threading.Lock()
+
+
+def configure_logging(**overrides):
+    """Change logging settings for the whole process (e.g. from command-line flags).
+
+    level may be given as a name ("INFO") or a number. Writers already open
+    are flushed and reopened with the new settings on their next line.
+    """
+    overrides = {k: v for k, v in overrides.items() if v is not None}
+    if isinstance(overrides.get("level"), str):
+        overrides["level"] = LEVELS[overrides["level"].upper()]
+    if overrides.get("mode", "sync") not in MODES:
+        raise ValueError(f"Unknown log mode '{overrides['mode']}', expected one of {MODES}")
+    if overrides.get("rotate", "none") not in ROTATIONS:
+        raise ValueError(f"Unknown log rotation '{overrides['rotate']}', expected one of {ROTATIONS}")
+    if overrides.get("format", "text") not in FORMATS:
+        raise ValueError(f"Unknown log format '{overrides['format']}', expected one of {FORMATS}")
+    settings.update(overrides)
+    shutdown_logging()
+
+
+def shutdown_logging():
+    """Flush and close every open log file."""
+    with _writers_lock:
+        writers = list(_writers.values())
+        _writers.clear()
+    for writer in writers:
+        writer.close()
+
+
+atexit.register(shutdown_logging)
+
+
+def _get_writer(path):
+    writer = _writers.get(path)
+    if writer is None:
+        with _writers_lock:
+            writer = _writers.get(path)
+            if writer is None:
+                writer = _writers[path] = LogWriter(path, dict(settings))
+    return writer
+
+
+class LogWriter:
+    """Owns one log file: a persistent handle, optional background batching and rotation."""
+
+    def __init__(self, path, config):
+        self.path = path
+        self.config = config
+        self.background = config["mode"] == "background"
+        self.file = None
+        self.size = 0
+        self.opened_on = None
+        self.pending = []  # lines waiting for the background writer
+        self.pending_bytes = 0
+        self.closed = False
+        self.cond = threading.Condition()
+        self.io_lock = threading.Lock()  # serialises file access and rotation
+
+        if self.background:
+            self.thread = threading.Thread(target=self._run, name="log-writer")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def write(self, line):
+        with self.cond:
+            if not self.background or self.closed:
+                # A late line after close() is written directly rather than lost
+                self._write_lines([line])
+                return
+            self.pending.append(line)
+            self.pending_bytes += len(line)
+            # Wake the writer for the first line of a batch and again once the batch is big enough
+            if len(self.pending) == 1 or self.pending_bytes >= self.config["flush_bytes"]:
+                self.cond.notify()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                if not self.closed and self.pending_bytes < self.config["flush_bytes"]:
+                    # Give the batch a moment to fill up; woken early once it is big enough
+                    self.cond.wait(self.config["flush_interval"])
+                lines, self.pending, self.pending_bytes = self.pending, [], 0
+                closed = self.closed
+            if lines:
+                try:
+                    self._write_lines(lines)
+                except Exception as e:
+                    print(f"[LOGGER ERROR] {e}", file=sys.stderr)
+            if closed:
+                break
+        with self.io_lock:
+            self._close_file()
+
+    def _write_lines(self, lines):
+        data = "\n".join(lines) + "\n"
+        with self.io_lock:
+            if self.config["echo"]:
+                sys.stdout.write(data)
+            self._maybe_rotate()
+            self.file.write(data)
+            self.file.flush()
+            self.size += len(data)
+
+    # ---------------- ROTATION ----------------
+    def _open(self):
+        self.file = open(self.path, "a", encoding="utf-8")
+        self.size = self.file.tell()
+        # Date of the existing file, so a restart after midnight still rotates yesterday's log
+        self.opened_on = date.fromtimestamp(os.path.getmtime(self.path)) if self.size else date.today()
+
+    def _maybe_rotate(self):
+        if self.file is None:
+            self._open()
+        rotate = self.config["rotate"]
+        if rotate == "size" and self.size >= self.config["max_bytes"]:
+            self._close_file()
+            self._rotate_by_size()
+            self._open()
+        elif rotate == "daily" and date.today() != self.opened_on:
+            self._close_file()
+            self._rotate_by_date()
+            self._open()
+
+    def _rotate_by_size(self):
+        # server_log.txt -> server_log.txt.1 -> server_log.txt.2 ... up to backup_count
+        backups = self.config["backup_count"]
+        for i in range(backups - 1, 0, -1):
+            src = f"{self.path}.{i}"
+            if os.path.exists(src):
+                os.replace(src, f"{self.path}.{i + 1}")
+        if backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+    def _rotate_by_date(self):
+        # server_log.txt -> server_log.txt.2025-10-11, keeping the newest backup_count days
+        os.replace(self.path, f"{self.path}.{self.opened_on.isoformat()}")
+        directory = os.path.dirname(os.path.abspath(self.path))
+        prefix = os.path.basename(self.path) + "."
+        dated = sorted(name for name in os.listdir(directory)
+                       if name.startswith(prefix) and name[len(prefix):].count("-") == 2)
+        for name in dated[:max(len(dated) - self.config["backup_count"], 0)]:
+            os.remove(os.path.join(directory, name))
+
+    def _close_file(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def close(self):
+        if self.background:
+            with self.cond:
+                self.closed = True
+                self.cond.notify()
+            self.thread.join(timeout=5)
+        else:
+            with self.io_lock:
+                self._close_file()
+
+
+def event_type(event):
+    """"[NEW CONNECTION] bob ..." -> "new_connection"."""
+    if event.startswith("[") and "]" in event:
+        return event[1:event.index("]")].strip(" .").lower().replace(" ", "_")
+    return "event"
+
+
+def json_record(now, level, event, fields):
+    record = {"ts": round(now.timestamp(), 3), "time": now.strftime("%Y-%m-%d %H:%M:%S"),
+              "level": LEVEL_NAMES.get(level, level), "type": fields.pop("type", None) or event_type(event),
+              "msg": event}
+    for key, value in fields.items():
+        if isinstance(value, tuple) and len(value) == 2:
+            value = f"{value[0]}:{value[1]}"  # (host, port) peer address
+        record[key] = value
+    return json.dumps(record, ensure_ascii=False, default=str)
+
+
 class Logger:
-    def __init__(self, log_file="server_log.txt"):
-        self.log_file = log_file
-        self.lock = threading.Lock()
-
-    def log_event(self, event):
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        log_line = f"[{timestamp}] {event}"
-        with self.lock:
-            print(log_line)
-            with open(self.log_file, "a", encoding="utf-8") as f:
-                f.write(log_line + "\n")
+    def __init__(self, log_file=None, level=None):
+        self.log_file = log_file  # None: follow the process-wide setting
+        self.level = level  # None: follow the process-wide setting
+
+    def is_enabled(self, level):
+        return level >= (self.level if self.level is not None else settings["level"])
+
+    def log_event(self, event, level=INFO, **fields):
+        """Log one event. fields (type, user, addr, room, bytes, latency_ms, ...) only go into json logs.
+
+        Without a type, the json record takes it from the event's "[PREFIX]", e.g. "new_connection".
+        """
+        if not self.is_enabled(level):
+            return
+        now = datetime.now()
+        if settings["format"] == "json":
+            log_line = json_record(now, level, event, fields)
+        else:
+            log_line = f"[{now.strftime('%Y-%m-%d %H:%M:%S')}] {event}"
+        _get_writer(self.log_file or settings["log_file"]).write(log_line)
 
     def list_active_clients(self, clients):
         active = []
@@ -1,114 +1,466 @@
 # message_handler.py
+import os
 import threading
-from logger_utility import Logger
+import time
+import zlib
+from logger_utility import Logger, DEBUG, WARNING, ERROR
+from file_transfer import Upload, Delivery, RELAY_WINDOW, UPLOAD_CHUNK_SIZE
+from blob_store import valid_digest
+from rooms import LOBBY, normalize_room
+from rate_limit import RateLimiter, CHAT, PM, FILE
+from metrics import (metrics, BYTES_IN, MESSAGES_IN, SEND_ERRORS, DISCONNECTIONS, BROADCAST_TIME,
+                     HEARTBEAT_EVICTIONS, FILE_CACHE_HITS, RATE_LIMITED, RATE_LIMIT_DISCONNECTS)
+from history import MAX_HISTORY
+from protocol import (FrameDecoder, ProtocolError, encode_frame, encode_text, encode_json, decode_json,
+                      compress_frame, decompress_payload, inflate, StreamCompressor,
+                      TEXT, FILE_START, FILE_DATA, FILE_END, FILE_OFFER, FILE_ACCEPT, FILE_CANCEL, PING, PONG,
+                      PING_MAX_PAYLOAD, TRANSFER_ID_SIZE, FLAG_COMPRESSED)
+
+PING_FRAME = encode_frame(PING)
 
 logger = Logger()
 
 class MessageHandler:
-    def __init__(self, client_socket, client_address, clients, clients_lock):
+    def __init__(self, client_socket, client_address, server, threaded=True, decoder=None):
         self.client_socket = client_socket
         self.client_address = client_address
-        self.clients = clients
-        self.clients_lock = clients_lock
+        self.server = server
+        self.registry = server.registry
+        self.transfers = server.transfers
+        self.history = server.history
+        self.admins = server.admins  # usernames allowed to run admin commands (/stats)
+        self.threaded = threaded
+        # Carries over any frames the client pipelined behind its login
+        self.decoder = decoder or FrameDecoder()
         self.running = True
+        self.replay = None  # frames of the /history replay in progress, if any
+
+        # Ingress rate limits: over them, the reader pauses for self.pause seconds before going on
+        self.limiter = RateLimiter(server.rate_limits, server.rate_disconnect) if server.rate_limits else None
+        self.pause = 0.0
+
+        # Heartbeat: handle_frames() only stamps last_seen; the wheel timer works out the rest
+        self.last_seen = time.monotonic()
+        self.timer = None
+        if server.idle_timeout:
+            self.timer = server.timers.schedule(server.idle_timeout, self.check_liveness)
 
-        thread = threading.Thread(target=self.handle_client)
-        thread.daemon = True
-        thread.start()
+        if server.history_replay:
+            self.send_history(LOBBY, server.history_replay, quiet=True)
+
+        # The asyncio engine drives handle_message() from its own read loop
+        if threaded:
+            thread = threading.Thread(target=self.handle_client)
+            thread.daemon = True
+            thread.start()
 
     def handle_client(self): 
-        username = None
-        with self.clients_lock:
-            username = self.clients.get(self.client_socket, "Unknown")
-        logger.log_event(f"[CONNECTED] {username} ({self.client_address})")
+        username = self.get_username()
+        logger.log_event(f"[CONNECTED] {username} ({self.client_address})", user=username, addr=self.client_address)
 
         while self.running:
             try:
-                msg = self.client_socket.recv(4096).decode('utf-8')
-                if not msg:
+                if not self.handle_frames(username):
                     break
-                msg = msg.strip()
-                logger.log_event(f"[RECEIVED RAW] {username}: {msg}")
-
-                # ---------------- COMMANDS ----------------
-                if msg.startswith("/pm "):
-                    # existing private message code
-                    parts = msg.split(" ", 2)
-                    if len(parts) < 3:
-                        self._send_to_client(self.client_socket, "[SYSTEM] Usage: /pm <username> <message>")
-                        continue
-                    _, target_username, private_msg = parts
-                    self.handle_private_message(username, target_username, private_msg)
-
-                # ----------- FILE TRANSFER -----------
-                elif msg.startswith("/file "):
-                    # Format: /file recipient_username filename
-                    parts = msg.split(" ", 2)
-                    if len(parts) < 3:
-                        self._send_to_client(self.client_socket, "[SYSTEM] Usage: /file <username> <filename>")
-                        continue
-                    _, target_username, filename = parts
-                    self.handle_file_transfer(username, target_username, filename)
-
-                elif msg == "/list":
-                    self.send_user_list()
-                elif msg == "/quit":
-                    self._send_to_client(self.client_socket, "[SYSTEM] Goodbye.")
+                if self.pause:
+                    # Over the rate limit: leave the rest unread so TCP pushes back on the client
+                    time.sleep(self.pause)
+                    continue
+                n = self.decoder.recv_from(self.client_socket)
+                if not n:
                     break
-                else:
-                    full_msg = f"[{username}] ({self.client_address[0]}:{self.client_address[1]}): {msg}"
-                    logger.log_event(f"[BROADCAST] {full_msg}")
-                    self.broadcast(full_msg)
+                BYTES_IN.inc(n)
 
             except Exception as e:
-                logger.log_event(f"[DISCONNECTED] {username} ({e})")
+                logger.log_event(f"[DISCONNECTED] {username} ({e})", type="disconnect_reason", user=username,
+                                 addr=self.client_address, reason=str(e))
                 break
         self.stop()
 
+    def get_username(self):
+        return self.registry.get_username(self.client_socket, "Unknown")
+
+    def handle_frames(self, username):
+        """Handle every complete frame buffered in the decoder. Returns False once the client quits.
+
+        A client over its rate limit gets self.pause set to the seconds to wait before the
+        next call; the frames after the one that went over stay in the decoder until then.
+        """
+        self.last_seen = time.monotonic()
+        self.pause = 0.0
+        for frame_type, flags, payload in self.decoder.frames():
+            MESSAGES_IN.inc()
+            if flags & FLAG_COMPRESSED and frame_type != FILE_DATA:
+                payload = decompress_payload(payload)
+            kind, messages = FILE, 1
+            if frame_type == TEXT:
+                msg = str(payload, 'utf-8')
+                if not self.handle_message(username, msg):
+                    return False
+                kind = PM if msg.startswith("/pm ") else CHAT
+            elif frame_type == FILE_DATA:
+                self.handle_file_data(payload, flags)
+                messages = 0  # file data is limited by the byte bucket alone
+            elif frame_type == FILE_OFFER:
+                self.handle_file_offer(username, decode_json(payload))
+            elif frame_type == FILE_ACCEPT:
+                self.handle_file_accept(decode_json(payload))
+            elif frame_type == FILE_END:
+                self.handle_file_end(decode_json(payload))
+            elif frame_type == FILE_CANCEL:
+                self.handle_file_cancel(username, decode_json(payload))
+            elif frame_type == PING:
+                if len(payload) > PING_MAX_PAYLOAD:
+                    raise ProtocolError(f"PING payload of {len(payload)} bytes")
+                # A plain system frame: a client pinging faster than it reads meets the slow-consumer policy
+                self.client_socket.send(encode_frame(PONG, bytes(payload)))
+                kind = CHAT  # heartbeats count as chat, so a PING flood is paused like any other
+            elif frame_type == PONG:
+                kind = CHAT  # last_seen is all a pong is for
+            else:
+                raise ProtocolError(f"Unexpected frame type {frame_type} from client")
+            if self.limiter and kind:
+                self.pause = self.limiter.charge(kind, messages, len(payload))
+                if self.pause:
+                    return self.throttle(username)
+        return True
+
+    def throttle(self, username):
+        """The client went over its rate limit. Returns False if it has been over it for too long."""
+        RATE_LIMITED.inc()
+        if not self.limiter.over_threshold():
+            logger.log_event(f"[RATE LIMIT] Pausing reads from {username} for {self.pause:.2f}s", DEBUG,
+                             user=username, addr=self.client_address, pause_ms=round(self.pause * 1000, 1))
+            return True
+        RATE_LIMIT_DISCONNECTS.inc()
+        logger.log_event(f"[RATE LIMIT] {username} {self.client_address} over its rate limit for "
+                         f"{self.limiter.disconnect_after:.0f}s, disconnecting", WARNING,
+                         type="rate_limit_disconnect", user=username, addr=self.client_address)
+        self._send_to_client(self.client_socket, "[SYSTEM] Disconnected: you are sending too fast.")
+        return False
+
+    def check_liveness(self):
+        """Wheel timer callback: ping a silent client, drop one that never answered, else re-arm."""
+        if not self.running:
+            return
+        server = self.server
+        idle = time.monotonic() - self.last_seen
+        if idle >= server.idle_timeout + server.liveness_timeout:
+            HEARTBEAT_EVICTIONS.inc()
+            logger.log_event(f"[HEARTBEAT] No answer from {self.get_username()} {self.client_address} "
+                             f"for {idle:.0f}s, disconnecting", WARNING,
+                             user=self.get_username(), addr=self.client_address)
+            # Wakes the reader, which then cleans up as for any other disconnect
+            self.client_socket.abort()
+            return
+        if idle >= server.idle_timeout:
+            self.client_socket.send(PING_FRAME, force=True)
+            delay = server.idle_timeout + server.liveness_timeout - idle
+        else:
+            delay = server.idle_timeout - idle
+        self.timer = server.timers.schedule(delay, self.check_liveness)
+
+    def handle_message(self, username, msg):
+        """Process one message from the client. Returns False once the client quits."""
+        msg = msg.strip()
+        logger.log_event(f"[RECEIVED RAW] {username}: {msg}", DEBUG, type="received", user=username,
+                         addr=self.client_address, bytes=len(msg))
+
+        # ---------------- COMMANDS ----------------
+        if msg.startswith("/pm "):
+            # existing private message code
+            parts = msg.split(" ", 2)
+            if len(parts) < 3:
+                self._send_to_client(self.client_socket, "[SYSTEM] Usage: /pm <username> <message>")
+                return True
+            _, target_username, private_msg = parts
+            self.handle_private_message(username, target_username, private_msg)
+
+        # ----------- FILE TRANSFER -----------
+        elif msg.startswith("/file"):
+            # Clients turn "/file <recipients> <path>" into a FILE_OFFER upload before it gets here
+            self._send_to_client(self.client_socket,
+                                 "[SYSTEM] Usage: /file <username>[,<username>...] | #room <path> "
+                                 "(your client uploads the file)")
+
+        elif msg == "/list":
+            self.send_user_list()
+        elif msg == "/stats":
+            self.send_stats(username)
+
+        # ----------- ROOMS -----------
+        elif msg == "/join" or msg.startswith("/join "):
+            self.join_room(username, msg[len("/join"):])
+        elif msg == "/leave":
+            self.join_room(username, LOBBY)
+        elif msg == "/rooms":
+            self.send_room_list()
+        elif msg == "/history" or msg.startswith("/history "):
+            self.handle_history(msg[len("/history"):].strip())
+
+        elif msg == "/quit":
+            self._send_to_client(self.client_socket, "[SYSTEM] Goodbye.")
+            return False
+        else:
+            room = self.registry.rooms.room_of(self.client_socket) or LOBBY
+            full_msg = f"[{username}] ({self.client_address[0]}:{self.client_address[1]}): {msg}"
+            if room != LOBBY:
+                full_msg = f"[#{room}] {full_msg}"
+            start = time.perf_counter()
+            self.broadcast(full_msg, room, record=True)
+            logger.log_event(f"[BROADCAST] {full_msg}", DEBUG, type="message", user=username,
+                             addr=self.client_address, room=room, bytes=len(msg),
+                             latency_ms=round((time.perf_counter() - start) * 1000, 3))
+        return True
+
 
     def find_socket_by_username(self, username):
-        with self.clients_lock:
-            for sock, user in self.clients.items():
-                if user == username:
-                    return sock
-        return None
-
-    # inside MessageHandler class
-    def send_message_bytes(self, data_bytes):
-        try:
-            self.client_socket.send(data_bytes)
-        except Exception as e:
-            print(f"[ERROR] Failed to send bytes: {e}")
+        return self.registry.get_connection(username)
 
-    def handle_file_transfer(self, sender_username, target_username, filepath):
-        target_sock = self.find_socket_by_username(target_username)
-        if target_sock is None:
-            self._send_to_client(self.client_socket, f"[SYSTEM] User '{target_username}' not found.")
+    # ----------- FILE TRANSFER -----------
+    # sender --FILE_OFFER(sha256, to)--> server --FILE_START--> each recipient
+    # server --FILE_ACCEPT(offset)--> sender, unless the blob store already has the content
+    #     (then FILE_END: nothing to upload)
+    # sender --FILE_DATA...FILE_END--> server, which stores the blob once
+    # recipient --FILE_ACCEPT(offset)--> server --FILE_DATA...FILE_END--> recipient, from the blob
+    # recipient --FILE_END--> server: it already holds that content, skip it
+    # File frames are pinned in the recipient's queue, so they are never dropped.
+
+    def handle_file_offer(self, sender_username, offer):
+        transfer_id = str(offer.get("id", ""))
+        if len(transfer_id) != TRANSFER_ID_SIZE:
+            raise ProtocolError(f"Bad transfer id '{transfer_id}'")
+        sha256 = offer.get("sha256")
+        if not valid_digest(sha256):
+            raise ProtocolError(f"Bad sha256 '{sha256}'")
+        filename = os.path.basename(str(offer.get("name", ""))) or "file"
+        size = int(offer.get("size", 0))
+        if size < 0:
+            raise ProtocolError(f"Bad size {size}")
+        blobs = self.server.blobs
+        if size > blobs.max_bytes:
+            self.client_socket.send(encode_json(FILE_CANCEL, {"id": transfer_id, "reason": "file too large"}))
+            self._send_to_client(self.client_socket, f"[SYSTEM] '{filename}' is larger than the "
+                                                     f"{blobs.max_bytes} bytes the server can store.")
+            return
+
+        recipients = self.resolve_recipients(sender_username, offer.get("to"))
+        if not recipients:
+            self.client_socket.send(encode_json(FILE_CANCEL, {"id": transfer_id, "reason": "no recipients"}))
+            return
+
+        deliveries = []
+        for target_sock, target_username in recipients:
+            delivery = Delivery(transfer_id, self.client_socket, sender_username, target_sock, target_username,
+                                filename, size, sha256)
+            self.transfers.add_delivery(delivery)
+            deliveries.append(delivery)
+        names = ", ".join(name for _, name in recipients)
+
+        refused = None
+        with self.transfers.offer_lock:
+            # Pinned for every delivery, so it cannot be evicted before they are sent
+            path = blobs.acquire(sha256, len(deliveries))
+            upload = self.transfers.upload_of(sha256)
+            if path is None and upload is not None and upload.sender is self.client_socket:
+                # Our own earlier attempt at this file: replaced by this one, which resumes it
+                self.abort_upload(upload, "offered again")
+                upload = None
+            if path is None and upload is None:
+                try:
+                    blobs.reserve(sha256, size)
+                except ValueError as e:
+                    refused = str(e)
+                else:
+                    # Its .part file is opened (and rehashed, when resuming) by prepare_upload()
+                    upload = Upload(transfer_id, self.client_socket, sender_username, filename, size, sha256, None)
+                    upload.deliveries.extend(deliveries)
+                    self.transfers.add_upload(upload)
+            elif path is None:
+                # Another client is uploading the same content right now: these wait for that upload
+                upload.deliveries.extend(deliveries)
+
+        if refused is not None:
+            for delivery in deliveries:
+                self.transfers.remove_delivery(delivery)
+            self.client_socket.send(encode_json(FILE_CANCEL, {"id": transfer_id, "reason": refused}))
+            self._send_to_client(self.client_socket, f"[SYSTEM] Could not send '{filename}': {refused}.")
+            logger.log_event(f"[FILE REFUSED] {sender_username} -> {names}: {filename} ({size} bytes, {refused})",
+                             WARNING, user=sender_username, to=names, bytes=size)
+            return
+        if path is not None:
+            for delivery in deliveries:
+                self.transfers.attach_blob(delivery, blobs, path)
+
+        for delivery in deliveries:
+            delivery.recipient.send(encode_json(FILE_START, {"id": transfer_id, "from": sender_username,
+                                                             "name": filename, "size": size, "sha256": sha256}),
+                                    force=True)
+        if path is None and upload.sender is self.client_socket:
+            self.server.deliveries_pool.submit(self.prepare_upload, upload, names)
+        else:
+            FILE_CACHE_HITS.inc()
+            # Nothing to upload: the sender is done
+            self.client_socket.send(encode_json(FILE_END, {"id": transfer_id, "sha256": sha256}))
+            self._send_to_client(self.client_socket, f"[SYSTEM] '{filename}' is already on the server, "
+                                                     f"sending it to {names}.")
+            logger.log_event(f"[FILE OFFER] {sender_username} -> {names}: {filename} (stored, {size} bytes)",
+                             user=sender_username, to=names, bytes=size, cached=True)
+
+    def prepare_upload(self, upload, names):
+        """Open the upload's .part file (in the delivery pool, as resuming rehashes it), then ask for the data."""
+        try:
+            writer = self.server.blobs.open_upload(upload.sha256, upload.size)
+        except OSError as e:
+            logger.log_event(f"[FILE ERROR] Storing {upload.name} from {upload.sender_name}: {e}", ERROR,
+                             user=upload.sender_name)
+            with self.transfers.offer_lock:
+                if self.transfers.get_upload(upload.sender, upload.id) is not upload:
+                    return
+                self.transfers.remove_upload(upload)
+                deliveries = list(upload.deliveries)
+            upload.sender.send(encode_json(FILE_CANCEL, {"id": upload.id, "reason": "the server could not store it"}),
+                               force=True)
+            for delivery in deliveries:
+                self.cancel_delivery(delivery, "the server could not store it")
+            return
+        with self.transfers.offer_lock:
+            if self.transfers.get_upload(upload.sender, upload.id) is upload:
+                upload.writer, writer = writer, None
+        if writer is not None:
+            # Cancelled while the file was being opened
+            self.server.blobs.abort(writer)
             return
+        offset = upload.writer.offset
+        upload.sender.send(encode_json(FILE_ACCEPT, {"id": upload.id, "offset": offset}))
+        logger.log_event(f"[FILE OFFER] {upload.sender_name} -> {names}: {upload.name} ({upload.size} bytes"
+                         f"{f', resuming at {offset}' if offset else ''})",
+                         user=upload.sender_name, to=names, bytes=upload.size)
+
+    def resolve_recipients(self, sender_username, to):
+        """(connection, username) for each recipient of an offer: a '#room', a username or a list of them."""
+        if isinstance(to, str) and to.startswith("#"):
+            room = normalize_room(to)
+            members = self.registry.rooms.members(room) if room else ()
+            recipients = [(conn, self.registry.get_username(conn)) for conn in members if conn is not self.client_socket]
+            # Blobs are per server process: room members connected to another worker do not get the file
+            here = " on this server process" if self.server.worker_id is not None else ""
+            if not recipients:
+                self._send_to_client(self.client_socket, f"[SYSTEM] Nobody else is in {to}{here}.")
+            elif here:
+                self._send_to_client(self.client_socket, f"[SYSTEM] Only the members of {to} connected to this "
+                                                         f"server process get the file.")
+            return [(conn, name) for conn, name in recipients if name is not None]
+
+        names = [to] if isinstance(to, str) else to if isinstance(to, list) else []
+        recipients = []
+        for target_username in dict.fromkeys(str(name).strip() for name in names):
+            target_sock = self.find_socket_by_username(target_username)
+            if target_sock is None or target_username == sender_username:
+                self._send_to_client(self.client_socket, f"[SYSTEM] User '{target_username}' not found.")
+            elif getattr(target_sock, "remote", False):
+                # Blobs are stored per server process, and deliveries stream from them locally
+                self._send_to_client(self.client_socket,
+                                     f"[SYSTEM] '{target_username}' is connected to another server process; "
+                                     f"file transfers only work between users on the same one.")
+            else:
+                recipients.append((target_sock, target_username))
+        return recipients
+
+    def handle_file_data(self, payload, flags):
+        upload = self.transfers.get_upload(self.client_socket, str(payload[:TRANSFER_ID_SIZE], 'ascii'))
+        if upload is None or upload.writer is None:
+            return  # cancelled while the chunk was in flight, or sent before FILE_ACCEPT
+        data = payload[TRANSFER_ID_SIZE:]
+        if flags & FLAG_COMPRESSED:
+            # Blobs are stored as plain files; each recipient gets its own stream from them
+            if upload.inflater is None:
+                upload.inflater = zlib.decompressobj()
+            data = inflate(upload.inflater, data)
         try:
-            # Extract filename only
-            import os
-            filename = os.path.basename(filepath)
+            upload.writer.write(data)
+        except (OSError, ValueError) as e:
+            self.abort_upload(upload, str(e))
+            self.client_socket.send(encode_json(FILE_CANCEL, {"id": upload.id, "reason": str(e)}), force=True)
 
-            # Send filename first
-            target_sock.send(f"[FILE]{filename}".encode('utf-8'))
+    def handle_file_accept(self, fields):
+        delivery = self.transfers.get_delivery(self.client_socket, str(fields.get("id", "")))
+        if delivery is None or delivery.accepted:
+            return
+        delivery.offset = int(fields.get("offset", 0))
+        delivery.accepted = True
+        if delivery.offset:
+            logger.log_event(f"[FILE RESUME] {delivery.name} to {delivery.recipient_name} from byte {delivery.offset}",
+                             user=delivery.recipient_name, bytes=delivery.offset)
+        if self.transfers.claim_start(delivery):
+            start_delivery(delivery, self.transfers, self.server.deliveries_pool)
 
-            # Send file in chunks
-            with open(filepath, "rb") as f:
-                data = f.read(4096)
-                while data:
-                    target_sock.send(b"[FILEDATA]" + data)
-                    data = f.read(4096)
+    def handle_file_end(self, fields):
+        transfer_id = str(fields.get("id", ""))
+        delivery = self.transfers.get_delivery(self.client_socket, transfer_id)
+        if delivery is not None:
+            # From a recipient: it already holds this content
+            self.transfers.remove_delivery(delivery)
+            self._send_to_client(delivery.sender, f"[SYSTEM] {delivery.recipient_name} already has "
+                                                  f"'{delivery.name}', nothing sent.")
+            logger.log_event(f"[FILE SKIPPED] {delivery.recipient_name} already has {delivery.name}",
+                             user=delivery.recipient_name, bytes=delivery.size)
+            return
+        upload = self.transfers.get_upload(self.client_socket, transfer_id)
+        if upload is None or upload.writer is None:
+            return
+        with self.transfers.offer_lock:
+            # Committed under the lock, so an offer of the same content finds either this upload or the blob
+            self.transfers.remove_upload(upload)
+            deliveries = list(upload.deliveries)
+            path = self.server.blobs.commit(upload.writer, pins=len(deliveries))
+        if path is None:
+            self._send_to_client(self.client_socket, f"[SYSTEM] Upload of '{upload.name}' was corrupted "
+                                                     f"(checksum mismatch), please send it again.")
+            for delivery in deliveries:
+                self.cancel_delivery(delivery, "upload corrupted")
+            return
+        logger.log_event(f"[FILE STORED] {upload.sender_name}: {upload.name} ({upload.size} bytes, {upload.sha256})",
+                         user=upload.sender_name, bytes=upload.size)
+        for delivery in deliveries:
+            if self.transfers.attach_blob(delivery, self.server.blobs, path) and self.transfers.claim_start(delivery):
+                start_delivery(delivery, self.transfers, self.server.deliveries_pool)
 
-            # Send end-of-file signal
-            target_sock.send(b"[ENDFILE]")
+    def handle_file_cancel(self, username, fields):
+        transfer_id = str(fields.get("id", ""))
+        reason = f"{username}: {fields.get('reason', 'cancelled')}"
+        delivery = self.transfers.get_delivery(self.client_socket, transfer_id)
+        if delivery is not None:
+            self.transfers.remove_delivery(delivery)
+            self._send_to_client(delivery.sender, f"[SYSTEM] Transfer of '{delivery.name}' to "
+                                                  f"{delivery.recipient_name} cancelled ({reason}).")
+            return
+        upload = self.transfers.get_upload(self.client_socket, transfer_id)
+        if upload is not None:
+            self.abort_upload(upload, reason)
 
-            # Notify sender
-            self._send_to_client(self.client_socket, f"[SYSTEM] File '{filename}' sent to {target_username}.")
-            logger.log_event(f"[FILE] {sender_username} sent {filename} to {target_username}")
+    def abort_upload(self, upload, reason):
+        """Drop an unfinished upload (its .part file stays for a retry) and whatever waited on it."""
+        with self.transfers.offer_lock:
+            if self.transfers.get_upload(upload.sender, upload.id) is not upload:
+                return
+            self.transfers.remove_upload(upload)
+            writer, upload.writer = upload.writer, None
+            deliveries = list(upload.deliveries)
+        if writer is not None:
+            self.server.blobs.abort(writer)
+        # Otherwise prepare_upload() is still opening it, and aborts it once it has
+        for delivery in deliveries:
+            self.cancel_delivery(delivery, reason)
+        logger.log_event(f"[FILE CANCELLED] {upload.sender_name}: {upload.name} ({reason})", user=upload.sender_name)
 
-        except Exception as e:
-            self._send_to_client(self.client_socket, f"[SYSTEM] Failed to send file: {e}")
+    def cancel_delivery(self, delivery, reason):
+        """Tell the recipient of delivery that it is off."""
+        if delivery.cancelled:
+            return
+        self.transfers.remove_delivery(delivery)
+        delivery.recipient.send(encode_json(FILE_CANCEL, {"id": delivery.id, "reason": reason}), force=True)
+        self._send_to_client(delivery.recipient, f"[SYSTEM] Transfer of '{delivery.name}' cancelled ({reason}).")
 
     def handle_private_message(self, sender_username, target_username, message):
         target_sock = self.find_socket_by_username(target_username)
@@ -119,53 +471,211 @@ class MessageHandler:
         composed = f"[PRIVATE] {sender_username} -> {target_username}: {message}"
         # send to target
         try:
-            target_sock.send(composed.encode('utf-8'))
+            target_sock.sendall(compress_frame(encode_text(composed), target_sock.codec))
             # ack sender
             self._send_to_client(self.client_socket, f"[SYSTEM] Private message sent to {target_username}.")
-            logger.log_event(f"[PRIVATE] {composed}")
+            logger.log_event(f"[PRIVATE] {composed}", DEBUG, type="pm", user=sender_username, to=target_username,
+                             addr=self.client_address, bytes=len(message))
         except Exception as e:
             self._send_to_client(self.client_socket, f"[SYSTEM] Failed to deliver to {target_username}: {e}")
-            logger.log_event(f"[PRIVATE ERROR] {e}")
+            logger.log_event(f"[PRIVATE ERROR] {e}", ERROR, user=sender_username, to=target_username)
+
+    def send_stats(self, username):
+        if username not in self.admins:
+            self._send_to_client(self.client_socket, "[SYSTEM] /stats is only available to server admins.")
+            return
+        self._send_to_client(self.client_socket, "[SYSTEM] Server stats:\n" + "\n".join(metrics.summary_lines()))
 
     def send_user_list(self):
-        with self.clients_lock:
-            users = list(self.clients.values())
-        user_list_msg = "[SYSTEM] Users online: " + ", ".join(users)
+        user_list_msg = "[SYSTEM] Users online: " + ", ".join(self.registry.usernames())
         self._send_to_client(self.client_socket, user_list_msg)
 
-    def broadcast(self, message):
-        with self.clients_lock:
-            for client in list(self.clients.keys()):
+    # ----------- ROOMS -----------
+    def join_room(self, username, name):
+        room = normalize_room(name)
+        if room is None:
+            self._send_to_client(self.client_socket,
+                                 "[SYSTEM] Usage: /join <room> (letters, digits, '_', '-', '.'; up to 32, not starting with '.')")
+            return
+        rooms = self.registry.rooms
+        previous = rooms.join(self.client_socket, room)
+        if previous == room:
+            self._send_to_client(self.client_socket, f"[SYSTEM] You are already in #{room}.")
+            return
+        if previous is not None and previous != LOBBY:
+            self.broadcast(f"[SYSTEM] {username} left #{previous}.", previous)
+        if room != LOBBY:
+            self.broadcast(f"[SYSTEM] {username} joined #{room}.", room)
+        self._send_to_client(self.client_socket, f"[SYSTEM] You are now in #{room}.")
+        logger.log_event(f"[ROOM] {username}: #{previous} -> #{room}", type="join", user=username, room=room)
+        if self.server.history_replay:
+            self.send_history(room, self.server.history_replay, quiet=True)
+
+    def send_room_list(self):
+        current = self.registry.rooms.room_of(self.client_socket)
+        listing = ", ".join(f"#{name} ({count}){' *' if name == current else ''}"
+                            for name, count in self.registry.rooms.rooms())
+        if self.server.worker_id is not None:
+            # Room membership is not shared over the bus, so neither are the counts
+            listing += f" (members connected to this server process, worker {self.server.worker_id})"
+        self._send_to_client(self.client_socket, f"[SYSTEM] Rooms: {listing}")
+
+    # ----------- HISTORY -----------
+    def handle_history(self, arg):
+        """/history [N | <minutes>m]: replay the current room's last N messages or last minutes."""
+        room = self.registry.rooms.room_of(self.client_socket) or LOBBY
+        try:
+            if arg.endswith("m"):
+                since = time.time() - float(arg[:-1]) * 60
+                self.send_history(room, frames=self.history.since(room, since))
+            else:
+                self.send_history(room, int(arg) if arg else 50)
+        except ValueError:
+            self._send_to_client(self.client_socket,
+                                 f"[SYSTEM] Usage: /history [count (max {MAX_HISTORY}) | <minutes>m]")
+        except OSError as e:
+            # A segment file that went missing or cannot be read: this request fails, the connection does not
+            logger.log_event(f"[HISTORY ERROR] #{room}: {e}", ERROR, room=room)
+            self._send_to_client(self.client_socket, f"[SYSTEM] Could not read the history of #{room}.")
+
+    def send_history(self, room, count=0, frames=None, quiet=False):
+        if frames is None:
+            frames = self.history.last(room, count) if count > 0 else []
+        if not frames:
+            if not quiet:
+                self._send_to_client(self.client_socket, f"[SYSTEM] No earlier messages in #{room}.")
+            return
+        if self.replay is not None:
+            if not quiet:
+                self._send_to_client(self.client_socket, "[SYSTEM] Still sending earlier history, "
+                                                         "try again once it has ended.")
+            return
+        self._send_to_client(self.client_socket, f"[SYSTEM] Last {len(frames)} messages in #{room}:")
+        self.replay = iter(frames)
+        self.replay_history()
+
+    def replay_history(self):
+        """Queue replayed frames while the client's queue is under RELAY_WINDOW bytes and half full.
+
+        Past that it returns, and the client's writer calls it again once it
+        has drained the queue. A long replay never floods the queue, and
+        leaves room in it for live messages.
+        """
+        conn = self.client_socket
+        while conn.when_writable(RELAY_WINDOW, self.replay_history, max(self.server.max_queue // 2, 1)):
+            frame = next(self.replay, None)
+            if frame is None:
+                self.replay = None
+                self._send_to_client(conn, "[SYSTEM] End of history.")
+                return
+            # Stored frames go out exactly as they were broadcast
+            conn.send(compress_frame(frame, conn.codec))
+
+    def broadcast(self, message, room=LOBBY, record=False):
+        # Encode once (and compress at most once per codec); every recipient's queue shares the same frame
+        frame = encode_text(message)
+        variants = {}
+        # Only the room's members: O(members), not O(everyone on the server).
+        # Only enqueues: each client's writer does the actual (possibly slow) send
+        with BROADCAST_TIME.time():
+            for client in self.registry.rooms.members(room):
                 if client != self.client_socket:
-                    try:
-                        client.send(message.encode('utf-8'))
-                    except Exception as e:
-                        logger.log_event(f"[BROADCAST ERROR] {e}")
-                        try:
-                            client.close()
-                        except:
-                            pass
-                        if client in self.clients:
-                            del self.clients[client]
+                    client.send(compress_frame(frame, client.codec, variants), system=False)
+        if record:
+            self.history.append(room, frame)
+        # Clients of other worker processes, when running as a cluster
+        self.registry.publish(frame, room, record)
 
     def _send_to_client(self, client, message):
         try:
-            client.send(message.encode('utf-8'))
+            client.sendall(compress_frame(encode_text(message), client.codec))
         except Exception as e:
-            logger.log_event(f"[SEND ERROR] {e}")
+            SEND_ERRORS.inc()
+            logger.log_event(f"[SEND ERROR] {e}", ERROR)
 
     def stop(self):
         self.running = False
-        with self.clients_lock:
-            if self.client_socket in self.clients:
-                username = self.clients[self.client_socket]
-                del self.clients[self.client_socket]
-                logger.log_event(f"[DISCONNECTED] {username} {self.client_address}")
+        if self.timer:
+            self.timer.cancel()
+        username = self.registry.unregister(self.client_socket)
+        if username is not None:
+            DISCONNECTIONS.inc()
+            logger.log_event(f"[DISCONNECTED] {username} {self.client_address}", user=username, addr=self.client_address)
+        # Partial uploads stay in the blob store and partial downloads on the recipient's disk,
+        # so a retry resumes where this one stopped. Deliveries to us stop at their next chunk.
+        with self.transfers.offer_lock:
+            uploads, _ = self.transfers.remove_connection(self.client_socket)
+            writers = [upload.writer for upload in uploads if upload.writer is not None]
+            for upload in uploads:
+                upload.writer = None
+        for writer in writers:
+            self.server.blobs.abort(writer)
+        for upload in uploads:
+            for delivery in list(upload.deliveries):
+                self.cancel_delivery(delivery, f"{username} disconnected")
         try:
             self.client_socket.close()
         except:
             pass
 
 
-def handle_client(client_socket, client_address, clients, clients_lock):
-    MessageHandler(client_socket, client_address, clients, clients_lock)
+# ----------- BLOB DELIVERY -----------
+def start_delivery(delivery, transfers, pool):
+    try:
+        pool.submit(deliver_file, delivery, transfers, pool)
+    except RuntimeError:
+        pass  # the server is shutting down
+
+
+def deliver_file(delivery, transfers, pool):
+    """Stream a stored blob to one recipient from its resume offset, one step at a time in the delivery pool.
+
+    A step sends while the recipient's queue is under RELAY_WINDOW bytes and
+    returns; the recipient's writer starts the next one once it has drained
+    the queue. A slow recipient holds back only its own delivery, never
+    buffers the file and keeps no pool thread waiting.
+    """
+    conn = delivery.recipient
+    prefix = delivery.id.encode('ascii')
+    if delivery.position is None:
+        delivery.position = delivery.offset
+        delivery.compressor = StreamCompressor(conn.codec)
+    try:
+        with open(delivery.path, "rb") as f:
+            f.seek(delivery.position)
+            while not delivery.cancelled:
+                if not conn.when_writable(RELAY_WINDOW, lambda: start_delivery(delivery, transfers, pool)):
+                    return  # resumed from the callback, or the recipient went away
+                chunk = f.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                delivery.position += len(chunk)
+                packed = delivery.compressor.compress(chunk)
+                if packed is None:
+                    conn.send(encode_frame(FILE_DATA, prefix + chunk), force=True)
+                else:
+                    conn.send(encode_frame(FILE_DATA, prefix + packed, FLAG_COMPRESSED), force=True)
+    except OSError as e:
+        logger.log_event(f"[FILE ERROR] Delivering {delivery.name} to {delivery.recipient_name}: {e}", ERROR,
+                         user=delivery.sender_name, to=delivery.recipient_name)
+        transfers.remove_delivery(delivery)
+        conn.send(encode_json(FILE_CANCEL, {"id": delivery.id, "reason": "file no longer on the server"}),
+                  force=True)
+        delivery.sender.send(compress_frame(encode_text(f"[SYSTEM] Could not send '{delivery.name}' to "
+                                                        f"{delivery.recipient_name}: it is no longer on the server."),
+                                            delivery.sender.codec))
+        return
+    if delivery.cancelled:
+        return
+    transfers.remove_delivery(delivery)
+    conn.send(encode_json(FILE_END, {"id": delivery.id, "sha256": delivery.sha256}), force=True)
+    delivery.sender.send(compress_frame(encode_text(f"[SYSTEM] File '{delivery.name}' sent to "
+                                                    f"{delivery.recipient_name}."), delivery.sender.codec))
+    logger.log_event(f"[FILE] {delivery.sender_name} sent {delivery.name} to {delivery.recipient_name}",
+                     type="file_sent", user=delivery.sender_name, to=delivery.recipient_name,
+                     bytes=delivery.size - delivery.offset,
+                     latency_ms=round((time.perf_counter() - delivery.started) * 1000, 1))
+
+
+def handle_client(client_socket, client_address, server, decoder=None):
+    return MessageHandler(client_socket, client_address, server, decoder=decoder)
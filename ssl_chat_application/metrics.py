@@ -0,0 +1,221 @@
+# metrics.py
+"""Process-wide counters and histograms for the server's hot paths.
+
+Recording is an increment (plus a bisect for histograms) under a per-metric
+lock, cheap enough to leave on in production. Read them with the admin
+/stats command or from the optional plain-text endpoint, which serves the
+Prometheus text format so any scraper can collect it.
+"""
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Bucket upper bounds: durations from 1us to ~8s, sizes from 1 to 4096
+TIME_BUCKETS = tuple(1e-6 * 2 ** i for i in range(24))
+SIZE_BUCKETS = tuple(2 ** i for i in range(13))
+
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter", f"{self.name} {self.value}"]
+
+    def summary(self):
+        return str(self.value)
+
+
+class Gauge:
+    """A value read from a callback when metrics are rendered (e.g. connected clients)."""
+
+    def __init__(self, name, help_text, read):
+        self.name = name
+        self.help = help_text
+        self.read = read
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {self.read()}"]
+
+    def summary(self):
+        return str(self.read())
+
+
+class Histogram:
+    """Fixed-bucket histogram; quantiles are reported as the upper bound of their bucket."""
+
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help = help_text
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last slot: above the largest bucket
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def time(self):
+        """Context manager observing the duration of its block in seconds."""
+        return _Timer(self)
+
+    def quantile(self, q):
+        if not self.count:
+            return 0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else self.max
+        return self.max
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, n in zip(self.buckets, self.counts):
+            cumulative += n
+            lines.append(f'{self.name}_bucket{{le="{bound:g}"}} {cumulative}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{self.name}_sum {self.sum:g}")
+        lines.append(f"{self.name}_count {self.count}")
+        return lines
+
+    def summary(self):
+        if not self.count:
+            return "no samples"
+        if self.buckets is TIME_BUCKETS:
+            fmt = lambda v: f"{v * 1000:.3f}ms"
+        else:
+            fmt = lambda v: f"{v:g}"
+        return (f"n={self.count} avg={fmt(self.sum / self.count)} p50<={fmt(self.quantile(0.5))} "
+                f"p99<={fmt(self.quantile(0.99))} max={fmt(self.max)}")
+
+
+class _Timer:
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class TimedLock:
+    """threading.Lock that records how long each acquire waited in a histogram."""
+
+    def __init__(self, histogram):
+        self._lock = threading.Lock()
+        self.histogram = histogram
+
+    def __enter__(self):
+        start = time.perf_counter()
+        self._lock.acquire()
+        self.histogram.observe(time.perf_counter() - start)
+
+    def __exit__(self, *exc):
+        self._lock.release()
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+
+    def counter(self, name, help_text):
+        return self._add(Counter(name, help_text))
+
+    def gauge(self, name, help_text, read):
+        """Register (or replace) a gauge read through read()."""
+        return self._add(Gauge(name, help_text, read))
+
+    def histogram(self, name, help_text, buckets=TIME_BUCKETS):
+        return self._add(Histogram(name, help_text, buckets))
+
+    def _add(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render_text(self):
+        """Every metric in the Prometheus text exposition format."""
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def summary_lines(self):
+        """One human-readable line per metric, for /stats."""
+        return [f"{name}: {metric.summary()}" for name, metric in list(self._metrics.items())]
+
+
+metrics = MetricsRegistry()
+
+# ---------------- SERVER METRICS ----------------
+CONNECTIONS = metrics.counter("chat_connections_total", "Clients that completed login")
+DISCONNECTIONS = metrics.counter("chat_disconnections_total", "Logged-in clients that went away")
+HANDSHAKE_FAILURES = metrics.counter("chat_handshake_failures_total",
+                                     "Connections refused or failed before login")
+MESSAGES_IN = metrics.counter("chat_messages_in_total", "Frames received from clients")
+MESSAGES_OUT = metrics.counter("chat_messages_out_total", "Frames queued for clients")
+BYTES_IN = metrics.counter("chat_bytes_in_total", "Bytes read from client sockets")
+BYTES_OUT = metrics.counter("chat_bytes_out_total", "Bytes written to client sockets")
+SEND_ERRORS = metrics.counter("chat_send_errors_total", "Failed writes to clients")
+DROPPED = metrics.counter("chat_dropped_total", "Frames dropped or refused by the slow-consumer policy")
+FILE_CACHE_HITS = metrics.counter("chat_file_cache_hits_total",
+                                  "File offers served from the blob store without an upload")
+HEARTBEAT_EVICTIONS = metrics.counter("chat_heartbeat_evictions_total",
+                                      "Connections closed for not answering a heartbeat ping")
+RATE_LIMITED = metrics.counter("chat_rate_limited_total",
+                               "Times reading from a client was paused for going over its rate limit")
+RATE_LIMIT_DISCONNECTS = metrics.counter("chat_rate_limit_disconnects_total",
+                                         "Clients disconnected for staying over their rate limit")
+
+HANDSHAKE_TIME = metrics.histogram("chat_tls_handshake_seconds", "TLS handshake duration (threads engine)")
+BROADCAST_TIME = metrics.histogram("chat_broadcast_fanout_seconds", "Time to queue one broadcast for every recipient")
+REGISTRY_LOCK_WAIT = metrics.histogram("chat_registry_lock_wait_seconds", "Wait to acquire the client registry lock")
+ROOMS_LOCK_WAIT = metrics.histogram("chat_rooms_lock_wait_seconds", "Wait to acquire the room index lock")
+QUEUE_DEPTH = metrics.histogram("chat_outbound_queue_depth", "Frames in a client's outbound queue after each put",
+                                SIZE_BUCKETS)
+
+
+# ---------------- TEXT ENDPOINT ----------------
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = metrics.render_text().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # scrapes would flood the console
+
+
+def serve_metrics(host, port):
+    """Serve metrics as plain text on http://host:port/ from a daemon thread. Returns the server."""
+    http_server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+    http_server.daemon_threads = True
+    thread = threading.Thread(target=http_server.serve_forever, name="metrics-http")
+    thread.daemon = True
+    thread.start()
+    return http_server
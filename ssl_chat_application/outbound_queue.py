@@ -0,0 +1,276 @@
+# outbound_queue.py
+import socket
+import threading
+import time
+from collections import deque
+from logger_utility import Logger, WARNING, ERROR
+from metrics import MESSAGES_OUT, BYTES_OUT, SEND_ERRORS, DROPPED, QUEUE_DEPTH
+
+logger = Logger()
+
+# ---------------- SLOW CONSUMER POLICIES ----------------
+DROP_OLDEST = "drop_oldest"          # discard the oldest queued message
+DISCONNECT = "disconnect"            # kick the client once its queue is full
+DROP_NON_SYSTEM = "drop_non_system"  # discard queued chat lines, keep system/private/file frames
+POLICIES = (DROP_OLDEST, DISCONNECT, DROP_NON_SYSTEM)
+
+DEFAULT_MAX_MESSAGES = 1024
+
+# Queue entry priorities
+CHAT = 0    # broadcast chat line
+SYSTEM = 1  # system reply, private message
+PINNED = 2  # file frames: never dropped, never count against the limit
+
+# Pinned frames are flow-controlled by their producers (RELAY_WINDOW), so this many bytes of them
+# queued means that has failed; as they cannot be dropped, the client is disconnected instead
+MAX_PINNED_BYTES = 32 * 1024 * 1024
+
+# Queued frames are packed into writes of up to this size, so a burst of small
+# chat lines costs one TLS write instead of one per line
+MAX_WRITE_SIZE = 64 * 1024
+
+
+def coalesce(batch, max_bytes=MAX_WRITE_SIZE):
+    """Yield the frames in batch packed into as few writes as possible, in order."""
+    if len(batch) == 1:
+        yield batch[0]
+        return
+    pending = []
+    size = 0
+    for data in batch:
+        if pending and size + len(data) > max_bytes:
+            yield pending[0] if len(pending) == 1 else b"".join(pending)
+            pending = []
+            size = 0
+        pending.append(data)
+        size += len(data)
+    if pending:
+        yield pending[0] if len(pending) == 1 else b"".join(pending)
+
+
+class OutboundQueue:
+    """Bounded FIFO of encoded frames waiting to be written to one client.
+
+    put() never blocks, so broadcasting to a client that stopped reading only
+    costs an append. What happens once the queue is full is decided by the
+    slow-consumer policy.
+    """
+
+    def __init__(self, max_messages=DEFAULT_MAX_MESSAGES, policy=DROP_OLDEST, on_ready=None,
+                 max_pinned_bytes=MAX_PINNED_BYTES):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown slow-consumer policy '{policy}', expected one of {POLICIES}")
+        self.max_messages = max_messages
+        self.max_pinned_bytes = max_pinned_bytes
+        self.policy = policy
+        self.on_ready = on_ready  # called after every successful put (asyncio wake-up)
+        self.items = deque()      # (data, priority)
+        self.bytes = 0            # total size of queued frames
+        self.unpinned = 0         # queued frames that count against max_messages
+        self.pinned_bytes = 0     # size of the queued frames that do not, limited by max_pinned_bytes
+        self.dropped = 0
+        self.closed = False
+        self.cond = threading.Condition()
+        self.waiters = []  # callbacks from when_writable(), run once the writer has drained the queue
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, data, system=True, force=False):
+        """Queue data. Returns False if the client should be disconnected instead.
+
+        force skips the size limit for frames that must never be dropped and
+        whose producer applies its own flow control (file chunks). Those only
+        have max_pinned_bytes as a backstop, past which the client is disconnected.
+        """
+        priority = PINNED if force else (SYSTEM if system else CHAT)
+        with self.cond:
+            if self.closed:
+                return True
+            if not force and self.unpinned >= self.max_messages:
+                if not self._make_room(priority):
+                    # DROP_OLDEST and DROP_NON_SYSTEM drop the new frame when nothing queued may go, except
+                    # that a system frame with only system frames ahead of it disconnects under DROP_NON_SYSTEM
+                    DROPPED.inc()
+                    return self.policy == DROP_OLDEST or (self.policy == DROP_NON_SYSTEM and priority == CHAT)
+            if force and self.pinned_bytes + len(data) > self.max_pinned_bytes:
+                DROPPED.inc()
+                return False
+            self.items.append((data, priority))
+            self.bytes += len(data)
+            if force:
+                self.pinned_bytes += len(data)
+            else:
+                self.unpinned += 1
+            self.cond.notify()
+            QUEUE_DEPTH.observe(len(self.items))
+        MESSAGES_OUT.inc()
+        if self.on_ready:
+            self.on_ready()
+        return True
+
+    def _make_room(self, priority):
+        """Apply the slow-consumer policy. Returns True if the new item may be queued."""
+        if self.policy == DISCONNECT:
+            return False
+        # DROP_OLDEST may discard anything but pinned frames, DROP_NON_SYSTEM only chat lines
+        droppable = SYSTEM if self.policy == DROP_OLDEST else CHAT
+        for i, (_, queued_priority) in enumerate(self.items):
+            if queued_priority <= droppable:
+                self.bytes -= len(self.items[i][0])
+                self.unpinned -= 1
+                del self.items[i]
+                self.dropped += 1
+                DROPPED.inc()
+                return True
+        if priority <= droppable:
+            # The new item is the oldest droppable one
+            self.dropped += 1
+        return False
+
+    def take_all(self, block=True, timeout=None):
+        """Return every queued frame (oldest first), or None once closed and drained."""
+        with self.cond:
+            if block:
+                while not self.items and not self.closed:
+                    if not self.cond.wait(timeout):
+                        return []
+            if not self.items:
+                return None if self.closed else []
+            batch = [data for data, _ in self.items]
+            self.items.clear()
+            self.bytes = 0
+            self.unpinned = 0
+            self.pinned_bytes = 0
+            self.cond.notify_all()  # wake producers waiting in wait_for_space()
+            waiters, self.waiters = self.waiters, []
+        for callback in waiters:
+            callback()
+        return batch
+
+    def has_space(self, max_bytes=None, max_messages=None):
+        if max_bytes is not None and self.bytes >= max_bytes:
+            return False
+        return self.unpinned < min(self.max_messages, max_messages or self.max_messages)
+
+    def wait_for_space(self, timeout=None, max_bytes=None):
+        """Block until the queue is below its limit (and below max_bytes if given).
+
+        Returns False on timeout or close.
+        """
+        with self.cond:
+            ok = self.cond.wait_for(lambda: self.closed or self.has_space(max_bytes), timeout)
+            return ok and not self.closed
+
+    def when_writable(self, max_bytes, callback, max_messages=None):
+        """True if the queue has room. Otherwise False, and callback() runs on the writer once it
+        has taken everything queued (or when the queue closes; never if it already is). Never blocks.
+
+        max_messages, below the queue's own limit, keeps the rest of the queue free for other frames.
+        """
+        with self.cond:
+            if self.closed:
+                return False
+            if self.has_space(max_bytes, max_messages):
+                return True
+            self.waiters.append(callback)
+            return False
+
+    def close(self, discard=False):
+        with self.cond:
+            self.closed = True
+            if discard:
+                self.items.clear()
+                self.bytes = 0
+                self.unpinned = 0
+                self.pinned_bytes = 0
+            self.cond.notify_all()
+            waiters, self.waiters = self.waiters, []
+        for callback in waiters:
+            callback()
+        if self.on_ready:
+            self.on_ready()
+
+
+class ClientConnection:
+    """A client socket plus its outbound queue and dedicated writer thread.
+
+    Exposes the socket methods MessageHandler uses, so it can stand in for
+    the raw SSL socket everywhere (including as the key in the clients dict).
+    """
+
+    def __init__(self, sock, max_messages=DEFAULT_MAX_MESSAGES, policy=DROP_OLDEST, coalesce_delay=0.0):
+        self.sock = sock
+        self.queue = OutboundQueue(max_messages, policy)
+        # Optional window (seconds) the writer waits after the first frame so more can join its write
+        self.coalesce_delay = coalesce_delay
+        self.codec = None  # compression negotiated at login
+        try:
+            self.peername = sock.getpeername()
+        except OSError:
+            self.peername = None
+
+        thread = threading.Thread(target=self._write_loop)
+        thread.daemon = True
+        thread.start()
+
+    def _write_loop(self):
+        while True:
+            batch = self.queue.take_all()
+            if batch is None:
+                break
+            if self.coalesce_delay:
+                time.sleep(self.coalesce_delay)
+                batch.extend(self.queue.take_all(block=False) or ())
+            try:
+                for data in coalesce(batch):
+                    self.sock.sendall(data)
+                    BYTES_OUT.inc(len(data))
+            except Exception as e:
+                SEND_ERRORS.inc()
+                logger.log_event(f"[SEND ERROR] {self.peername}: {e}", ERROR, addr=self.peername)
+                self.queue.close(discard=True)
+                break
+        # Shutting down here also unblocks the reader thread, which then cleans up the client
+        self._shutdown()
+
+    def send(self, data, system=True, force=False):
+        if not self.queue.put(data, system, force):
+            logger.log_event(f"[SLOW CONSUMER] Disconnecting {self.peername} ({self.queue.policy})", WARNING,
+                             addr=self.peername)
+            self.abort()
+        return len(data)
+
+    def sendall(self, data):
+        self.send(data)
+
+    def wait_writable(self, timeout=None, max_bytes=None):
+        return self.queue.wait_for_space(timeout, max_bytes)
+
+    def when_writable(self, max_bytes, callback, max_messages=None):
+        return self.queue.when_writable(max_bytes, callback, max_messages)
+
+    def recv_into(self, buffer, nbytes=0):
+        return self.sock.recv_into(buffer, nbytes)
+
+    def getpeername(self):
+        return self.peername
+
+    def close(self):
+        # Let the writer flush what is already queued (e.g. "Goodbye."), then close
+        self.queue.close()
+
+    def abort(self):
+        self.queue.close(discard=True)
+        self._shutdown()
+
+    def _shutdown(self):
+        # close() alone does not wake a thread blocked in recv() on the same socket
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except:
+            pass
+        try:
+            self.sock.close()
+        except:
+            pass
@@ -0,0 +1,249 @@
+# protocol.py
+"""Wire framing shared by the server and the clients.
+
+Every message travels as one frame:
+
+    +---------+------+-------+----------------+-----------------+
+    | version | type | flags | length (uint32) | payload (bytes) |
+    +---------+------+-------+----------------+-----------------+
+
+so TCP is free to merge or split writes without the receiver ever
+confusing where one message ends and the next begins.
+
+Compression is negotiated at login: the client lists the codecs it can
+read in its HELLO, the server picks one and names it in its WELCOME. From
+then on either side may set FLAG_COMPRESSED on a frame whose payload is
+large enough to be worth it. Those payloads are compressed on their own,
+so one compressed broadcast frame can be queued for every recipient that
+negotiated the codec. FILE_DATA is the exception: a transfer's chunks form
+one deflate stream (each chunk ends on a sync flush), which compresses far
+better than chunk by chunk, and the receiver keeps one decompressor per
+transfer.
+"""
+import json
+import struct
+import zlib
+
+PROTOCOL_VERSION = 1
+HEADER = struct.Struct("!BBBI")  # version, frame type, flags, payload length
+MAX_PAYLOAD = 16 * 1024 * 1024
+LOGIN_MAX_PAYLOAD = 64 * 1024  # until the HELLO has been read, nothing bigger is accepted
+DEFAULT_BUFFER_SIZE = 256 * 1024
+
+# ---------------- FRAME TYPES ----------------
+HELLO = 1        # client -> server login, JSON object with at least "username"
+TEXT = 2         # chat line, command or system message (UTF-8)
+FILE_START = 3   # server -> recipient, JSON {"id", "from", "name", "size"}
+FILE_DATA = 4    # transfer id (TRANSFER_ID_SIZE ASCII bytes) + raw file bytes
+FILE_END = 5     # JSON {"id", "sha256"} of the complete file
+FILE_OFFER = 6   # sender -> server, JSON {"id", "to", "name", "size"}
+FILE_ACCEPT = 7  # recipient -> server -> sender, JSON {"id", "offset"} to start (or resume) at
+FILE_CANCEL = 8  # either direction, JSON {"id", "reason"}
+WELCOME = 9      # server -> client after login, JSON {"username", "compression"}
+PING = 10        # either direction, asks the peer for a PONG carrying the same payload
+PONG = 11
+PING_MAX_PAYLOAD = 64  # a PING is echoed back, so it may not carry more than this
+
+TRANSFER_ID_SIZE = 16
+
+# ---------------- COMPRESSION ----------------
+FLAG_COMPRESSED = 0x01
+COMPRESSION_CODECS = ("zlib",)  # codecs this side can read, in order of preference
+COMPRESS_MIN_SIZE = 512         # smaller payloads are sent as they are
+COMPRESS_LEVEL = 6
+# A chunk that compresses worse than this (already compressed data) ends compression for its transfer
+MIN_FILE_COMPRESSION_RATIO = 0.9
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode_frame(frame_type, payload=b"", flags=0):
+    return HEADER.pack(PROTOCOL_VERSION, frame_type, flags, len(payload)) + payload
+
+
+def encode_text(text):
+    return encode_frame(TEXT, text.encode('utf-8'))
+
+
+def encode_json(frame_type, fields):
+    return encode_frame(frame_type, json.dumps(fields).encode('utf-8'))
+
+
+def decode_json(payload):
+    try:
+        fields = json.loads(str(payload, 'utf-8'))
+    except ValueError as e:
+        raise ProtocolError(f"Malformed control frame: {e}")
+    if not isinstance(fields, dict):
+        raise ProtocolError("Malformed control frame")
+    return fields
+
+
+def negotiate_compression(offered):
+    """The codec to use with a peer that can read the codecs offered, or None."""
+    if isinstance(offered, (list, tuple)):
+        for codec in COMPRESSION_CODECS:
+            if codec in offered:
+                return codec
+    return None
+
+
+def compress_frame(frame, codec, variants=None):
+    """frame as sent to a peer that negotiated codec: payload compressed if that saves anything.
+
+    variants, a dict, caches the result per codec so one broadcast frame is
+    compressed once however many recipients share the codec.
+    """
+    if codec is None or len(frame) - HEADER.size < COMPRESS_MIN_SIZE:
+        return frame
+    if variants is not None and codec in variants:
+        return variants[codec]
+    version, frame_type, flags, length = HEADER.unpack_from(frame)
+    packed = zlib.compress(memoryview(frame)[HEADER.size:], COMPRESS_LEVEL)
+    if len(packed) < length:
+        frame = HEADER.pack(version, frame_type, flags | FLAG_COMPRESSED, len(packed)) + packed
+    if variants is not None:
+        variants[codec] = frame
+    return frame
+
+
+class StreamCompressor:
+    """Compresses the chunks of one file transfer as a single deflate stream."""
+
+    def __init__(self, codec):
+        self.deflater = zlib.compressobj(COMPRESS_LEVEL) if codec else None
+
+    def compress(self, chunk):
+        """Compressed bytes for the next chunk (FLAG_COMPRESSED), or None to send it as it is."""
+        if self.deflater is None:
+            return None
+        packed = self.deflater.compress(chunk) + self.deflater.flush(zlib.Z_SYNC_FLUSH)
+        if len(packed) < len(chunk) * MIN_FILE_COMPRESSION_RATIO:
+            return packed
+        # Already compressed data (archives, media): the rest of the file goes as it is
+        self.deflater = None
+        return None
+
+
+def decompress_payload(payload, max_size=MAX_PAYLOAD):
+    """Inflate a payload sent with FLAG_COMPRESSED (not FILE_DATA, which is a stream)."""
+    return inflate(zlib.decompressobj(), payload, max_size)
+
+
+def inflate(decompressor, data, max_size=MAX_PAYLOAD):
+    """Feed data to decompressor, refusing output beyond max_size (a compression bomb)."""
+    try:
+        out = decompressor.decompress(data, max_size)
+    except zlib.error as e:
+        raise ProtocolError(f"Bad compressed payload: {e}")
+    if decompressor.unconsumed_tail:
+        raise ProtocolError(f"Compressed payload inflates beyond {max_size} bytes")
+    return out
+
+
+def encode_hello(username, **fields):
+    fields["username"] = username
+    return encode_json(HELLO, fields)
+
+
+def decode_hello(payload):
+    return decode_json(payload)
+
+
+class FrameDecoder:
+    """Incremental frame decoder over one reusable receive buffer.
+
+    Socket data is read straight into the buffer with recv_into() and frames
+    are handed out as memoryview slices of it, so nothing is copied on the
+    way in. A payload view stays valid only until the next recv_from() or
+    feed() call; callers that need to keep it must copy it themselves.
+    """
+
+    def __init__(self, capacity=DEFAULT_BUFFER_SIZE, max_payload=MAX_PAYLOAD):
+        self.max_payload = max_payload
+        self._buf = bytearray(capacity)
+        self._view = memoryview(self._buf)
+        self._start = 0  # first unconsumed byte
+        self._end = 0    # end of received data
+        self._missing = 0  # bytes still needed to complete the pending frame
+        self._last = (0, 0)  # span of the last frame returned, header included
+
+    def _reserve(self, size):
+        """Make sure at least size bytes are free after the received data."""
+        if len(self._buf) - self._end >= size:
+            return
+        pending = self._end - self._start
+        if pending + size <= len(self._buf):
+            # Slide the partial frame to the front (memmove, no reallocation)
+            self._view[:pending] = self._view[self._start:self._end]
+        else:
+            # Views handed out earlier keep the old buffer alive, so swap in a new one
+            new_buf = bytearray(max(pending + size, 2 * len(self._buf)))
+            new_buf[:pending] = self._view[self._start:self._end]
+            self._buf = new_buf
+            self._view = memoryview(new_buf)
+        self._start = 0
+        self._end = pending
+
+    def recv_from(self, sock, size=4096):
+        """Read whatever is available (at least room for size bytes). Returns 0 on EOF."""
+        # Room for the rest of a large frame is made as it arrives (the buffer at most doubles
+        # per read), not all at once from the length a peer merely declared
+        self._reserve(max(size, min(self._missing, len(self._buf) // 2)))
+        n = sock.recv_into(self._view[self._end:])
+        self._end += n
+        return n
+
+    def feed(self, data):
+        """Append bytes that were read elsewhere (e.g. an asyncio StreamReader)."""
+        self._reserve(len(data))
+        self._view[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+    def next_frame(self):
+        """Return (frame_type, flags, payload) for the next complete frame, or None."""
+        available = self._end - self._start
+        if available < HEADER.size:
+            if available == 0:
+                self._start = self._end = 0
+            return None
+        version, frame_type, flags, length = HEADER.unpack_from(self._buf, self._start)
+        if version != PROTOCOL_VERSION:
+            raise ProtocolError(f"Unsupported protocol version {version}")
+        if length > self.max_payload:
+            raise ProtocolError(f"Frame of {length} bytes exceeds limit of {self.max_payload}")
+        if available < HEADER.size + length:
+            # Lets recv_from() read the rest of a large frame in big chunks
+            self._missing = HEADER.size + length - available
+            return None
+        self._missing = 0
+        frame_start = self._start
+        payload_start = frame_start + HEADER.size
+        self._start = payload_start + length
+        self._last = (frame_start, self._start)
+        return frame_type, flags, self._view[payload_start:self._start]
+
+    def last_frame(self):
+        """Header + payload of the frame last returned, for relaying it verbatim."""
+        start, end = self._last
+        return self._view[start:end]
+
+    def frames(self):
+        """Yield every complete frame currently buffered."""
+        while True:
+            frame = self.next_frame()
+            if frame is None:
+                return
+            yield frame
+
+
+def read_frame(sock, decoder):
+    """Block until one whole frame has arrived on sock. Returns None on EOF."""
+    while True:
+        frame = decoder.next_frame()
+        if frame is not None:
+            return frame
+        if not decoder.recv_from(sock):
+            return None
@@ -0,0 +1,88 @@
+# rate_limit.py
+"""Per-connection token buckets for what clients send.
+
+Each connection has a message bucket and a byte bucket for every kind of
+traffic: chat (room messages, commands and PING/PONG heartbeats), private
+messages and file transfers. A frame that overdraws a bucket is still handled, nothing is
+dropped, but the server then stops reading from that client until the
+bucket has refilled. The excess waits in the client's own socket buffers
+and TCP slows the sender down. Optionally (--rate-disconnect), a client
+kept over its limit for longer than a threshold is dropped.
+"""
+import time
+
+CHAT = "chat"
+PM = "pm"
+FILE = "file"
+KINDS = (CHAT, PM, FILE)
+
+# kind -> (messages per second, message burst, bytes per second, byte burst); a rate of 0 is unlimited.
+# FILE_DATA chunks only count towards the byte bucket, the other file frames towards the message bucket.
+DEFAULT_LIMITS = {
+    CHAT: (20.0, 40, 64 * 1024, 256 * 1024),
+    PM: (20.0, 40, 64 * 1024, 256 * 1024),
+    FILE: (10.0, 50, 0, 0),
+}
+# Seconds a client may stay over its limit before it is disconnected (0: never). Pausing
+# reads already throttles it, so disconnecting is opt-in
+DEFAULT_DISCONNECT_AFTER = 0
+
+
+def parse_limit(spec):
+    """'kind:msgs_per_s:burst:bytes_per_s:byte_burst' (command line) -> (kind, limits)."""
+    parts = spec.split(":")
+    if len(parts) != 5 or parts[0] not in KINDS:
+        raise ValueError(f"expected <{'|'.join(KINDS)}>:<msgs/s>:<burst>:<bytes/s>:<byte burst>, got '{spec}'")
+    rate, burst, byte_rate, byte_burst = (float(p) for p in parts[1:])
+    if min(rate, burst, byte_rate, byte_burst) < 0:
+        raise ValueError(f"negative rate limit in '{spec}'")
+    return parts[0], (rate, burst, byte_rate, byte_burst)
+
+
+class TokenBucket:
+    """rate tokens a second, holding at most burst of them. A rate of 0 never limits."""
+
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+
+    def take(self, amount, now):
+        """Spend amount tokens, going into debt if need be. Returns seconds until the debt is paid off."""
+        if not self.rate:
+            return 0.0
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        self.tokens -= amount
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class RateLimiter:
+    """The buckets of one connection. Only its reader (thread or task) uses it, so there is no lock."""
+
+    def __init__(self, limits=DEFAULT_LIMITS, disconnect_after=DEFAULT_DISCONNECT_AFTER):
+        self.buckets = {kind: (TokenBucket(rate, burst), TokenBucket(byte_rate, byte_burst))
+                        for kind, (rate, burst, byte_rate, byte_burst) in limits.items()}
+        self.disconnect_after = disconnect_after
+        self.limited_since = None  # start of the current run of over-limit frames
+
+    def charge(self, kind, messages, size):
+        """Account for one frame. Returns how long to stop reading from the client (0: carry on)."""
+        buckets = self.buckets.get(kind)
+        if buckets is None:
+            return 0.0
+        now = time.monotonic()
+        delay = max(buckets[0].take(messages, now), buckets[1].take(size, now))
+        if not delay:
+            self.limited_since = None
+        elif self.limited_since is None:
+            self.limited_since = now
+        return delay
+
+    def over_threshold(self):
+        """True once the client has been kept over its limit for disconnect_after seconds."""
+        return bool(self.disconnect_after and self.limited_since is not None
+                    and time.monotonic() - self.limited_since >= self.disconnect_after)
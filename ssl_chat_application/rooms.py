@@ -0,0 +1,94 @@
+# rooms.py
+import re
+from metrics import TimedLock, ROOMS_LOCK_WAIT
+
+# Every client starts here, so a server nobody /joins behaves like one big chat
+LOBBY = "lobby"
+
+# No leading dot: room names double as history directory names
+ROOM_NAME = re.compile(r"^[a-z0-9_-][a-z0-9_.-]{0,31}$")
+
+
+def normalize_room(name):
+    """Canonical room name for user input like '#Team-A', or None if it is not a valid name."""
+    name = name.strip().lstrip("#").lower()
+    return name if ROOM_NAME.match(name) else None
+
+
+class Room:
+    __slots__ = ("name", "members", "snapshot", "dirty")
+
+    def __init__(self, name):
+        self.name = name
+        self.members = {}  # connection -> None, an insertion-ordered set
+        self.snapshot = ()
+        self.dirty = False
+
+
+class RoomIndex:
+    """room -> members and connection -> room, for sending only to one room.
+
+    Each client is in exactly one room at a time. Like ClientRegistry, changes
+    are constant-time dict operations under one short lock, and each room keeps
+    its own lazily rebuilt member snapshot, so a join or leave in one room never
+    invalidates the snapshot another room's broadcasts are using.
+    """
+
+    def __init__(self):
+        self._lock = TimedLock(ROOMS_LOCK_WAIT)
+        self._rooms = {LOBBY: Room(LOBBY)}
+        self._room_of = {}  # connection -> Room
+
+    def join(self, conn, name):
+        """Move conn into room name (created on demand). Returns the room it left, or None."""
+        with self._lock:
+            previous = self._remove(conn)
+            room = self._rooms.get(name)
+            if room is None:
+                room = self._rooms[name] = Room(name)
+            room.members[conn] = None
+            room.dirty = True
+            self._room_of[conn] = room
+        return previous
+
+    def leave(self, conn):
+        """Take conn out of whatever room it is in. Returns that room's name, or None."""
+        with self._lock:
+            return self._remove(conn)
+
+    def _remove(self, conn):
+        # Called with the lock held
+        room = self._room_of.pop(conn, None)
+        if room is None:
+            return None
+        del room.members[conn]
+        room.dirty = True
+        if not room.members and room.name != LOBBY:
+            del self._rooms[room.name]
+        return room.name
+
+    def room_of(self, conn):
+        room = self._room_of.get(conn)
+        return room.name if room else None
+
+    def members(self, name):
+        """Immutable snapshot of the connections in room name, in join order."""
+        room = self._rooms.get(name)
+        if room is None:
+            return ()
+        if room.dirty:
+            with self._lock:
+                if room.dirty:
+                    room.snapshot = tuple(room.members)
+                    room.dirty = False
+        return room.snapshot
+
+    def rooms(self):
+        """(name, member count) for every room, lobby first."""
+        with self._lock:
+            return [(room.name, len(room.members)) for room in self._rooms.values()]
+
+    def clear(self):
+        with self._lock:
+            self._rooms = {LOBBY: Room(LOBBY)}
+            self._room_of.clear()
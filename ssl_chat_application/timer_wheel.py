@@ -0,0 +1,76 @@
+# timer_wheel.py
+"""One hashed timer wheel for every per-connection timeout on the server.
+
+Timers hash into a ring of slots by expiry tick; a single thread advances
+one slot per tick and fires what is due there, leaving timers that are
+whole revolutions away for a later pass. Scheduling and cancelling are O(1)
+whatever the number of connections, and there is one thread instead of
+one timer (or one sleeping thread) per socket.
+"""
+import threading
+import time
+from logger_utility import Logger, ERROR
+
+logger = Logger()
+
+DEFAULT_TICK = 0.5   # seconds; timers fire up to one tick late
+DEFAULT_SLOTS = 512  # one revolution = slots * tick seconds
+
+
+class Timer:
+    __slots__ = ("expiry", "callback")
+
+    def __init__(self, expiry, callback):
+        self.expiry = expiry  # tick number
+        self.callback = callback
+
+    def cancel(self):
+        # Stays in its slot until that slot comes round; dropping the callback frees what it refers to
+        self.callback = None
+
+
+class TimerWheel:
+    def __init__(self, tick=DEFAULT_TICK, slots=DEFAULT_SLOTS):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        self.current = 0  # last tick processed
+        self.running = True
+        thread = threading.Thread(target=self._run, name="timer-wheel")
+        thread.daemon = True
+        thread.start()
+
+    def schedule(self, delay, callback):
+        """Call callback() on the wheel thread after about delay seconds. Returns a Timer."""
+        with self.lock:
+            # Never into the slot being processed, or the timer would wait a whole revolution
+            expiry = max(int((time.monotonic() - self.start + delay) / self.tick) + 1, self.current + 1)
+            timer = Timer(expiry, callback)
+            self.slots[expiry % len(self.slots)].append(timer)
+        return timer
+
+    def _run(self):
+        while self.running:
+            next_tick = self.start + (self.current + 1) * self.tick
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            with self.lock:
+                self.current += 1
+                index = self.current % len(self.slots)
+                due = self.slots[index]
+                later = [timer for timer in due if timer.expiry > self.current and timer.callback]
+                self.slots[index] = later
+            for timer in due:
+                callback = timer.callback
+                if callback is None or timer.expiry > self.current:
+                    continue
+                timer.callback = None
+                try:
+                    callback()
+                except Exception as e:
+                    logger.log_event(f"[TIMER ERROR] {e!r}", ERROR)
+
+    def stop(self):
+        self.running = False
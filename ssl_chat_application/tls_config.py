@@ -0,0 +1,96 @@
+# tls_config.py
+"""TLS contexts for the server and clients, and client-side session reuse.
+
+A full handshake costs the server an RSA signature plus a key exchange;
+a resumed one (TLS 1.3 session ticket, or TLS 1.2 session id/ticket)
+skips the signature, which is what makes a reconnect storm affordable.
+The server hands out tickets, clients keep the SSLSession from their last
+connection and offer it on the next one.
+"""
+import os
+import ssl
+import threading
+
+CERT_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_CERT = os.path.join(CERT_DIR, "server.crt")
+SERVER_KEY = os.path.join(CERT_DIR, "server.key")
+CA_CERT = os.path.join(CERT_DIR, "ca_cert.pem")
+
+# TLS 1.2 suites: forward secret AEAD only (TLS 1.3 suites are fixed by OpenSSL)
+DEFAULT_CIPHERS = "ECDHE+AESGCM:ECDHE+CHACHA20"
+TLS_VERSIONS = {"1.2": ssl.TLSVersion.TLSv1_2, "1.3": ssl.TLSVersion.TLSv1_3}
+# TLS 1.3 tickets sent after each full handshake; each can resume one later connection
+DEFAULT_SESSION_TICKETS = 2
+
+
+def server_context(certfile=SERVER_CERT, keyfile=SERVER_KEY, ciphers=DEFAULT_CIPHERS, ecdh_curve=None,
+                   min_version="1.2", session_tickets=DEFAULT_SESSION_TICKETS):
+    """SSLContext for the server.
+
+    ecdh_curve pins the key exchange group (e.g. "prime256v1"); by default
+    OpenSSL negotiates its preferred group, X25519 first. session_tickets=0
+    disables tickets, leaving only the server-side session cache for TLS 1.2.
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certfile=certfile, keyfile=keyfile)
+    context.minimum_version = TLS_VERSIONS[min_version]
+    context.maximum_version = ssl.TLSVersion.TLSv1_3
+    context.options |= ssl.OP_CIPHER_SERVER_PREFERENCE | ssl.OP_NO_COMPRESSION
+    if ciphers:
+        context.set_ciphers(ciphers)
+    if ecdh_curve:
+        context.set_ecdh_curve(ecdh_curve)
+    if session_tickets:
+        context.options &= ~ssl.OP_NO_TICKET
+        context.num_tickets = session_tickets
+    else:
+        context.options |= ssl.OP_NO_TICKET
+        context.num_tickets = 0
+    return context
+
+
+def client_context(cafile=CA_CERT, min_version="1.2"):
+    """SSLContext for clients: verifies the server certificate and hostname against cafile."""
+    context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH, cafile=cafile)
+    context.minimum_version = TLS_VERSIONS[min_version]
+    return context
+
+
+class SessionCache:
+    """Last TLS session per (host, port), offered again on the next connection.
+
+    A session can only be resumed through the SSLContext that created it, so
+    each one is kept together with its context.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions = {}  # (host, port) -> (context, session)
+
+    def get(self, host, port, context):
+        entry = self._sessions.get((host, port))
+        if entry is not None and entry[0] is context:
+            return entry[1]
+        return None
+
+    def remember(self, host, port, sock):
+        """Keep sock's session if it can be resumed.
+
+        With TLS 1.3 the ticket arrives after the handshake, so call this once
+        the server has sent something (or before closing the socket).
+        """
+        try:
+            session = sock.session
+        except (AttributeError, ValueError, OSError):
+            return
+        if session is not None and (session.has_ticket or session.id):
+            with self._lock:
+                self._sessions[(host, port)] = (sock.context, session)
+
+    def forget(self, host, port):
+        with self._lock:
+            self._sessions.pop((host, port), None)
+
+
+# Shared by every connection a client process makes
+SESSIONS = SessionCache()